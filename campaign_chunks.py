@@ -0,0 +1,202 @@
+# file: campaign_chunks.py
+"""
+Campagna a pezzi: solo la parte utile al turno arriva al DM.
+
+campaign_story.txt viene diviso una volta (per versione del file) in chunk:
+- sezioni [TITOLO] ... : "core" (sempre nel prompt di sistema) se il titolo è
+  tra CAMPAIGN_CORE_SECTIONS, altrimenti "note" recuperate per parole chiave;
+- atti (righe "ATTO n:" / "ACT n:"): nel prompt di sistema vanno solo l'atto
+  corrente (game_state.current_act) e il successivo;
+- stadi di affinità (righe "STAGE n: ... (Affinity a-b)"): per turno, lo stadio
+  corrente e il successivo della compagna attiva e di ogni NPC in scena.
+
+Le note e gli stadi finiscono in dm_input["campaign_notes"]; il prompt di sistema
+cambia solo al cambio d'atto (la context cache resta valida dentro l'atto).
+La dimensione del prompt non cresce più con la lunghezza della campagna.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+CAMPAIGN_CHUNKING = os.getenv("CAMPAIGN_CHUNKING", "1").strip().lower() in ("1", "true", "yes", "on")
+# Sezioni sempre presenti (match sul titolo, senza maiuscole/minuscole)
+CAMPAIGN_CORE_SECTIONS = tuple(
+    s.strip().lower() for s in os.getenv(
+        "CAMPAIGN_CORE_SECTIONS",
+        "titolo,title,ambientazione,setting,trama,plot,characters,personaggi,regolamento,rules,"
+        "challenge,sfide,reward,premi,trigger",
+    ).split(",") if s.strip()
+)
+# Note recuperate per turno (le più pertinenti)
+CAMPAIGN_NOTES_MAX = int(os.getenv("CAMPAIGN_NOTES_MAX", "3") or "3")
+
+_SECTION_RE = re.compile(r"^\[(.+?)\]\s*$")
+_ACT_RE = re.compile(r"^(?:ATTO|ACT)\s+(\d+)\b", re.IGNORECASE)
+_STAGE_RE = re.compile(r"^STAGE\s+(\d+)\b", re.IGNORECASE)
+_RANGE_RE = re.compile(r"\(\s*affinit[yà]\s+(-?\d+)\s*-\s*(-?\d+)\s*\)", re.IGNORECASE)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class Chunk(NamedTuple):
+    kind: str  # "core" | "act" | "stage" | "stage_intro" | "note"
+    section: str
+    title: str
+    text: str
+    number: Optional[int] = None  # atto / stadio
+    affinity: Optional[tuple] = None  # (min, max) per gli stadi
+    keywords: FrozenSet[str] = frozenset()
+
+
+def _words(text: str) -> List[str]:
+    return [w.lower() for w in _WORD_RE.findall(text or "") if len(w) >= 4 and not w.isdigit()]
+
+
+class Campaign:
+    def __init__(self, chunks: List[Chunk]) -> None:
+        self.chunks = chunks
+        self.acts = sorted((c for c in chunks if c.kind == "act"), key=lambda c: c.number)
+        self.stages = sorted((c for c in chunks if c.kind == "stage"), key=lambda c: c.number)
+
+    # --- prompt di sistema ---
+
+    def act_number(self, current_act: Any) -> Optional[int]:
+        if not self.acts:
+            return None
+        match = re.search(r"\d+", str(current_act or ""))
+        wanted = int(match.group()) if match else self.acts[0].number
+        numbers = [c.number for c in self.acts]
+        return wanted if wanted in numbers else numbers[0]
+
+    def system_text(self, act_number: Optional[int]) -> str:
+        """Sezioni core + atto corrente e successivo, nell'ordine del file."""
+        allowed = set()
+        if act_number is not None:
+            following = [c.number for c in self.acts if c.number > act_number]
+            allowed = {act_number} | ({min(following)} if following else set())
+        parts = []
+        for chunk in self.chunks:
+            if chunk.kind == "core" or (chunk.kind == "act" and chunk.number in allowed):
+                parts.append(chunk.text)
+        return "\n\n".join(parts)
+
+    # --- note per turno ---
+
+    def notes_for(self, game_state: Dict[str, Any], turn_text: str,
+                  npcs: Iterable[str] = ()) -> List[Dict[str, str]]:
+        """npcs: altri NPC in scena (oltre alla compagna attiva), ognuno col suo stadio."""
+        names = [str(game_state.get("companion_name") or "")] + [str(n) for n in npcs]
+        stages = self._stages_for(game_state, names)
+        if stages:
+            stages = [c for c in self.chunks if c.kind == "stage_intro"] + stages
+        notes = [{"title": c.title, "text": c.text} for c in stages]
+
+        words = set(_words(turn_text))
+        scored = []
+        for index, chunk in enumerate(self.chunks):
+            if chunk.kind != "note":
+                continue
+            score = len(chunk.keywords & words)
+            if score:
+                scored.append((-score, index, chunk))
+        for _score, _index, chunk in sorted(scored)[:CAMPAIGN_NOTES_MAX]:
+            notes.append({"title": chunk.title, "text": chunk.text})
+        return notes
+
+    def _stages_for(self, game_state: Dict[str, Any], names: List[str]) -> List[Chunk]:
+        """Unione di stadio corrente + successivo per ogni NPC in scena (ogni stadio li descrive tutti)."""
+        if not self.stages:
+            return []
+        scores = game_state.get("affinity_scores") if isinstance(game_state.get("affinity_scores"), dict) else {}
+        selected: Dict[int, Chunk] = {}
+        for name in dict.fromkeys(names):
+            try:
+                affinity = int(scores.get(name, 0) or 0)
+            except (TypeError, ValueError):
+                affinity = 0
+            current = next((c for c in self.stages if c.affinity and c.affinity[0] <= affinity <= c.affinity[1]), None)
+            if current is None:
+                # Fuori dagli intervalli (o stadi senza intervallo): il primo se sotto, l'ultimo se sopra
+                low = self.stages[0].affinity
+                current = self.stages[0] if (low is None or affinity < low[0]) else self.stages[-1]
+            following = [c for c in self.stages if c.number > current.number]
+            for chunk in [current] + following[:1]:
+                selected[chunk.number] = chunk
+        return [selected[n] for n in sorted(selected)]
+
+
+def parse_campaign(text: str) -> Campaign:
+    chunks: List[Chunk] = []
+    section = ""
+    section_kind = "core"
+    buffer: List[str] = []
+    current: Dict[str, Any] = {}
+
+    def flush() -> None:
+        body = "\n".join(buffer).strip()
+        buffer.clear()
+        if not body:
+            return
+        kind = current.get("kind") or section_kind
+        title = current.get("title") or section
+        chunks.append(Chunk(kind=kind, section=section, title=title, text=body,
+                            number=current.get("number"), affinity=current.get("affinity")))
+
+    for line in (text or "").splitlines():
+        stripped = line.strip()
+        header = _SECTION_RE.match(stripped)
+        if header:
+            flush()
+            current = {}
+            section = header.group(1).strip()
+            section_kind = "core" if any(k in section.lower() for k in CAMPAIGN_CORE_SECTIONS) else "note"
+            buffer.append(stripped)
+            continue
+        act = _ACT_RE.match(stripped)
+        stage = _STAGE_RE.match(stripped)
+        if act or stage:
+            flush()
+            if act:
+                current = {"kind": "act", "title": stripped, "number": int(act.group(1))}
+            else:
+                span = _RANGE_RE.search(stripped)
+                current = {"kind": "stage", "title": stripped, "number": int(stage.group(1)),
+                           "affinity": (int(span.group(1)), int(span.group(2))) if span else None}
+        buffer.append(line.rstrip())
+    flush()
+
+    # L'introduzione di una sezione divisa in atti/stadi segue il destino dei suoi pezzi:
+    # con gli atti è core (intestazione della struttura), con gli stadi accompagna gli stadi
+    act_sections = {c.section for c in chunks if c.kind == "act"}
+    stage_sections = {c.section for c in chunks if c.kind == "stage"}
+    chunks = [c._replace(kind="core") if c.kind == "note" and c.section in act_sections
+              else c._replace(kind="stage_intro") if c.kind == "note" and c.section in stage_sections
+              else c for c in chunks]
+
+    # Parole chiave: solo quelle che distinguono un chunk (presenti in al massimo 2 chunk)
+    counts = Counter(w for c in chunks for w in set(_words(c.text)))
+    chunks = [c._replace(keywords=frozenset(w for w in _words(c.text) if counts[w] <= 2))
+              if c.kind == "note" else c for c in chunks]
+    return Campaign(chunks)
+
+
+_cache_lock = threading.Lock()
+_parsed: Dict[str, Campaign] = {}
+
+
+def get_campaign(text: Optional[str]) -> Campaign:
+    """Campagna già divisa, per contenuto del file (il parsing avviene una volta per versione)."""
+    key = hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+    with _cache_lock:
+        campaign = _parsed.get(key)
+        if campaign is None:
+            campaign = parse_campaign(text or "")
+            _parsed.clear()  # teniamo solo la versione corrente
+            _parsed[key] = campaign
+            kinds = Counter(c.kind for c in campaign.chunks)
+            print(f"[CAMPAIGN] {len(campaign.chunks)} chunk: {dict(kinds)}")
+        return campaign
@@ -1,17 +1,24 @@
 # comfy_bridge.py
 from __future__ import annotations
 
+import hashlib
 import json
 import os
 import shutil
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
 from urllib.parse import urlparse
 
 import requests
 import websocket
 from dotenv import load_dotenv
-from google import genai
+
+from cost_ledger import LEDGER, usage_from_gemini
+from gemini_scheduler import SCHEDULER, is_rate_limited, shared_client
 
 # Importazione corretta dei comandi SD per la VRAM
 try:
@@ -34,10 +41,18 @@ COMFY_WS_URL = COMFY_URL.replace("https://", "wss://").replace("http://", "ws://
 CLIENT_ID = str(uuid.uuid4())
 
 API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=API_KEY) if API_KEY else None
+# Attesa massima di uno slot nello scheduler Gemini: oltre, si usa il prompt italiano
+I2V_PROMPT_QUOTA_WAIT_SEC = float(os.getenv("I2V_PROMPT_QUOTA_WAIT_SEC", "20") or "20")
 
 COMFY_OUTPUT_PATH = (os.getenv("COMFY_OUTPUT_PATH", "") or "").strip()
 
+# Cache su disco dei prompt I2V già tradotti (stesso testo italiano -> stesso inglese)
+I2V_PROMPT_CACHE = os.getenv("I2V_PROMPT_CACHE", "1").strip().lower() in ("1", "true", "yes", "on")
+I2V_PROMPT_CACHE_PATH = Path(os.getenv("I2V_PROMPT_CACHE_PATH", "storage/i2v_prompt_cache.json"))
+I2V_PROMPT_CACHE_MAX = int(os.getenv("I2V_PROMPT_CACHE_MAX", "500") or "500")
+# Scadenza delle voci in giorni (0 = mai)
+I2V_PROMPT_CACHE_TTL_DAYS = float(os.getenv("I2V_PROMPT_CACHE_TTL_DAYS", "0") or "0")
+
 
 def _is_local_comfy() -> bool:
     try:
@@ -66,17 +81,9 @@ def free_comfy_vram() -> bool:
 # Gemini (IT -> EN + prompt engineer) - TUA LOGICA ORIGINALE
 # ---------------------------------------------------------------------------
 
-def get_gemini_prompt(prompt_it: str) -> str:
-    prompt_it = (prompt_it or "").strip()
-    if not prompt_it:
-        return "cinematic realism, subtle natural motion, stable identity, smooth camera movement"
-
-    if not client:
-        return prompt_it
-
-    print(f"🧠 [Gemini] Prompt engineer I2V (da IT): '{prompt_it}'")
+I2V_PROMPT_MODEL = "gemini-2.0-flash"
 
-    sys_instruction = """
+I2V_SYSTEM_INSTRUCTION = """
     You are an elite AI video prompt engineer specialized in image-to-video (I2V) models (Wan/LongCat style).
     Task:
     1) Translate the user prompt from Italian to English.
@@ -91,17 +98,139 @@ def get_gemini_prompt(prompt_it: str) -> str:
     - Output ONLY the final English positive prompt (single paragraph). No quotes, no markdown, no extra text.
     """
 
+# Cambiando istruzioni o modello le vecchie traduzioni non valgono più
+_I2V_INSTRUCTION_HASH = hashlib.sha256(
+    f"{I2V_PROMPT_MODEL}\n{I2V_SYSTEM_INSTRUCTION}".encode("utf-8")).hexdigest()[:16]
+
+
+class I2VPromptCache:
+    """LRU su un file JSON: chiave = testo normalizzato + hash delle istruzioni.
+
+    Un hit aggiorna l'ordine solo in memoria; il file si riscrive a ogni inserimento
+    (che può anche eliminare voci) e alla chiusura (flush), non a ogni lettura.
+    """
+
+    def __init__(self, path: Path = I2V_PROMPT_CACHE_PATH, max_entries: int = I2V_PROMPT_CACHE_MAX,
+                 ttl_sec: float = I2V_PROMPT_CACHE_TTL_DAYS * 86400) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._entries: Optional[OrderedDict] = None  # letto alla prima richiesta
+        self._dirty = False  # ordine LRU cambiato dopo l'ultimo salvataggio
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt_it: str) -> str:
+        normalized = " ".join((prompt_it or "").split()).casefold()
+        return hashlib.sha256(f"{_I2V_INSTRUCTION_HASH}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def _load(self) -> OrderedDict:
+        if self._entries is None:
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                items = data.items() if isinstance(data, dict) else []
+            except (OSError, ValueError):
+                items = []
+            # Dal meno al più recente: l'ordine dell'OrderedDict è l'ordine LRU
+            self._entries = OrderedDict(sorted(
+                ((k, v) for k, v in items if isinstance(v, dict) and v.get("prompt_en")),
+                key=lambda kv: kv[1].get("used", 0)))
+        return self._entries
+
+    def _save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except OSError as e:
+            print(f"⚠️ [I2V-CACHE] Salvataggio fallito: {e}")
+
+    def get(self, prompt_it: str) -> Optional[str]:
+        key = self.key(prompt_it)
+        now = time.time()
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry and self.ttl_sec > 0 and now - entry.get("created", 0) > self.ttl_sec:
+                del entries[key]
+                self._dirty = True
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            entry["used"] = now
+            entries.move_to_end(key)
+            self._dirty = True
+            self.hits += 1
+            return entry["prompt_en"]
+
+    def put(self, prompt_it: str, prompt_en: str) -> None:
+        if not prompt_en:
+            return
+        key = self.key(prompt_it)
+        now = time.time()
+        with self._lock:
+            entries = self._load()
+            entries[key] = {"prompt_it": prompt_it, "prompt_en": prompt_en, "created": now, "used": now}
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._save()
+
+    def flush(self) -> None:
+        """Salva l'ordine LRU aggiornato dai hit (chiamato alla chiusura della GUI)."""
+        with self._lock:
+            if self._entries is not None and self._dirty:
+                self._save()
+
+
+PROMPT_CACHE = I2VPromptCache()
+
+
+def get_gemini_prompt(prompt_it: str) -> str:
+    prompt_it = (prompt_it or "").strip()
+    if not prompt_it:
+        return "cinematic realism, subtle natural motion, stable identity, smooth camera movement"
+
+    # Stesso testo già tradotto: niente chiamata, e il testo identico fa scattare
+    # anche la cache di WanVideoTextEncodeCached in ComfyUI
+    cached = PROMPT_CACHE.get(prompt_it) if I2V_PROMPT_CACHE else None
+    if cached:
+        print(f"✨ [Gemini] Prompt EN dalla cache ({PROMPT_CACHE.hits} hit): {cached}")
+        return cached
+
+    # Client condiviso con llm_client: una sola quota, coordinata da SCHEDULER
+    client = shared_client(API_KEY or "")
+    if not client:
+        return prompt_it
+
+    print(f"🧠 [Gemini] Prompt engineer I2V (da IT): '{prompt_it}'")
+
+    # Priorità più bassa: i turni del DM passano sempre davanti
+    if not SCHEDULER.acquire("video", timeout=I2V_PROMPT_QUOTA_WAIT_SEC):
+        print("⚠️ [Gemini] Quota occupata dai turni: uso prompt originale.")
+        return prompt_it
+
     try:
         response = client.models.generate_content(
-            model="gemini-2.0-flash",
+            model=I2V_PROMPT_MODEL,
             contents=f"Italian prompt:\n{prompt_it}",
-            config={"system_instruction": sys_instruction, "temperature": 0.35},
+            config={"system_instruction": I2V_SYSTEM_INSTRUCTION, "temperature": 0.35},
         )
+        LEDGER.record_llm(I2V_PROMPT_MODEL, usage_from_gemini(getattr(response, "usage_metadata", None)), "video")
         out = (response.text or "").strip()
         out = " ".join(out.split())
         print(f"✨ [Gemini] Prompt EN (engineered): {out}")
+        if out and I2V_PROMPT_CACHE:
+            PROMPT_CACHE.put(prompt_it, out)
         return out if out else prompt_it
     except Exception as e:
+        if is_rate_limited(e):
+            SCHEDULER.penalize(e)
         print(f"⚠️ Errore Gemini: {e}. Uso prompt originale.")
         return prompt_it
 
@@ -203,6 +332,17 @@ def _pick_best_video(candidates: list[tuple[str, str, str]]) -> tuple[str, str,
     return best if score(best[0]) < 9 else None
 
 
+def _execution_seconds(prompt_id: str) -> float | None:
+    """Durata dell'esecuzione lato ComfyUI (execution_start -> execution_success nella history)."""
+    try:
+        messages = (_get_history_item(prompt_id).get("status") or {}).get("messages") or []
+        stamps = {name: data.get("timestamp") for name, data in messages if isinstance(data, dict)}
+        start, end = stamps.get("execution_start"), stamps.get("execution_success")
+        return (end - start) / 1000.0 if start and end else None
+    except Exception:
+        return None
+
+
 def get_latest_video_file(folder: str, max_age_seconds: int = 300) -> str | None:
     if not folder or not os.path.exists(folder):
         return None
@@ -308,9 +448,11 @@ def track_and_download(ws: websocket.WebSocket, prompt_id: str, output_filename:
 # ---------------------------------------------------------------------------
 
 def generate_video_from_image(image_path: str, text_context: str,
-                              output_path: str = "storage/videos/output.mp4") -> str | None:
+                              output_path: str = "storage/videos/output.mp4",
+                              prompt_en: Optional[str] = None) -> str | None:
     """
     Genera un video usando il workflow LongCat gestendo la VRAM di Stable Diffusion.
+    prompt_en: prompt inglese già pronto (animation_instructions_en del DM): salta la traduzione.
     """
     # 1) STAFFETTA: SPEGNIMENTO SD
     if SD_VRAM_GUARD:
@@ -326,7 +468,10 @@ def generate_video_from_image(image_path: str, text_context: str,
             print(f"❌ ERRORE: Manca '{workflow_file}'.")
             return None
 
-        prompt_text = get_gemini_prompt(text_context)
+        prompt_en = " ".join((prompt_en or "").split())
+        if prompt_en:
+            print(f"✨ [ComfyUI] Prompt EN dal DM: {prompt_en}")
+        prompt_text = prompt_en or get_gemini_prompt(text_context)
         comfy_image_name = upload_image(image_path)
 
         text_node_id = None
@@ -351,7 +496,11 @@ def generate_video_from_image(image_path: str, text_context: str,
             response = queue_workflow(workflow)
             prompt_id = response.get("prompt_id")
             if not prompt_id: return None
-            return track_and_download(ws, prompt_id, output_path)
+            started = time.monotonic()
+            saved = track_and_download(ws, prompt_id, output_path)
+            LEDGER.record_video(_execution_seconds(prompt_id), time.monotonic() - started,
+                                prompt_source="dm" if prompt_en else "tradotto")
+            return saved
         finally:
             if ws.connected:
                 try:
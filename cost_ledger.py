@@ -0,0 +1,203 @@
+# file: cost_ledger.py
+"""
+Registro dei costi: quanto consuma ogni turno e ogni video.
+
+Ogni evento è una riga JSON compatta, solo in aggiunta, in COST_LEDGER_PATH:
+- "llm":   token di input / in cache / output (/ ragionamento) per modello, da usage_metadata;
+- "sd":    steps x megapixel dell'immagine (dal blocco "info" di A1111) e secondi di GPU
+           (durata della richiesta txt2img: A1111 lavora un'immagine alla volta);
+- "video": secondi di esecuzione di ComfyUI (dalla history) e durata totale del job;
+- "tts":   caratteri sintetizzati (l'unità di fatturazione di Google TTS);
+- "turn":  chiusura del turno, con durata e totali del turno (solo chiamate LLM
+           "interactive": riassunto, video e duplicati hedge restano alla sessione).
+
+Ogni riga porta sessione ("s") e turno ("turn"), così il file si può aggregare
+a piacere; la GUI mostra il riepilogo della sessione corrente (rollup_text()).
+Le risposte riprodotte da llm_cache non costano nulla e non vengono registrate.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+COST_LEDGER = os.getenv("COST_LEDGER", "1").strip().lower() in ("1", "true", "yes", "on")
+COST_LEDGER_PATH = Path(os.getenv("COST_LEDGER_PATH", "storage/cost_ledger.jsonl"))
+
+_LLM_FIELDS = ("in", "cached", "out", "thoughts")
+
+
+def usage_from_gemini(usage: Any) -> Optional[Dict[str, int]]:
+    """usage_metadata di google-genai -> {in, cached, out, thoughts}."""
+    if usage is None:
+        return None
+    counts = {
+        "in": getattr(usage, "prompt_token_count", None),
+        "cached": getattr(usage, "cached_content_token_count", None),
+        "out": getattr(usage, "candidates_token_count", None),
+        "thoughts": getattr(usage, "thoughts_token_count", None),
+    }
+    counts = {k: int(v or 0) for k, v in counts.items()}
+    return counts if any(counts.values()) else None
+
+
+def usage_from_openai(usage: Any) -> Optional[Dict[str, int]]:
+    """Campo "usage" di /v1/chat/completions -> stesso formato."""
+    if not isinstance(usage, dict):
+        return None
+    details = usage.get("prompt_tokens_details") if isinstance(usage.get("prompt_tokens_details"), dict) else {}
+    completion = usage.get("completion_tokens_details") if isinstance(usage.get("completion_tokens_details"), dict) else {}
+    counts = {
+        "in": int(usage.get("prompt_tokens") or 0),
+        "cached": int(details.get("cached_tokens") or 0),
+        "out": int(usage.get("completion_tokens") or 0),
+        "thoughts": int(completion.get("reasoning_tokens") or 0),
+    }
+    return counts if any(counts.values()) else None
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {
+        "llm": {},  # modello -> {calls, in, cached, out, thoughts}
+        "sd": {"images": 0, "mp_steps": 0.0, "gpu_sec": 0.0},
+        "video": {"jobs": 0, "exec_sec": 0.0, "wall_sec": 0.0},
+        "tts": {"calls": 0, "chars": 0},
+    }
+
+
+class CostLedger:
+    def __init__(self, path: Path = COST_LEDGER_PATH, enabled: bool = COST_LEDGER) -> None:
+        self.path = path
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.session = uuid.uuid4().hex[:8]
+        self._turn: Any = None
+        self._turn_start: Optional[float] = None
+        self._session_totals = _empty_totals()
+        self._turn_totals = _empty_totals()
+        self._turns = 0
+
+    # --- turni e sessioni ---
+
+    def new_session(self) -> None:
+        """Sessione caricata/nuova: riepilogo da zero (il file resta com'è)."""
+        with self._lock:
+            self.session = uuid.uuid4().hex[:8]
+            self._session_totals = _empty_totals()
+            self._turn_totals = _empty_totals()
+            self._turns = 0
+            self._turn = None
+
+    def begin_turn(self, turn: Any) -> None:
+        with self._lock:
+            self._turn = turn
+            self._turn_start = time.monotonic()
+            self._turn_totals = _empty_totals()
+
+    def end_turn(self) -> Dict[str, Any]:
+        """Chiude il turno corrente: scrive la riga "turn" e restituisce i suoi totali."""
+        with self._lock:
+            if self._turn_start is None:
+                return _empty_totals()
+            totals, self._turn_totals = self._turn_totals, _empty_totals()
+            wall = time.monotonic() - self._turn_start
+            self._turn_start = None
+            self._turns += 1
+            sd = {k: round(v, 2) for k, v in totals["sd"].items()}
+            self._write({"k": "turn", "sec": round(wall, 2), "llm": totals["llm"], "sd": sd, "tts": totals["tts"]})
+        return totals
+
+    # --- eventi ---
+
+    def record_llm(self, model: Optional[str], usage: Optional[Dict[str, int]], source: str = "") -> None:
+        if not usage:
+            return
+        model = str(model or "?")
+        with self._lock:
+            # Al turno solo le chiamate del turno stesso; riassunto, video ecc. solo alla sessione
+            scopes = (self._session_totals, self._turn_totals) if source == "interactive" else (self._session_totals,)
+            for totals in scopes:
+                entry = totals["llm"].setdefault(model, {"calls": 0, **{f: 0 for f in _LLM_FIELDS}})
+                entry["calls"] += 1
+                for field in _LLM_FIELDS:
+                    entry[field] += int(usage.get(field) or 0)
+            self._write({"k": "llm", "model": model, "src": source or None,
+                         **{f: usage[f] for f in _LLM_FIELDS if usage.get(f)}})
+
+    def record_sd(self, steps: int, width: int, height: int, seconds: float) -> None:
+        mp_steps = round(steps * width * height / 1_000_000, 2)
+        with self._lock:
+            for totals in (self._session_totals, self._turn_totals):
+                totals["sd"]["images"] += 1
+                totals["sd"]["mp_steps"] += mp_steps
+                totals["sd"]["gpu_sec"] += seconds
+            self._write({"k": "sd", "steps": steps, "w": width, "h": height,
+                         "mp_steps": mp_steps, "gpu_sec": round(seconds, 2)})
+
+    def record_video(self, exec_seconds: Optional[float], wall_seconds: float, prompt_source: str = "") -> None:
+        exec_seconds = wall_seconds if exec_seconds is None else exec_seconds
+        with self._lock:
+            # I video non appartengono a un turno: vanno solo nel riepilogo della sessione
+            video = self._session_totals["video"]
+            video["jobs"] += 1
+            video["exec_sec"] += exec_seconds
+            video["wall_sec"] += wall_seconds
+            self._write({"k": "video", "exec_sec": round(exec_seconds, 2), "wall_sec": round(wall_seconds, 2),
+                         "prompt": prompt_source or None})
+
+    def record_tts(self, chars: int) -> None:
+        if chars <= 0:
+            return
+        with self._lock:
+            for totals in (self._session_totals, self._turn_totals):
+                totals["tts"]["calls"] += 1
+                totals["tts"]["chars"] += chars
+            self._write({"k": "tts", "chars": chars})
+
+    # --- scrittura / riepilogo ---
+
+    def _write(self, event: Dict[str, Any]) -> None:
+        """Una riga per evento (chiamato con il lock preso)."""
+        if not self.enabled:
+            return
+        line = {"t": round(time.time(), 1), "s": self.session, "turn": self._turn}
+        line.update((k, v) for k, v in event.items() if v is not None)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(line, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+        except OSError as e:
+            print(f"[COST] Scrittura del registro fallita: {e}")
+
+    def session_totals(self) -> Dict[str, Any]:
+        with self._lock:
+            totals = json.loads(json.dumps(self._session_totals))
+            totals["turns"] = self._turns
+            return totals
+
+    def rollup_text(self) -> str:
+        """Riepilogo della sessione su poche righe, per la GUI."""
+        totals = self.session_totals()
+        lines = []
+        for model, t in sorted(totals["llm"].items()):
+            cached = f" ({t['cached']:,} in cache)" if t["cached"] else ""
+            thoughts = f" +{t['thoughts']:,} ragion." if t["thoughts"] else ""
+            lines.append(f"{model}: {t['calls']} chiamate, {t['in']:,} in{cached}, {t['out']:,} out{thoughts}")
+        sd, video, tts = totals["sd"], totals["video"], totals["tts"]
+        if sd["images"]:
+            lines.append(f"SD: {sd['images']} immagini, {sd['mp_steps']:.0f} MP·step, {sd['gpu_sec']:.0f}s GPU")
+        if video["jobs"]:
+            lines.append(f"Video: {video['jobs']} job, {video['exec_sec']:.0f}s ComfyUI")
+        if tts["chars"]:
+            lines.append(f"TTS: {tts['chars']:,} caratteri")
+        if not lines:
+            return "Costi sessione: nessun consumo registrato."
+        turns = totals["turns"]
+        return f"Costi sessione ({turns} turni):\n" + "\n".join(lines)
+
+
+LEDGER = CostLedger()
@@ -0,0 +1,109 @@
+# file: deadline.py
+"""
+Scadenza + annullamento di un turno.
+
+Un Deadline nasce per turno (SceneWorker) e viaggia attraverso tutti gli stadi:
+LLM, Stable Diffusion, TTS. Ogni stadio:
+- usa remaining()/timeout() per i propri timeout di rete (mai oltre la scadenza);
+- controlla check()/cancelled nei punti in cui può fermarsi;
+- può registrare con on_cancel() un'azione per interrompere il lavoro remoto
+  (es. /sdapi/v1/interrupt di A1111).
+
+cancel() è thread-safe: la GUI lo chiama dal suo thread mentre il turno gira altrove.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+# Scadenza di default di un turno intero (narrazione + stato + immagine + voce)
+TURN_DEADLINE_SEC = float(os.getenv("TURN_DEADLINE_SEC", "300") or "300")
+
+
+class TurnCancelled(Exception):
+    """Il turno è stato annullato (o è scaduto): lo stadio smette di lavorare."""
+
+
+class Deadline:
+    def __init__(self, budget_sec: Optional[float] = TURN_DEADLINE_SEC) -> None:
+        self.started_at = time.monotonic()
+        self.expires_at = (self.started_at + budget_sec) if budget_sec else None
+        self.reason = ""
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    # --- stato ---
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def expired(self) -> bool:
+        return self.cancelled or (self.expires_at is not None and time.monotonic() >= self.expires_at)
+
+    def remaining(self, cap: Optional[float] = None) -> Optional[float]:
+        """Secondi rimasti (al massimo cap). None = nessun limite."""
+        if self.cancelled:
+            return 0.0
+        left = None if self.expires_at is None else max(0.0, self.expires_at - time.monotonic())
+        if cap is None:
+            return left
+        return cap if left is None else min(cap, left)
+
+    def timeout(self, default: float) -> float:
+        """Timeout da passare a una chiamata di rete; solleva se il tempo è già finito."""
+        self.check()
+        left = self.remaining(default)
+        return default if left is None else max(0.1, left)
+
+    def check(self, stage: str = "") -> None:
+        if self.expired():
+            where = f" ({stage})" if stage else ""
+            raise TurnCancelled(f"{self.reason or 'scadenza del turno superata'}{where}")
+
+    def sleep(self, seconds: float) -> bool:
+        """Attesa interrompibile. True se nel frattempo il turno è stato annullato/è scaduto."""
+        left = self.remaining(seconds)
+        self._event.wait(seconds if left is None else left)
+        return self.expired()
+
+    # --- annullamento ---
+
+    def cancel(self, reason: str = "turno annullato") -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"[TURN] Errore durante l'annullamento: {e}")
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Registra callback (chiamata subito se già annullato). Restituisce la funzione per toglierla."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def child(self) -> "Deadline":
+        """Deadline di un sotto-lavoro: stessa scadenza, annullato con questo
+        ma annullabile anche da solo (es. la richiesta strutturata quando la narrazione fallisce)."""
+        sub = Deadline(None)
+        sub.started_at = self.started_at
+        sub.expires_at = self.expires_at
+        self.on_cancel(lambda: sub.cancel(self.reason))
+        return sub
+
+    def _discard(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
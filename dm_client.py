@@ -1,11 +1,30 @@
 # file: dm_client.py
 from __future__ import annotations
 
+import asyncio
+import functools
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from llm_client import call_llm
+from campaign_chunks import CAMPAIGN_CHUNKING, Campaign, get_campaign
+from deadline import Deadline
+from dm_schema import DMResponse, dm_response_schema, struct_response_schema, validate_dm_response
+from json_stream import JsonFieldStream
+from memory_index import MEMORY
+from llm_client import (
+    call_llm,
+    call_llm_stream,
+    call_llm_stream_async,
+    count_tokens,
+    record_route_latency,
+    route_model,
+)
+from prompt_registry import REGISTRY, CompiledPrompt, estimate_tokens
+from story_summarizer import STORY_SUMMARY_BACKGROUND
 
 # ---------------------------------------------------------------------------
 # Prompt paths
@@ -22,15 +41,29 @@ STORY_PATH = Path("prompts/campaign_story.txt")
 # ---------------------------------------------------------------------------
 
 # IMPORTANT:
-# - Your engine merges `new_state` into `game_state` via `updated_state.update(new_state)` (dm_engine.py),
-#   so it is SAFE to update these fields via new_state.
+# - Your engine merges `new_state` into `game_state` via `merge_state` (dm_engine.py),
+#   so it is SAFE to update these fields via new_state (nested npc_storage/flags are merged, not replaced).
 # - recent_dialogue must NEVER be put inside new_state (GUI manages it).
-MEMORY_INSTRUCTION = (
+#
+# DM_STATE_MODE:
+# - "patch" (default): il modello emette solo i cambiamenti come 'state_patch' (JSON-Patch),
+#   applicati da state_patch.apply_state_patch -> molti meno token in uscita.
+# - "full": vecchio contratto, 'new_state' con i campi ricopiati.
+DM_STATE_MODE = os.getenv("DM_STATE_MODE", "patch").strip().lower()
+
+# Con il riassunto in background (story_summarizer.py) il DM non scrive più story_summary
+_FULL_SUMMARY_ITEM = (
+    "\n1) 'story_summary': do NOT write it: the game maintains the summary in the background."
+) if STORY_SUMMARY_BACKGROUND else (
+    "\n1) 'story_summary': Updated conceptual summary (max 200 words)."
+    "\n   - Keep it compact and persistent."
+)
+
+_FULL_STATE_INSTRUCTION = (
     "\n\n[CRITICAL MEMORY & STATE INSTRUCTION]"
     "\nIn the response JSON, inside 'new_state', you MAY update these fields when needed:"
     "\n"
-    "\n1) 'story_summary': Updated conceptual summary (max 200 words)."
-    "\n   - Keep it compact and persistent."
+    + _FULL_SUMMARY_ITEM +
     "\n"
     "\n2) 'current_outfit': The companion's CURRENT outfit description."
     "\n   - PERSISTENCE RULE: COPY the previous value unless the scene clearly changes clothing/damage."
@@ -42,35 +75,194 @@ MEMORY_INSTRUCTION = (
     "\n   - Add/remove as progress changes."
     "\n"
     "\nNEVER include 'recent_dialogue' inside 'new_state'."
+    "\n'game_state' only contains the fields relevant to this turn: fields you omit from 'new_state' are kept as they are."
+)
+
+_PATCH_STATE_INSTRUCTION = (
+    "\n\n[CRITICAL MEMORY & STATE INSTRUCTION — DELTA CONTRACT]"
+    "\nThis OVERRIDES the 'new_state' field of the JSON structure above: do NOT output 'new_state'."
+    "\nOutput 'state_patch' instead: a list of JSON-Patch operations with ONLY what changed this turn"
+    " (an empty list if nothing changed). Paths refer to 'game_state'."
+    "\nAllowed ops: add, replace, remove. Examples:"
+    '\n  {"op": "replace", "path": "/location", "value": "Empty Classroom"}'
+    '\n  {"op": "add", "path": "/quest_log/-", "value": "Short new objective"}'
+    '\n  {"op": "remove", "path": "/quest_log/0"}'
+    "\nFields you may change: location, companion_name, current_outfit, npc_memory_text,"
+    " current_act, quest_log, " + ("" if STORY_SUMMARY_BACKGROUND else "story_summary (max 200 words), ")
+    + "stage, flags."
+    "\n- NEVER copy unchanged values: a field you do not patch keeps its previous value."
+    "\n- 'current_outfit' only when clothing visibly changes; 'current_act' only on major plot progression."
+    "\n- NEVER touch 'recent_dialogue'."
+    "\n'game_state' only contains the fields relevant to this turn."
+)
+
+# Turno, oro, inventario e affinità sono calcolati dal motore (mechanics.py):
+# il modello chiede solo le variazioni, con intenti compatti.
+_MECHANICS_INSTRUCTION = (
+    "\n\n[MECHANICS — HANDLED BY THE GAME ENGINE]"
+    "\nNEVER write 'turn', 'gold', 'inventory' or 'affinity_scores' yourself: those values are ignored."
+    "\nInstead add 'intents' to the response JSON: a list of compact requests the engine applies, e.g."
+    '\n  [{"gain_item": "torch"}, {"lose_item": "rope"}, {"gold": -5}, {"affinity": {"Luna": 1, "Maria": -2}}]'
+    "\nUse an empty list when nothing changes. Affinity changes are capped at +/-10 per character per turn."
+    " The current values are in 'game_state': read them, do not rewrite them."
 )
 
+# Contratto di risposta passato al modello come response_schema (dm_schema.py)
+DM_RESPONSE_SCHEMA_ENABLED = os.getenv("DM_RESPONSE_SCHEMA", "1").strip().lower() in ("1", "true", "yes", "on")
+DM_RESPONSE_SCHEMA = dm_response_schema(DM_STATE_MODE) if DM_RESPONSE_SCHEMA_ENABLED else None
+
+# Ricordi recuperati da memory_index (presenti solo quando sono rilevanti)
+_RECALL_INSTRUCTION = (
+    "\n\n[LONG-TERM RECALL]"
+    "\n'relevant_memories', when present, lists older moments of THIS session related to the player's action"
+    " (turn, speaker, text). Use them for continuity (names, promises, places, past choices);"
+    " never repeat them verbatim and never contradict them."
+)
+
+MEMORY_INSTRUCTION = (
+    _FULL_STATE_INSTRUCTION if DM_STATE_MODE == "full" else _PATCH_STATE_INSTRUCTION
+) + _MECHANICS_INSTRUCTION + _RECALL_INSTRUCTION
+
 # ---------------------------------------------------------------------------
-# Prompt loader
+# Prompt loader (compilato una volta, ricaricato solo se i file cambiano)
 # ---------------------------------------------------------------------------
 
-def load_dm_system_prompt() -> str:
+def _compose_dm_prompt(base_prompt: Optional[str], campaign_story: Optional[str],
+                       act_number: Optional[int] = None) -> str:
     # Build the DM brain:
     # 1) Base DM prompt (Canovaccio C + JSON contract)
-    # 2) Optional campaign story (plot & secrets)
+    # 2) Optional campaign story (plot & secrets) — con CAMPAIGN_CHUNKING solo core + atto corrente/successivo
     # 3) Memory/state instruction
-    try:
-        base_prompt = DM_PROMPT_PATH.read_text(encoding="utf-8")
-    except FileNotFoundError:
+    if base_prompt is None:
         base_prompt = "You are a Dungeon Master. Respond only in valid JSON."
-
-    try:
-        campaign_story = STORY_PATH.read_text(encoding="utf-8")
-    except FileNotFoundError:
+    if campaign_story is None:
         campaign_story = "[NO SPECIFIC CAMPAIGN STORY LOADED. IMPROVISE.]"
+    elif CAMPAIGN_CHUNKING:
+        campaign_story = (
+            f"{get_campaign(campaign_story).system_text(act_number)}\n"
+            "(Other campaign sections relevant to the turn arrive in 'campaign_notes' of the input.)"
+        )
 
-    full_prompt = (
+    return (
         f"{base_prompt}\n\n"
         f"--- CAMPAIGN DATA (PLOT & SECRETS) ---\n"
         f"{campaign_story}\n"
         f"--- END CAMPAIGN DATA ---\n"
         f"{MEMORY_INSTRUCTION}"
     )
-    return full_prompt
+
+
+DM_PROMPT_ASSET = "dm_system"
+REGISTRY.register(DM_PROMPT_ASSET, sources=[DM_PROMPT_PATH, STORY_PATH], compose=_compose_dm_prompt)
+
+# Testo grezzo della campagna (per le note del turno): stesso hot reload, niente I/O a ogni turno
+CAMPAIGN_ASSET = "campaign_story"
+REGISTRY.register(CAMPAIGN_ASSET, sources=[STORY_PATH], compose=lambda story: story or "", minify=False)
+
+
+def current_campaign() -> Campaign:
+    return get_campaign(REGISTRY.get(CAMPAIGN_ASSET).text)
+
+
+def get_dm_system_prompt(game_state: Optional[Dict[str, Any]] = None) -> CompiledPrompt:
+    """Prompt di sistema compilato (testo, hash, stima token).
+
+    Con CAMPAIGN_CHUNKING c'è un asset per atto: il prompt (e la context cache)
+    cambia solo quando cambia current_act.
+    """
+    if not CAMPAIGN_CHUNKING:
+        return REGISTRY.get(DM_PROMPT_ASSET)
+    act = current_campaign().act_number((game_state or {}).get("current_act"))
+    if act is None:
+        return REGISTRY.get(DM_PROMPT_ASSET)
+    name = f"{DM_PROMPT_ASSET}:atto{act}"
+    if not REGISTRY.registered(name):
+        REGISTRY.register(name, sources=[DM_PROMPT_PATH, STORY_PATH],
+                          compose=functools.partial(_compose_dm_prompt, act_number=act))
+    return REGISTRY.get(name)
+
+
+def load_dm_system_prompt(game_state: Optional[Dict[str, Any]] = None) -> str:
+    return get_dm_system_prompt(game_state).text
+
+
+# ---------------------------------------------------------------------------
+# Proiezione dello stato: al DM va solo ciò che serve in questo turno
+# ---------------------------------------------------------------------------
+
+# Campi di game_state sempre inviati (stato "vivo" della scena)
+CORE_STATE_FIELDS = (
+    "turn", "companion_name", "location", "affinity_scores", "gold", "inventory",
+    "current_outfit", "npc_memory_text", "current_act", "quest_log",
+    "last_roll", "last_action", "last_roll_effect",
+)
+
+# Già presenti al livello superiore di dm_input: non li duplichiamo dentro game_state
+TOP_LEVEL_FIELDS = ("main_quest", "story_summary")
+
+# Campi gestiti dal motore, mai inviati al modello
+ENGINE_FIELDS = ("recent_changes", "recent_dialogue")
+
+
+def _mentioned_npcs(game_state: Dict[str, Any], player_input: str,
+                    recent_dialogue: List[Dict[str, str]]) -> List[str]:
+    storage = game_state.get("npc_storage") or {}
+    if not isinstance(storage, dict):
+        return []
+    text = " ".join([player_input or ""] + [str(d.get("text", "")) for d in recent_dialogue]).lower()
+    active = str(game_state.get("companion_name") or "")
+    # La compagna attiva è già descritta da current_outfit / npc_memory_text
+    return [name for name in storage if name != active and name.lower() in text]
+
+
+def project_game_state(
+    game_state: Dict[str, Any],
+    player_input: str,
+    recent_dialogue: List[Dict[str, str]],
+    npcs: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """Sottoinsieme di game_state rilevante per questo turno.
+
+    - campi principali (CORE_STATE_FIELDS);
+    - NPC di npc_storage nominati nell'input o nel dialogo recente;
+    - qualsiasi altro campo cambiato negli ultimi turni (recent_changes, vedi dm_engine).
+    Il resto resta nel motore: dm_engine.merge_state riunisce la risposta allo stato completo.
+    """
+    projected: Dict[str, Any] = {k: game_state[k] for k in CORE_STATE_FIELDS if k in game_state}
+
+    recently_changed = set()
+    for changed in game_state.get("recent_changes") or []:
+        if isinstance(changed, list):
+            recently_changed.update(str(k) for k in changed)
+
+    skip = set(CORE_STATE_FIELDS) | set(TOP_LEVEL_FIELDS) | set(ENGINE_FIELDS) | {"npc_storage"}
+    for key, value in game_state.items():
+        if key not in skip and key in recently_changed:
+            projected[key] = value
+
+    if npcs is None:
+        npcs = _mentioned_npcs(game_state, player_input, recent_dialogue)
+    if npcs:
+        storage = game_state["npc_storage"]
+        projected["npc_storage"] = {name: storage[name] for name in npcs}
+
+    # Log solo se la proiezione ha davvero tolto qualcosa (riassunto e campi del motore viaggiano a parte)
+    omitted = sorted(k for k in game_state if k not in projected and k not in TOP_LEVEL_FIELDS
+                     and k not in ENGINE_FIELDS and k != "npc_storage")
+    if omitted:
+        print(f"[DM] Stato proiettato: {len(projected)}/{len(game_state)} campi "
+              f"(omessi: {', '.join(omitted)}), NPC in archivio: {npcs or '—'}")
+    return projected
+
+
+def _turn_text(game_state: Dict[str, Any], recent_dialogue: List[Dict[str, str]], player_input: str) -> str:
+    """Testo con le entità del turno (per le note della campagna)."""
+    parts = [player_input or "", str(game_state.get("location") or ""), str(game_state.get("companion_name") or "")]
+    parts += [str(d.get("text", "")) for d in recent_dialogue[-2:] if isinstance(d, dict)]
+    quest_log = game_state.get("quest_log")
+    if isinstance(quest_log, list):
+        parts += [str(q) for q in quest_log]
+    return " ".join(parts)
 
 
 def build_dm_input(
@@ -80,13 +272,160 @@ def build_dm_input(
     recent_dialogue: List[Dict[str, str]],
     player_input: str,
 ) -> Dict[str, Any]:
-    return {
+    npcs = _mentioned_npcs(game_state, player_input, recent_dialogue)
+    dm_input = {
         "main_quest": main_quest,
         "story_summary": story_summary,
-        "game_state": game_state,  # includes current_outfit/current_act/quest_log
+        # includes current_outfit/current_act/quest_log (solo i campi rilevanti, vedi project_game_state)
+        "game_state": project_game_state(game_state, player_input, recent_dialogue, npcs=npcs),
         "recent_dialogue": recent_dialogue,
         "player_input": player_input,
     }
+    if CAMPAIGN_CHUNKING:
+        # Stadi di affinità di compagna e NPC in scena + sezioni che nominano le entità del turno
+        notes = current_campaign().notes_for(game_state, _turn_text(game_state, recent_dialogue, player_input),
+                                             npcs=npcs)
+        if notes:
+            dm_input["campaign_notes"] = notes
+    # Battute passate simili all'azione del giocatore (memory_index): richiamo su tutta la sessione
+    memories = MEMORY.search(player_input, exclude=(d.get("text", "") for d in recent_dialogue))
+    if memories:
+        dm_input["relevant_memories"] = memories
+        print(f"[DM] Ricordi rilevanti: {[m['turn'] for m in memories]}")
+    return dm_input
+
+
+# ---------------------------------------------------------------------------
+# Budget di token per dm_input (tetto rigido alla dimensione del prompt)
+# ---------------------------------------------------------------------------
+
+DM_INPUT_TOKEN_BUDGET = int(os.getenv("DM_INPUT_TOKEN_BUDGET", "2500") or "2500")
+
+# 1 = verifica il totale con count_tokens dell'API e calibra la stima locale
+DM_EXACT_TOKEN_COUNT = os.getenv("DM_EXACT_TOKEN_COUNT", "0").strip().lower() in ("1", "true", "yes", "on")
+
+# Rapporto token reali / stimati, aggiornato quando il conteggio esatto è attivo
+_token_calibration = 1.0
+
+
+def _tokens(value: Any) -> int:
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    return int(estimate_tokens(text) * _token_calibration + 0.5)
+
+
+def _fit_state(state: Dict[str, Any], limit: int) -> Dict[str, Any]:
+    # Prima gli NPC in archivio, poi i campi extra "recenti": i campi principali restano sempre
+    state = dict(state)
+    optional = ["npc_storage"] + [k for k in state if k not in CORE_STATE_FIELDS and k != "npc_storage"]
+    for key in optional:
+        if _tokens(state) <= limit:
+            break
+        state.pop(key, None)
+    return state
+
+
+def _fit_dialogue(dialogue: List[Dict[str, str]], limit: int) -> List[Dict[str, str]]:
+    # Teniamo le battute più recenti che entrano nel budget
+    kept: List[Dict[str, str]] = []
+    used = 0
+    for item in reversed(dialogue):
+        cost = _tokens(item)
+        if used + cost > limit:
+            break
+        kept.insert(0, item)
+        used += cost
+    return kept
+
+
+def _fit_summary(summary: str, limit: int) -> str:
+    # Tagliamo dall'inizio: la parte finale del riassunto è la più attuale
+    if _tokens(summary) <= limit:
+        return summary
+    words = summary.split()
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _tokens(" ".join(words[mid:])) <= limit:
+            hi = mid
+        else:
+            lo = mid + 1
+    return " ".join(words[lo:])
+
+
+def _fit_ranked(items: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    # Già ordinati per rilevanza/priorità: teniamo i primi che entrano
+    kept: List[Dict[str, Any]] = []
+    used = 0
+    for item in items:
+        cost = _tokens(item)
+        if used + cost > limit:
+            break
+        kept.append(item)
+        used += cost
+    return kept
+
+
+def pack_dm_input(dm_input: Dict[str, Any], budget: int = DM_INPUT_TOKEN_BUDGET) -> Dict[str, Any]:
+    """Riempie il budget per priorità:
+    input giocatore > stato > note della campagna > dialogo > ricordi > riassunto.
+
+    L'input del giocatore (e la main_quest) non vengono mai tagliati; ogni taglio viene loggato.
+    """
+    packed = dict(dm_input)
+    before = {k: _tokens(v) for k, v in dm_input.items()}
+
+    # Sezioni fisse + struttura JSON
+    fixed_keys = [k for k in packed if k not in
+                  ("game_state", "campaign_notes", "recent_dialogue", "relevant_memories", "story_summary")]
+    remaining = budget - sum(before[k] for k in fixed_keys) - 2 * len(packed)
+
+    state = packed.get("game_state") or {}
+    if isinstance(state, dict):
+        packed["game_state"] = _fit_state(state, max(remaining, 0))
+    remaining -= _tokens(packed.get("game_state") or {})
+
+    notes = packed.get("campaign_notes")
+    if isinstance(notes, list):
+        packed["campaign_notes"] = _fit_ranked(notes, max(remaining, 0))
+        if not packed["campaign_notes"]:
+            packed.pop("campaign_notes")
+        remaining -= _tokens(packed.get("campaign_notes") or [])
+
+    dialogue = packed.get("recent_dialogue") or []
+    if isinstance(dialogue, list):
+        packed["recent_dialogue"] = _fit_dialogue(dialogue, max(remaining, 0))
+    remaining -= _tokens(packed.get("recent_dialogue") or [])
+
+    memories = packed.get("relevant_memories")
+    if isinstance(memories, list):
+        packed["relevant_memories"] = _fit_ranked(memories, max(remaining, 0))
+        if not packed["relevant_memories"]:
+            packed.pop("relevant_memories")
+        remaining -= _tokens(packed.get("relevant_memories") or [])
+
+    summary = str(packed.get("story_summary") or "")
+    packed["story_summary"] = _fit_summary(summary, max(remaining, 0)) if remaining > 0 else ""
+
+    after = {k: _tokens(v) for k, v in packed.items()}
+    trimmed = {k: before[k] - after.get(k, 0) for k in before if before[k] > after.get(k, 0)}
+    total = sum(after.values())
+    if trimmed:
+        print(f"[DM] Budget {budget} token: tagliati {trimmed} (totale ~{total} token)")
+    if total > budget:
+        print(f"[DM] ATTENZIONE: input oltre budget anche dopo i tagli (~{total}/{budget}).")
+    return packed
+
+
+def _calibrate_tokens(input_str: str) -> None:
+    """Confronta la stima locale con il conteggio esatto dell'API e aggiorna il fattore."""
+    global _token_calibration
+    exact = count_tokens(input_str)
+    estimated = estimate_tokens(input_str)
+    if not exact or not estimated:
+        return
+    # Media mobile: un singolo turno anomalo non stravolge la stima
+    _token_calibration = 0.7 * _token_calibration + 0.3 * (exact / estimated)
+    print(f"[DM] Token input: {exact} esatti vs ~{estimated} stimati (calibrazione {_token_calibration:.2f})")
 
 
 def _repair_json(content: str) -> Dict[str, Any]:
@@ -113,53 +452,413 @@ def _repair_json(content: str) -> Dict[str, Any]:
         raise ValueError(f"JSON irrecuperabile: {clean[:80]}...")
 
 
-def get_dm_response(
+def _prepare_dm_request(
     main_quest: str,
     story_summary: str,
     game_state: Dict[str, Any],
     recent_dialogue: List[Dict[str, str]],
     player_input: str,
-) -> Dict[str, Any]:
-    system_prompt = load_dm_system_prompt()
-    dm_input = build_dm_input(main_quest, story_summary, game_state, recent_dialogue, player_input)
+) -> Tuple[CompiledPrompt, Dict[str, Any]]:
+    """Prompt di sistema compilato + input del turno già proiettato e impacchettato."""
+    compiled_prompt = get_dm_system_prompt(game_state)
+    dm_input = pack_dm_input(
+        build_dm_input(main_quest, story_summary, game_state, recent_dialogue, player_input)
+    )
 
     # --- DEBUG: what we send ---
     print("\n" + "─" * 60)
+    print(f"🧩 [PROMPT] system hash={compiled_prompt.hash} ~{compiled_prompt.tokens_est} token")
     print("📤 [IO] STO INVIANDO QUESTO AL MASTER:")
     print(json.dumps(dm_input, ensure_ascii=False, indent=2))
     print("─" * 60)
 
-    input_str = json.dumps(dm_input, ensure_ascii=False)
-    raw_response = call_llm(system_prompt, input_str)
+    return compiled_prompt, dm_input
 
-    final_json: Dict[str, Any] = {}
 
-    if isinstance(raw_response, dict):
-        if "reply_it" in raw_response:
-            final_json = raw_response
-        else:
-            content = raw_response.get("content")
-            if isinstance(content, str) and content.strip():
-                try:
-                    final_json = _repair_json(content)
-                except Exception:
-                    final_json = {}
-
-    if not final_json:
-        final_json = {
-            "reply_it": "Il narratore ha avuto un momento di confusione (Errore comunicazione LLM).",
-            "new_state": {},
-            "image_subject": None,
-            "visual_en": None,
-            "tags_en": [],
-            "animation_instructions_en": "",
-            "is_error": True,
-        }
+def _parse_dm_content(raw_response: Any, require_reply: bool = True) -> DMResponse:
+    """Dal dict di call_llm al JSON della risposta, validato ({} se illeggibile o senza reply_it)."""
+    if not isinstance(raw_response, dict):
+        return {}
+    if "reply_it" in raw_response:
+        parsed = raw_response
+    else:
+        content = raw_response.get("content")
+        if not (isinstance(content, str) and content.strip()):
+            return {}
+        try:
+            # Con lo schema la risposta è già JSON valido; la riparazione resta per i backend senza
+            parsed = _repair_json(content)
+        except Exception:
+            return {}
+    final_json, errors = validate_dm_response(parsed, require_reply=require_reply)
+    if errors:
+        print(f"[DM] Risposta corretta dal validatore: {'; '.join(errors)}")
+    return final_json
+
+
+def _error_response() -> Dict[str, Any]:
+    return {
+        "reply_it": "Il narratore ha avuto un momento di confusione (Errore comunicazione LLM).",
+        "new_state": {},
+        "image_subject": None,
+        "visual_en": None,
+        "tags_en": [],
+        "animation_instructions_en": "",
+        "is_error": True,
+    }
+
 
+def _remember_outcome(final_json: Dict[str, Any]) -> None:
+    global _last_response_error
+    _last_response_error = bool(final_json.get("is_error"))
+
+
+def _log_dm_output(final_json: Dict[str, Any]) -> None:
     # --- DEBUG: what we receive ---
     print("\n" + "─" * 60)
     print("📥 [MASTER] IL CERVELLO HA RISPOSTO:")
     print(json.dumps(final_json, ensure_ascii=False, indent=2))
     print("─" * 60 + "\n")
 
+
+# ---------------------------------------------------------------------------
+# Routing del modello per turno (llm_client.route_model)
+# ---------------------------------------------------------------------------
+
+# Esito dell'ultima risposta: dopo un errore il turno successivo va sul modello pro
+_last_response_error = False
+
+
+def _turn_signals(game_state: Dict[str, Any], player_input: str) -> Dict[str, Any]:
+    quest_log = game_state.get("quest_log")
+    flags = game_state.get("flags") if isinstance(game_state.get("flags"), dict) else {}
+    return {
+        "rolled": game_state.get("last_roll") is not None,
+        "input_chars": len((player_input or "").strip()),
+        # Obiettivi esauriti (o flag esplicito): il DM deve decidere il passaggio d'atto
+        "act_change_pending": (isinstance(quest_log, list) and not quest_log)
+                              or bool(flags.get("act_change_pending")),
+        "previous_error": _last_response_error,
+    }
+
+
+class _RouteTimer:
+    """Misura la latenza della chiamata (totale e primo pezzo) e la registra sul tier."""
+
+    def __init__(self, tier: str, on_chunk: Optional[Callable[[str], None]] = None) -> None:
+        self.tier = tier
+        self._on_chunk = on_chunk
+        self._start = time.monotonic()
+        self._first: Optional[float] = None
+
+    def chunk(self, text: str) -> None:
+        if self._first is None:
+            self._first = time.monotonic() - self._start
+        if self._on_chunk:
+            self._on_chunk(text)
+
+    def done(self, raw_response: Any) -> None:
+        error = not isinstance(raw_response, dict) or bool(raw_response.get("error"))
+        record_route_latency(self.tier, time.monotonic() - self._start,
+                             first_chunk=self._first, error=error)
+
+
+def get_dm_response(
+    main_quest: str,
+    story_summary: str,
+    game_state: Dict[str, Any],
+    recent_dialogue: List[Dict[str, str]],
+    player_input: str,
+    on_reply_chunk: Optional[Callable[[str], None]] = None,
+    on_field: Optional[Callable[[str, Any], None]] = None,
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    """Chiama il DM e restituisce il JSON della risposta.
+
+    Se on_reply_chunk o on_field sono passati, la chiamata va in streaming:
+    - on_reply_chunk riceve il testo di 'reply_it' man mano che il modello lo scrive;
+    - on_field riceve (chiave, valore) di ogni campo di primo livello appena è completo.
+    deadline (opzionale) limita e può annullare la chiamata.
+    """
+    compiled_prompt, dm_input = _prepare_dm_request(
+        main_quest, story_summary, game_state, recent_dialogue, player_input
+    )
+    system_prompt = compiled_prompt.text
+    tier, model = route_model(_turn_signals(game_state, player_input))
+
+    input_str = json.dumps(dm_input, ensure_ascii=False)
+    if DM_EXACT_TOKEN_COUNT:
+        _calibrate_tokens(input_str)
+    if on_reply_chunk or on_field:
+        reader = JsonFieldStream(
+            partial_keys=("reply_it",),
+            on_partial=(lambda _key, text: on_reply_chunk(text)) if on_reply_chunk else None,
+            on_field=on_field,
+        )
+        timer = _RouteTimer(tier, on_chunk=reader.feed)
+        raw_response = call_llm_stream(system_prompt, input_str, on_chunk=timer.chunk,
+                                       cache_key=compiled_prompt.hash, model=model, deadline=deadline,
+                                       response_schema=DM_RESPONSE_SCHEMA)
+    else:
+        timer = _RouteTimer(tier)
+        raw_response = call_llm(system_prompt, input_str, cache_key=compiled_prompt.hash, model=model,
+                                deadline=deadline, response_schema=DM_RESPONSE_SCHEMA)
+    timer.done(raw_response)
+    return _finish_dm_response(raw_response)
+
+
+def _finish_dm_response(raw_response: Any) -> DMResponse:
+    final_json = _parse_dm_content(raw_response) or _error_response()
+    _remember_outcome(final_json)
+    _log_dm_output(final_json)
     return final_json
+
+
+# ---------------------------------------------------------------------------
+# Split call: narrazione e contabilità come due richieste parallele
+# ---------------------------------------------------------------------------
+
+# Modello per la richiesta strutturata (stato + campi immagine): non scrive prosa,
+# quindi può essere uno più veloce. Vuoto = stesso modello della narrazione.
+DM_STRUCT_MODEL = os.getenv("DM_STRUCT_MODEL", "gemini-2.5-flash").strip() or None
+
+# Campi prodotti dalla richiesta strutturata (ordine = ordine chiesto al modello:
+# lo stato prima dei campi immagine, così il pipelining SD parte appena possibile)
+STRUCT_FIELDS = ("state_patch" if DM_STATE_MODE != "full" else "new_state", "intents",
+                 "image_subject", "tags_en", "visual_en", "animation_instructions_en")
+
+# Il contratto va nell'input del turno, NON nel prompt di sistema:
+# entrambe le richieste condividono così lo stesso prompt (e la stessa context cache).
+_NARRATION_CONTRACT = (
+    "NARRATION ONLY: write ONLY the Italian narration of this turn (what you would put in 'reply_it')"
+    " as plain text. No JSON, no code fences, no state or image fields: another request handles them."
+)
+_STRUCT_CONTRACT = (
+    "BOOKKEEPING ONLY: another request writes the narration of this turn. Output ONLY a JSON object"
+    f" with these fields, in this order: {', '.join(STRUCT_FIELDS)}."
+    " Do NOT output 'reply_it'. Decide the outcome of the player's action exactly as the narrator would"
+    " (most likely outcome given game_state, last roll and campaign rules) and describe THAT scene."
+)
+STRUCT_RESPONSE_SCHEMA = struct_response_schema(STRUCT_FIELDS) if DM_RESPONSE_SCHEMA_ENABLED else None
+
+# Worker per la richiesta strutturata (uno per processo, non uno per turno)
+_STRUCT_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="dm-struct")
+
+
+def _narration_text(raw_response: Dict[str, Any]) -> str:
+    text = (raw_response.get("content") or "").strip()
+    # Il modello a volte risponde comunque in JSON: recuperiamo reply_it
+    if text.startswith("{") or text.startswith("```"):
+        try:
+            parsed = _repair_json(text)
+            if isinstance(parsed, dict) and parsed.get("reply_it"):
+                return str(parsed["reply_it"]).strip()
+        except ValueError:
+            pass
+    return text
+
+
+def _request_struct(
+    compiled_prompt: CompiledPrompt,
+    input_str: str,
+    on_field: Optional[Callable[[str, Any], None]],
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    """Richiesta strutturata. In caso di errore tiene i campi già completi dello stream."""
+    reader = JsonFieldStream(partial_keys=(), on_field=on_field)
+    raw_response = call_llm_stream(compiled_prompt.text, input_str, on_chunk=reader.feed,
+                                   cache_key=compiled_prompt.hash, model=DM_STRUCT_MODEL, deadline=deadline,
+                                   response_schema=STRUCT_RESPONSE_SCHEMA)
+    return _struct_result(raw_response, reader)
+
+
+def _struct_result(raw_response: Dict[str, Any], reader: JsonFieldStream) -> Dict[str, Any]:
+    if raw_response.get("error"):
+        print(f"[DM] Richiesta strutturata fallita ({raw_response['error']}), "
+              f"tengo i campi completi: {sorted(reader.fields)}")
+        return _partial_struct(reader)
+    return _parse_dm_content(raw_response, require_reply=False) or _partial_struct(reader)
+
+
+def _partial_struct(reader: JsonFieldStream) -> Dict[str, Any]:
+    fields, _errors = validate_dm_response(reader.fields, require_reply=False)
+    return dict(fields, struct_error=True)
+
+
+def get_dm_response_split(
+    main_quest: str,
+    story_summary: str,
+    game_state: Dict[str, Any],
+    recent_dialogue: List[Dict[str, str]],
+    player_input: str,
+    on_reply_chunk: Optional[Callable[[str], None]] = None,
+    on_field: Optional[Callable[[str, Any], None]] = None,
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    """Come get_dm_response, ma con due richieste concorrenti:
+    la narrazione (testo semplice, in streaming) e la contabilità (JSON, modello veloce).
+
+    - narrazione fallita -> turno in errore (is_error) subito: la richiesta strutturata
+      viene annullata e i suoi campi non arrivano più a on_field;
+    - contabilità fallita -> la narrazione resta, stato invariato e niente immagine
+      (salvo i campi arrivati completi prima dell'errore).
+    on_field riceve i campi della richiesta strutturata appena completi.
+    """
+    compiled_prompt, dm_input = _prepare_dm_request(
+        main_quest, story_summary, game_state, recent_dialogue, player_input
+    )
+    narration_str, struct_str = _split_inputs(dm_input)
+    # Il routing vale per la narrazione; la contabilità usa sempre DM_STRUCT_MODEL
+    tier, model = route_model(_turn_signals(game_state, player_input))
+
+    # Deadline proprio: se la narrazione fallisce la contabilità non serve più
+    struct_deadline = deadline.child() if deadline is not None else Deadline(None)
+    struct_on_field = None
+    if on_field is not None:
+        def struct_on_field(key: str, value: Any) -> None:
+            if not struct_deadline.cancelled:
+                on_field(key, value)
+    struct_future = _STRUCT_EXECUTOR.submit(_request_struct, compiled_prompt, struct_str,
+                                            struct_on_field, struct_deadline)
+
+    timer = _RouteTimer(tier, on_chunk=on_reply_chunk)
+    try:
+        if on_reply_chunk:
+            raw_narration = call_llm_stream(compiled_prompt.text, narration_str, on_chunk=timer.chunk,
+                                            cache_key=compiled_prompt.hash, model=model,
+                                            deadline=deadline, response_mime_type="text/plain")
+        else:
+            raw_narration = call_llm(compiled_prompt.text, narration_str, cache_key=compiled_prompt.hash,
+                                     model=model, deadline=deadline, response_mime_type="text/plain")
+    except BaseException:
+        struct_deadline.cancel("narrazione fallita")
+        raise
+    timer.done(raw_narration)
+
+    if _narration_failed(raw_narration):
+        struct_deadline.cancel("narrazione fallita")
+        print("[DM] Narrazione fallita: annullo la richiesta strutturata.")
+        return _merge_split(raw_narration, {})
+
+    try:
+        struct = struct_future.result()
+    except Exception as e:
+        print(f"[DM] Richiesta strutturata in eccezione: {e}")
+        struct = {"struct_error": True}
+
+    return _merge_split(raw_narration, struct)
+
+
+def _split_inputs(dm_input: Dict[str, Any]) -> Tuple[str, str]:
+    """Input delle due richieste: stesso turno, contratto di risposta diverso."""
+    narration_str = json.dumps(dict(dm_input, response_contract=_NARRATION_CONTRACT), ensure_ascii=False)
+    struct_str = json.dumps(dict(dm_input, response_contract=_STRUCT_CONTRACT), ensure_ascii=False)
+    if DM_EXACT_TOKEN_COUNT:
+        _calibrate_tokens(narration_str)
+    return narration_str, struct_str
+
+
+def _narration_failed(raw_narration: Dict[str, Any]) -> bool:
+    return bool(raw_narration.get("error")) or not _narration_text(raw_narration)
+
+
+def _merge_split(raw_narration: Dict[str, Any], struct: Dict[str, Any]) -> Dict[str, Any]:
+    if _narration_failed(raw_narration):
+        final_json = _error_response()
+    else:
+        final_json = {k: v for k, v in struct.items() if k != "reply_it"}
+        final_json["reply_it"] = _narration_text(raw_narration)
+
+    _remember_outcome(final_json)
+    _log_dm_output(final_json)
+    return final_json
+
+
+# ---------------------------------------------------------------------------
+# Versioni asincrone (motore asyncio, vedi dm_engine.process_turn_async)
+# ---------------------------------------------------------------------------
+
+async def get_dm_response_async(
+    main_quest: str,
+    story_summary: str,
+    game_state: Dict[str, Any],
+    recent_dialogue: List[Dict[str, str]],
+    player_input: str,
+    on_reply_chunk: Optional[Callable[[str], None]] = None,
+    on_field: Optional[Callable[[str, Any], None]] = None,
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    """Come get_dm_response, sempre in streaming, senza occupare thread durante l'attesa."""
+    compiled_prompt, dm_input = _prepare_dm_request(
+        main_quest, story_summary, game_state, recent_dialogue, player_input
+    )
+    tier, model = route_model(_turn_signals(game_state, player_input))
+    input_str = json.dumps(dm_input, ensure_ascii=False)
+    if DM_EXACT_TOKEN_COUNT:
+        await asyncio.to_thread(_calibrate_tokens, input_str)
+
+    reader = JsonFieldStream(
+        partial_keys=("reply_it",),
+        on_partial=(lambda _key, text: on_reply_chunk(text)) if on_reply_chunk else None,
+        on_field=on_field,
+    )
+    timer = _RouteTimer(tier, on_chunk=reader.feed)
+    raw_response = await call_llm_stream_async(compiled_prompt.text, input_str, on_chunk=timer.chunk,
+                                               cache_key=compiled_prompt.hash, model=model, deadline=deadline,
+                                               response_schema=DM_RESPONSE_SCHEMA)
+    timer.done(raw_response)
+    return _finish_dm_response(raw_response)
+
+
+async def _request_struct_async(
+    compiled_prompt: CompiledPrompt,
+    input_str: str,
+    on_field: Optional[Callable[[str, Any], None]],
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    reader = JsonFieldStream(partial_keys=(), on_field=on_field)
+    raw_response = await call_llm_stream_async(compiled_prompt.text, input_str, on_chunk=reader.feed,
+                                               cache_key=compiled_prompt.hash, model=DM_STRUCT_MODEL,
+                                               deadline=deadline, response_schema=STRUCT_RESPONSE_SCHEMA)
+    return _struct_result(raw_response, reader)
+
+
+async def get_dm_response_split_async(
+    main_quest: str,
+    story_summary: str,
+    game_state: Dict[str, Any],
+    recent_dialogue: List[Dict[str, str]],
+    player_input: str,
+    on_reply_chunk: Optional[Callable[[str], None]] = None,
+    on_field: Optional[Callable[[str, Any], None]] = None,
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    """Come get_dm_response_split: le due richieste sono due task sullo stesso loop."""
+    compiled_prompt, dm_input = _prepare_dm_request(
+        main_quest, story_summary, game_state, recent_dialogue, player_input
+    )
+    narration_str, struct_str = _split_inputs(dm_input)
+    tier, model = route_model(_turn_signals(game_state, player_input))
+
+    struct_task = asyncio.ensure_future(_request_struct_async(compiled_prompt, struct_str, on_field, deadline))
+    timer = _RouteTimer(tier, on_chunk=on_reply_chunk)
+    try:
+        raw_narration = await call_llm_stream_async(compiled_prompt.text, narration_str, on_chunk=timer.chunk,
+                                                    cache_key=compiled_prompt.hash, model=model,
+                                                    deadline=deadline, response_mime_type="text/plain")
+    except BaseException:
+        struct_task.cancel()
+        raise
+    timer.done(raw_narration)
+
+    if _narration_failed(raw_narration):
+        struct_task.cancel()
+        print("[DM] Narrazione fallita: annullo la richiesta strutturata.")
+        return _merge_split(raw_narration, {})
+
+    try:
+        struct = await struct_task
+    except Exception as e:
+        print(f"[DM] Richiesta strutturata in eccezione: {e}")
+        struct = {"struct_error": True}
+    return _merge_split(raw_narration, struct)
@@ -1,8 +1,23 @@
 # file: dm_engine.py
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
 import copy
-from dm_client import get_dm_response
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from deadline import Deadline
+from dm_client import (
+    ENGINE_FIELDS,
+    get_dm_response,
+    get_dm_response_async,
+    get_dm_response_split,
+    get_dm_response_split_async,
+)
 from image_prompts import build_image_prompts
+from prompt_registry import estimate_tokens
+from mechanics import advance_turn, apply_intents, strip_owned_fields, strip_owned_ops
+from state_patch import apply_state_patch
 
 # Import morbido di SD
 try:
@@ -10,6 +25,28 @@ try:
 except ImportError:
     sd_client = None
 
+# Import morbido della voce (senza pygame / google TTS il turno va avanti muto)
+try:
+    import voice_narrator
+except ImportError:
+    voice_narrator = None
+
+
+# Pipeline: avvia SD appena i campi immagine arrivano dallo stream, mentre l'LLM scrive il resto
+PIPELINE_IMAGE = os.getenv("ENGINE_PIPELINE_IMAGE", "1").strip().lower() not in ("0", "false", "no", "off")
+
+# Split call: narrazione e contabilità (stato/immagine) come due richieste parallele
+# (dm_client.get_dm_response_split). La narrazione è pronta appena il modello l'ha scritta.
+SPLIT_CALL = os.getenv("DM_SPLIT_CALL", "0").strip().lower() in ("1", "true", "yes", "on")
+
+# Campi della risposta che servono al prompt builder
+IMAGE_FIELDS = ("image_subject", "tags_en", "visual_en")
+
+# Un worker per stadio in parallelo (tts, prompt, immagine, stato)
+_STAGE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="turn-stage")
+# Le attese sugli stadi sono a fette: così scadenza e annullamento si vedono subito
+_WAIT_SLICE_SEC = 0.25
+
 
 def choose_image_size(image_subject: str, visual_en: str, tags_en: List[str]) -> Tuple[int, int]:
     """Wrapper per mantenere la tua logica originale."""
@@ -18,6 +55,283 @@ def choose_image_size(image_subject: str, visual_en: str, tags_en: List[str]) ->
     return 1032, 864  # Fallback
 
 
+# Il DM vede solo una proiezione dello stato (dm_client.project_game_state):
+# per questi campi una risposta parziale va FUSA, non sostituita
+# (es. npc_storage con un solo NPC non deve cancellare gli altri).
+DEEP_MERGE_FIELDS = ("npc_storage", "flags", "affinity_scores")
+
+# Per quanti turni un campo cambiato resta "recente" (e quindi visibile al DM)
+RECENT_CHANGE_TURNS = 3
+
+
+def _deep_merge(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    merged = dict(old)
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def merge_state(game_state: Dict[str, Any], new_state: Dict[str, Any]) -> Dict[str, Any]:
+    """Applica new_state a una COPIA dello stato (l'originale resta intatto)."""
+    updated_state = copy.deepcopy(game_state)
+    if not isinstance(new_state, dict):
+        return updated_state
+
+    changed: List[str] = []
+    for key, value in copy.deepcopy(new_state).items():
+        if key in ENGINE_FIELDS:
+            continue
+        if key in DEEP_MERGE_FIELDS and isinstance(value, dict) and isinstance(updated_state.get(key), dict):
+            value = _deep_merge(updated_state[key], value)
+        if updated_state.get(key) != value:
+            changed.append(key)
+        updated_state[key] = value
+
+    history = [c for c in (game_state.get("recent_changes") or []) if isinstance(c, list)]
+    updated_state["recent_changes"] = (history + [sorted(changed)])[-RECENT_CHANGE_TURNS:]
+    return updated_state
+
+
+def _track_patch(state: Dict[str, Any], touched: List[str]) -> Dict[str, Any]:
+    # Le radici toccate dalla patch contano come cambiate in questo turno (vedi project_game_state)
+    if touched:
+        changes = state.get("recent_changes") or [[]]
+        changes[-1] = sorted(set(changes[-1]) | set(touched))
+        state["recent_changes"] = changes
+    return state
+
+
+def apply_dm_state(game_state: Dict[str, Any], dm_fields: Dict[str, Any], log: bool = True) -> Dict[str, Any]:
+    """Stato aggiornato dalla risposta del DM: 'new_state' (contratto completo)
+    e/o 'state_patch' (contratto delta, solo i percorsi cambiati), più gli 'intents'
+    delle meccaniche locali (turno, oro, inventario, affinità: vedi mechanics.py)."""
+    new_state, dropped = strip_owned_fields(dm_fields.get("new_state") or {})
+    ops, dropped_ops = strip_owned_ops(dm_fields.get("state_patch"))
+    updated_state = merge_state(game_state, new_state)
+
+    if ops:
+        patched, touched, errors = apply_state_patch(updated_state, ops)
+        updated_state = _track_patch(patched, touched)
+        if log:
+            for err in errors:
+                print(f"[ENGINE] Operazione di state_patch scartata: {err}")
+            # Metrica: token della patch contro quelli di un new_state con gli stessi campi
+            full_equivalent = {root: patched.get(root) for root in touched}
+            print(
+                f"[ENGINE] state_patch: {len(ops)} op "
+                f"(~{estimate_tokens(json.dumps(ops, ensure_ascii=False))} token) "
+                f"invece di ~{estimate_tokens(json.dumps(full_equivalent, ensure_ascii=False))} token di new_state"
+            )
+
+    # Meccaniche deterministiche: il modello chiede, il motore calcola
+    applied, intent_errors = apply_intents(updated_state, dm_fields.get("intents"))
+    advance_turn(updated_state)
+
+    if log:
+        if dropped or dropped_ops:
+            print(f"[ENGINE] Campi delle meccaniche ignorati (gestiti in locale): {dropped + dropped_ops}")
+        if applied:
+            print(f"[ENGINE] Intenti applicati: {', '.join(applied)}")
+        for err in intent_errors:
+            print(f"[ENGINE] Intento scartato: {err}")
+    return updated_state
+
+
+# ---------------------------------------------------------------------------
+# Grafo degli stadi del turno
+# ---------------------------------------------------------------------------
+
+class StageGraph:
+    """
+    Mini-DAG: ogni stadio parte appena le sue dipendenze sono completate.
+
+    - add(): stadio calcolato da una funzione fn(results) -> valore
+    - resolve(): stadio completato dall'esterno (es. la chiamata LLM)
+    Se uno stadio fallisce (o vale None) i suoi dipendenti vengono saltati.
+    on_stage(nome, valore) viene chiamato per ogni stadio completato, dal thread che lo completa.
+    Con un deadline scaduto gli stadi non ancora partiti vengono saltati e wait_all()
+    smette di aspettare: chi finisce dopo non viene più notificato.
+    """
+
+    def __init__(self, on_stage: Optional[Callable[[str, Any], None]] = None,
+                 deadline: Optional[Deadline] = None) -> None:
+        self._on_stage = on_stage
+        self._deadline = deadline
+        self._closed = False
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Tuple[Optional[Callable[[Dict[str, Any]], Any]], Tuple[str, ...]]] = {}
+        self._started: set = set()
+        self._resolved: set = set()
+        self._results: Dict[str, Any] = {}
+        self._done: Dict[str, threading.Event] = {}
+
+    def add(self, name: str, fn: Callable[[Dict[str, Any]], Any], deps: Iterable[str] = ()) -> None:
+        with self._lock:
+            self._stages[name] = (fn, tuple(deps))
+            self._done[name] = threading.Event()
+        self._schedule()
+
+    def external(self, name: str) -> None:
+        """Dichiara uno stadio che verrà completato con resolve()."""
+        with self._lock:
+            self._stages[name] = (None, ())
+            self._started.add(name)
+            self._done[name] = threading.Event()
+
+    def resolve(self, name: str, value: Any) -> bool:
+        """Completa uno stadio esterno. Restituisce False se era già completo."""
+        with self._lock:
+            if name in self._resolved:
+                return False
+            self._resolved.add(name)
+        self._complete(name, value)
+        return True
+
+    def is_done(self, name: str) -> bool:
+        return self._done[name].is_set()
+
+    def wait_all(self) -> Dict[str, Any]:
+        """Risultati di tutti gli stadi; a deadline scaduto solo quelli già completi."""
+        for name in list(self._done):
+            while not self._done[name].wait(timeout=_WAIT_SLICE_SEC):
+                if self._deadline is not None and self._deadline.expired():
+                    return self._abandon()
+        return dict(self._results)
+
+    def _abandon(self) -> Dict[str, Any]:
+        with self._lock:
+            self._closed = True
+            pending = [n for n, ev in self._done.items() if not ev.is_set()]
+            results = dict(self._results)
+        print(f"[ENGINE] {self._deadline.reason or 'Scadenza del turno'}: "
+              f"abbandono gli stadi {', '.join(pending)}; restituisco i risultati parziali.")
+        return results
+
+    def _complete(self, name: str, value: Any) -> None:
+        with self._lock:
+            self._results[name] = value
+            self._done[name].set()
+            closed = self._closed
+        if self._on_stage and value is not None and not closed:
+            try:
+                self._on_stage(name, value)
+            except Exception as e:
+                print(f"[ENGINE] Errore callback stadio '{name}': {e}")
+        self._schedule()
+
+    def _schedule(self) -> None:
+        to_run = []
+        to_skip = []
+        with self._lock:
+            for name, (fn, deps) in self._stages.items():
+                if name in self._started or fn is None:
+                    continue
+                if not all(self._done[d].is_set() for d in deps):
+                    continue
+                self._started.add(name)
+                if any(self._results.get(d) is None for d in deps):
+                    to_skip.append(name)
+                else:
+                    to_run.append((name, fn))
+
+        if to_run and self._deadline is not None and self._deadline.expired():
+            # Tempo finito: inutile avviare lavoro che nessuno aspetterà
+            to_skip.extend(name for name, _fn in to_run)
+            to_run = []
+        for name in to_skip:
+            self._complete(name, None)
+        for name, fn in to_run:
+            _STAGE_EXECUTOR.submit(self._run, name, fn)
+
+    def _run(self, name: str, fn: Callable[[Dict[str, Any]], Any]) -> None:
+        try:
+            value = fn(dict(self._results))
+        except Exception as e:
+            print(f"[ENGINE] Stadio '{name}' fallito: {e}")
+            value = None
+        self._complete(name, value)
+
+
+# ---------------------------------------------------------------------------
+# Stadi
+# ---------------------------------------------------------------------------
+
+def _image_fields_from(fields: Dict[str, Any], game_state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Input del prompt builder: campi immagine + stato aggiornato (companion/outfit)."""
+    image_subject = fields.get("image_subject")
+    if not image_subject:
+        return None
+    return {
+        "image_subject": image_subject,
+        "tags_en": fields.get("tags_en") or [],
+        "visual_en": fields.get("visual_en") or "",
+        "state": apply_dm_state(game_state, fields, log=False),
+    }
+
+
+def _stream_diverged(early: Optional[Dict[str, Any]], final: Optional[Dict[str, Any]]) -> bool:
+    """True se l'immagine avviata dallo stream non corrisponde alla risposta finale
+    (es. stream interrotto e richiesta ripetuta, oppure campi corretti dalla validazione)."""
+    if early is None:
+        return False
+    if final is None or any(early.get(k) != final.get(k) for k in IMAGE_FIELDS):
+        print("[ENGINE] Campi immagine finali diversi da quelli in streaming: scarto l'immagine anticipata.")
+        return True
+    if early["state"] != final["state"]:
+        changed = sorted(k for k in set(early["state"]) | set(final["state"])
+                         if early["state"].get(k) != final["state"].get(k))
+        print(f"[ENGINE] Stato finale diverso da quello in streaming ({', '.join(changed)}): "
+              "l'immagine anticipata resta (stessi campi immagine).")
+    return False
+
+
+def build_prompt_stage(image_fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Prompt builder (LoRA) + scelta formato."""
+    image_subject = image_fields["image_subject"]
+    tags_en = image_fields["tags_en"]
+    visual_en = image_fields["visual_en"]
+
+    # Costruisce i prompt usando la logica dei LoRA (image_prompts.py)
+    pos, neg = build_image_prompts(image_subject, tags_en, visual_en, image_fields["state"])
+
+    # Sceglie la dimensione (sd_client.py)
+    w, h = choose_image_size(image_subject, visual_en, tags_en)
+
+    return {"positive": pos, "negative": neg, "width": w, "height": h,
+            "image_subject": image_subject, "visual_en": visual_en}
+
+
+def render_image_stage(prompt: Dict[str, Any], deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """txt2img su Stable Diffusion."""
+    print(f"[ENGINE] Generazione immagine: {prompt['image_subject']} ({prompt['width']}x{prompt['height']})")
+    image_path = sd_client.generate_image_from_prompts(
+        positive_prompt=prompt["positive"],
+        negative_prompt=prompt["negative"],
+        width=prompt["width"],
+        height=prompt["height"],
+        deadline=deadline,
+    )
+    if deadline is not None and deadline.cancelled:
+        return None  # annullata mentre SD lavorava (es. risposta del DM in errore): non va mostrata
+
+    return {
+        "image_path": image_path,
+        "visual_en": prompt["visual_en"]
+    }
+
+
+def synthesize_voice_stage(dm_output: Dict[str, Any], deadline: Optional[Deadline] = None) -> Optional[str]:
+    """Sintetizza (senza riprodurre) la narrazione; la GUI la suona quando arriva."""
+    if dm_output.get("is_error"):
+        return None
+    script = dm_output.get("speech_script")
+    text = voice_narrator.script_to_text(script) if isinstance(script, list) and script else dm_output.get("reply_it", "")
+    return voice_narrator.synthesize(text, deadline=deadline)
+
+
 def process_turn(
         main_quest: str,
         story_summary: str,
@@ -25,59 +339,264 @@ def process_turn(
         recent_dialogue: List[Dict[str, str]],
         player_input: str,
         generate_image: bool = True,
+        on_reply_chunk: Optional[Callable[[str], None]] = None,
+        pipeline: bool = PIPELINE_IMAGE,
+        synthesize_voice: bool = False,
+        on_stage: Optional[Callable[[str, Any], None]] = None,
+        split_call: bool = SPLIT_CALL,
+        deadline: Optional[Deadline] = None,
 ) -> Dict[str, Any]:
-    """Ciclo completo del turno."""
+    """Ciclo completo del turno, come grafo di stadi:
 
-    # 1. Chiamata LLM
-    dm_output = get_dm_response(
-        main_quest, story_summary, game_state, recent_dialogue, player_input
-    )
+        llm ──┬── state                      (new_state / state_patch)
+              ├── tts                        (se synthesize_voice)
+              └── image_fields ── prompt ── image
+
+    on_reply_chunk (opzionale): riceve la narrazione in streaming, prima che il turno finisca.
+    pipeline: se True, 'image_fields' si completa dallo stream LLM, quindi SD parte
+              mentre il modello sta ancora scrivendo il resto.
+    on_stage (opzionale): on_stage(nome, valore) per ogni stadio completato
+              ('state', 'tts', 'image', ...), così la GUI aggiorna ogni parte appena pronta.
+    split_call: se True, narrazione e stato/campi immagine arrivano da due richieste
+              concorrenti; 'image_fields' si completa dalla richiesta strutturata.
+    deadline (opzionale): scadenza/annullamento del turno, passato a ogni stadio. Allo scadere
+              il turno restituisce quello che c'è (es. testo senza immagine).
+    """
+
+    graph = StageGraph(on_stage=on_stage, deadline=deadline)
+    graph.external("llm")
+    graph.external("image_fields")
+
+    want_image = bool(generate_image and sd_client)
+    # SD può partire prima della narrazione: se poi il DM risponde in errore, l'immagine va fermata
+    image_deadline = deadline.child() if deadline is not None else Deadline(None)
+    graph.add("state", lambda r: apply_dm_state(game_state, r["llm"]), deps=("llm",))
+    if synthesize_voice and voice_narrator:
+        graph.add("tts", lambda r: synthesize_voice_stage(r["llm"], deadline), deps=("llm",))
+    if want_image:
+        graph.add("prompt", lambda r: build_prompt_stage(r["image_fields"]), deps=("image_fields",))
+        graph.add("image", lambda r: render_image_stage(r["prompt"], image_deadline), deps=("prompt",))
+
+    streamed: Dict[str, Any] = {}
+    early: Dict[str, Any] = {}  # campi immagine usati per avviare SD dallo stream
+
+    def _on_field(key: str, value: Any) -> None:
+        streamed[key] = value
+        if graph.is_done("image_fields"):
+            return
+        has_state = "new_state" in streamed or "state_patch" in streamed
+        if all(k in streamed for k in IMAGE_FIELDS) and has_state:
+            if streamed.get("image_subject"):
+                print("[ENGINE] Campi immagine arrivati in streaming: avvio SD in anticipo.")
+            early["fields"] = _image_fields_from(streamed, game_state)
+            graph.resolve("image_fields", early["fields"])
 
-    reply_it = dm_output.get("reply_it", "")
-    new_state = dm_output.get("new_state", {})
-    image_subject = dm_output.get("image_subject")  # Può essere None se errore
-    visual_en = dm_output.get("visual_en", "")
-    tags_en = dm_output.get("tags_en", [])
+    # 1. Chiamata LLM
+    try:
+        request = get_dm_response_split if split_call else get_dm_response
+        dm_output = request(
+            main_quest, story_summary, game_state, recent_dialogue, player_input,
+            on_reply_chunk=on_reply_chunk,
+            on_field=_on_field if (pipeline and want_image) else None,
+            deadline=deadline,
+        )
+    except Exception:
+        # Chiudiamo gli stadi in attesa, così nessuno resta appeso
+        graph.resolve("image_fields", None)
+        graph.resolve("llm", None)
+        raise
 
     # Propaghiamo il flag di errore se presente
     is_error = dm_output.get("is_error", False)
+    final_fields = None if is_error else _image_fields_from(dm_output, game_state)
+    # L'immagine partita dallo stream vale solo se la risposta finale la conferma
+    drop_image = is_error or _stream_diverged(early.get("fields"), final_fields)
+    if drop_image:
+        image_deadline.cancel("risposta del DM in errore" if is_error else "campi immagine cambiati")
 
-    # 2. Update Stato
-    updated_state = copy.deepcopy(game_state)
-    updated_state.update(new_state)
-
-    # 3. Generazione Immagine
-    image_path = None
-    image_info = None
-
-    # Generiamo SOLO se c'è un subject valido (quindi non in caso di errore)
-    if generate_image and sd_client and image_subject:
-        # Costruisce i prompt usando la logica dei LoRA (image_prompts.py)
-        pos, neg = build_image_prompts(image_subject, tags_en, visual_en, updated_state)
-
-        # Sceglie la dimensione (sd_client.py)
-        w, h = choose_image_size(image_subject, visual_en, tags_en)
-
-        # Genera
-        print(f"[ENGINE] Generazione immagine: {image_subject} ({w}x{h})")
-        image_path = sd_client.generate_image_from_prompts(
-            positive_prompt=pos,
-            negative_prompt=neg,
-            width=w,
-            height=h
-        )
+    # Fallback: campi immagine presi dalla risposta completa (nessuno stream o ordine diverso)
+    graph.resolve("image_fields", final_fields)
+    graph.resolve("llm", dm_output)
 
-        image_info = {
-            "image_path": image_path,
-            "visual_en": visual_en
-        }
-    else:
-        if not image_subject:
-            print("[ENGINE] Nessun subject immagine ricevuto (o errore LLM), salto generazione.")
+    if not dm_output.get("image_subject"):
+        print("[ENGINE] Nessun subject immagine ricevuto (o errore LLM), salto generazione.")
+
+    # 2-3. Stato, voce e immagine procedono in parallelo: aspettiamo che finiscano tutti
+    #      (o che scada il turno: in quel caso arriva solo ciò che è già pronto)
+    results = graph.wait_all()
 
     return {
-        "reply_it": reply_it,
-        "game_state": updated_state,
-        "image_info": image_info,
+        "reply_it": dm_output.get("reply_it", ""),
+        "game_state": results.get("state") or copy.deepcopy(game_state),
+        "image_info": None if drop_image else results.get("image"),
+        "audio_path": results.get("tts"),
+        # Istruzioni di animazione (inglese) dell'immagine del turno: la GUI le riusa per il video
+        "animation_instructions_en": str(dm_output.get("animation_instructions_en") or ""),
         "is_error": is_error  # Passiamo il flag alla GUI
-    }
\ No newline at end of file
+    }
+
+
+# ---------------------------------------------------------------------------
+# Motore asyncio: stesso turno, tutti gli I/O su un solo loop (vedi engine_loop.py)
+# ---------------------------------------------------------------------------
+
+async def _until_deadline(tasks: List["asyncio.Future[Any]"], deadline: Optional[Deadline]) -> None:
+    """Aspetta i task; a deadline scaduto/annullato cancella quelli ancora in corso."""
+    pending = {t for t in tasks if t is not None}
+    while pending:
+        if deadline is not None and deadline.expired():
+            for task in pending:
+                task.cancel()
+            print(f"[ENGINE] {deadline.reason or 'Scadenza del turno'}: "
+                  f"cancello {len(pending)} stadi; restituisco i risultati parziali.")
+            # Lasciamo ai task il tempo di chiudersi (es. interrupt di SD)
+            await asyncio.wait(pending, timeout=_WAIT_SLICE_SEC)
+            return
+        _done, pending = await asyncio.wait(pending, timeout=_WAIT_SLICE_SEC)
+
+
+def _task_result(task: Optional["asyncio.Future[Any]"], name: str) -> Any:
+    if task is None or not task.done() or task.cancelled():
+        return None
+    if task.exception() is not None:
+        print(f"[ENGINE] Stadio '{name}' fallito: {task.exception()}")
+        return None
+    return task.result()
+
+
+async def render_image_stage_async(prompt: Dict[str, Any], deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    print(f"[ENGINE] Generazione immagine: {prompt['image_subject']} ({prompt['width']}x{prompt['height']})")
+    image_path = await sd_client.generate_image_from_prompts_async(
+        positive_prompt=prompt["positive"],
+        negative_prompt=prompt["negative"],
+        width=prompt["width"],
+        height=prompt["height"],
+        deadline=deadline,
+    )
+    return {"image_path": image_path, "visual_en": prompt["visual_en"]}
+
+
+async def synthesize_voice_stage_async(dm_output: Dict[str, Any],
+                                       deadline: Optional[Deadline] = None) -> Optional[str]:
+    if dm_output.get("is_error"):
+        return None
+    script = dm_output.get("speech_script")
+    text = voice_narrator.script_to_text(script) if isinstance(script, list) and script else dm_output.get("reply_it", "")
+    return await voice_narrator.synthesize_async(text, deadline=deadline)
+
+
+async def process_turn_async(
+        main_quest: str,
+        story_summary: str,
+        game_state: Dict[str, Any],
+        recent_dialogue: List[Dict[str, str]],
+        player_input: str,
+        generate_image: bool = True,
+        on_reply_chunk: Optional[Callable[[str], None]] = None,
+        pipeline: bool = PIPELINE_IMAGE,
+        synthesize_voice: bool = False,
+        on_stage: Optional[Callable[[str, Any], None]] = None,
+        split_call: bool = SPLIT_CALL,
+        deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
+    """Come process_turn (stessi parametri, stessi stadi, stesso risultato), ma ogni stadio
+    è un task asyncio: LLM, SD e TTS restano in volo insieme sullo stesso thread.
+
+    I callback (on_reply_chunk, on_stage) vengono chiamati dal thread del loop.
+    """
+    loop = asyncio.get_running_loop()
+    want_image = bool(generate_image and sd_client)
+    want_voice = bool(synthesize_voice and voice_narrator)
+    image_fields: "asyncio.Future[Optional[Dict[str, Any]]]" = loop.create_future()
+    streamed: Dict[str, Any] = {}
+    early: Dict[str, Any] = {}
+
+    def _emit(name: str, value: Any) -> None:
+        if on_stage is None or value is None:
+            return
+        try:
+            on_stage(name, value)
+        except Exception as e:
+            print(f"[ENGINE] Errore callback stadio '{name}': {e}")
+
+    def _resolve_image_fields(fields: Optional[Dict[str, Any]]) -> None:
+        if not image_fields.done():
+            image_fields.set_result(fields)
+            _emit("image_fields", fields)
+
+    def _on_field(key: str, value: Any) -> None:
+        streamed[key] = value
+        if image_fields.done():
+            return
+        has_state = "new_state" in streamed or "state_patch" in streamed
+        if all(k in streamed for k in IMAGE_FIELDS) and has_state:
+            if streamed.get("image_subject"):
+                print("[ENGINE] Campi immagine arrivati in streaming: avvio SD in anticipo.")
+            early["fields"] = _image_fields_from(streamed, game_state)
+            _resolve_image_fields(early["fields"])
+
+    async def _image_branch() -> Optional[Dict[str, Any]]:
+        fields = await image_fields
+        if not fields:
+            return None
+        prompt = build_prompt_stage(fields)
+        _emit("prompt", prompt)
+        info = await render_image_stage_async(prompt, deadline)
+        _emit("image", info)
+        return info
+
+    image_task = asyncio.ensure_future(_image_branch()) if want_image else None
+
+    # 1. Chiamata LLM (come task: la scadenza del turno può cancellarla)
+    request = get_dm_response_split_async if split_call else get_dm_response_async
+    llm_task = asyncio.ensure_future(request(
+        main_quest, story_summary, game_state, recent_dialogue, player_input,
+        on_reply_chunk=on_reply_chunk,
+        on_field=_on_field if (pipeline and want_image) else None,
+        deadline=deadline,
+    ))
+    await _until_deadline([llm_task], deadline)
+    try:
+        if not llm_task.done():
+            raise asyncio.CancelledError()
+        dm_output = llm_task.result()
+    except asyncio.CancelledError:
+        # Turno scaduto/annullato prima che il DM finisse
+        dm_output = {"reply_it": "Il narratore non ha risposto in tempo.", "new_state": {}, "is_error": True}
+    except Exception:
+        _resolve_image_fields(None)
+        if image_task is not None:
+            image_task.cancel()
+        raise
+
+    is_error = dm_output.get("is_error", False)
+    final_fields = None if is_error else _image_fields_from(dm_output, game_state)
+    if (is_error or _stream_diverged(early.get("fields"), final_fields)) and image_task is not None:
+        # SD può essere partito dai campi in streaming: niente immagine che la risposta finale non conferma
+        image_task.cancel()
+        image_task = None
+    _resolve_image_fields(final_fields)
+    _emit("llm", dm_output)
+
+    if not dm_output.get("image_subject"):
+        print("[ENGINE] Nessun subject immagine ricevuto (o errore LLM), salto generazione.")
+
+    # 2. Stato: locale e immediato
+    state = apply_dm_state(game_state, dm_output)
+    _emit("state", state)
+
+    # 3. Voce e immagine in volo insieme, entro la scadenza del turno
+    tts_task = None
+    if want_voice:
+        tts_task = asyncio.ensure_future(synthesize_voice_stage_async(dm_output, deadline))
+        tts_task.add_done_callback(lambda t: _emit("tts", _task_result(t, "tts")))
+    await _until_deadline([image_task, tts_task], deadline)
+
+    return {
+        "reply_it": dm_output.get("reply_it", ""),
+        "game_state": state or copy.deepcopy(game_state),
+        "image_info": _task_result(image_task, "image"),
+        "audio_path": _task_result(tts_task, "tts"),
+        "animation_instructions_en": str(dm_output.get("animation_instructions_en") or ""),
+        "is_error": is_error,
+    }
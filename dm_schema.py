@@ -0,0 +1,197 @@
+# file: dm_schema.py
+"""
+Contratto di risposta del DM: tipo (DMResponse), schema JSON e validatore.
+
+- Lo schema va al modello come response_schema (llm_client): con Gemini la
+  risposta è generata già conforme, niente più JSON da "riparare".
+- validate_dm_response() controlla e corregge ciò che arriva (anche dai backend
+  senza schema): un campo sbagliato viene scartato da solo, il resto del turno
+  resta valido. Solo 'reply_it' è obbligatorio.
+
+Il validatore è "compilato" una volta all'import: per ogni campo una funzione
+di coercizione già pronta, nessuna interpretazione dello schema a ogni turno.
+"""
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypedDict
+
+
+class DMResponse(TypedDict, total=False):
+    reply_it: str
+    new_state: Dict[str, Any]
+    state_patch: List[Dict[str, Any]]
+    intents: List[Dict[str, Any]]
+    image_subject: Optional[str]
+    tags_en: List[str]
+    visual_en: Optional[str]
+    animation_instructions_en: str
+    speech_script: List[Dict[str, str]]
+    is_error: bool
+
+
+# ---------------------------------------------------------------------------
+# Schema (sottoinsieme di JSON Schema accettato da Gemini e dai server OpenAI-compatibili)
+# ---------------------------------------------------------------------------
+
+_STRING = {"type": "string"}
+
+# L'ordine delle proprietà è l'ordine di generazione: prima la narrazione, poi lo stato,
+# poi i campi immagine (lo streaming avvia SD appena arrivano, vedi dm_engine)
+_PROPERTIES: Dict[str, Dict[str, Any]] = {
+    "reply_it": {"type": "string", "description": "Italian narration of this turn."},
+    "new_state": {"type": "object", "description": "Changed game_state fields (full state contract)."},
+    "state_patch": {
+        "type": "array",
+        "description": "JSON-Patch operations on game_state, only what changed this turn.",
+        "items": {
+            "type": "object",
+            "properties": {
+                "op": {"type": "string", "enum": ["add", "replace", "remove"]},
+                "path": _STRING,
+                "value": {},
+            },
+            "required": ["op", "path"],
+        },
+    },
+    "intents": {
+        "type": "array",
+        "description": "Mechanics requests: gain_item, lose_item, gold, affinity.",
+        "items": {"type": "object"},
+    },
+    "image_subject": {"type": "string", "description": "Who/what to draw; empty string for no image."},
+    "tags_en": {"type": "array", "items": _STRING},
+    "visual_en": _STRING,
+    "animation_instructions_en": _STRING,
+    "speech_script": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {"speaker": _STRING, "text": _STRING},
+            "required": ["text"],
+        },
+    },
+}
+
+
+def _schema(fields: Tuple[str, ...], required: Tuple[str, ...]) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": {name: _PROPERTIES[name] for name in fields},
+        "required": list(required),
+    }
+
+
+def dm_response_schema(state_mode: str = "patch") -> Dict[str, Any]:
+    """Schema della risposta completa (una sola richiesta)."""
+    state_field = "new_state" if state_mode == "full" else "state_patch"
+    return _schema(
+        ("reply_it", state_field, "intents", "image_subject", "tags_en", "visual_en",
+         "animation_instructions_en", "speech_script"),
+        required=("reply_it",),
+    )
+
+
+def struct_response_schema(fields: Tuple[str, ...]) -> Dict[str, Any]:
+    """Schema della richiesta di contabilità (split call): niente 'reply_it'."""
+    return _schema(tuple(fields), required=tuple(f for f in fields if f in ("state_patch", "new_state", "intents")))
+
+
+# ---------------------------------------------------------------------------
+# Validatore compilato
+# ---------------------------------------------------------------------------
+
+class _Invalid(Exception):
+    pass
+
+
+Coercer = Callable[[Any], Any]
+
+
+def _compile(schema: Dict[str, Any]) -> Coercer:
+    kind = schema.get("type")
+
+    if kind == "string":
+        allowed = schema.get("enum")
+
+        def coerce_string(value: Any) -> str:
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise _Invalid(f"stringa attesa, ricevuto {type(value).__name__}")
+            text = str(value).strip()
+            if allowed is not None:
+                text = text.lower()
+                if text not in allowed:
+                    raise _Invalid(f"{text!r} non è tra {allowed}")
+            return text
+        return coerce_string
+
+    if kind == "array":
+        item = _compile(schema.get("items") or {})
+
+        def coerce_array(value: Any) -> List[Any]:
+            # Un elemento singolo al posto della lista (es. "tags_en": "smile")
+            if not isinstance(value, list):
+                value = [value]
+            out = []
+            for element in value:
+                try:
+                    out.append(item(element))
+                except _Invalid:
+                    continue  # elemento scartato, la lista resta
+            return out
+        return coerce_array
+
+    if kind == "object":
+        fields = {name: _compile(sub) for name, sub in (schema.get("properties") or {}).items()}
+        required = tuple(schema.get("required") or ())
+
+        def coerce_object(value: Any) -> Dict[str, Any]:
+            if not isinstance(value, dict):
+                raise _Invalid(f"oggetto atteso, ricevuto {type(value).__name__}")
+            missing = [name for name in required if value.get(name) in (None, "")]
+            if missing:
+                raise _Invalid(f"mancano {missing}")
+            out = dict(value)
+            for name, coerce in fields.items():
+                if out.get(name) is not None:
+                    out[name] = coerce(out[name])
+            return out
+        return coerce_object
+
+    # Nessun tipo: qualsiasi valore JSON
+    return lambda value: value
+
+
+def _compile_response(schema: Dict[str, Any]) -> Dict[str, Coercer]:
+    return {name: _compile(sub) for name, sub in schema["properties"].items()}
+
+
+# Tutti i campi noti, indipendentemente dal contratto di stato in uso
+_FIELD_COERCERS = _compile_response({"properties": _PROPERTIES})
+
+
+def validate_dm_response(data: Any, require_reply: bool = True) -> Tuple[DMResponse, List[str]]:
+    """Restituisce (risposta corretta, errori). I campi non validi sono tolti, non fatali.
+
+    Con require_reply e 'reply_it' mancante/vuoto la risposta è vuota ({}): il turno è in errore.
+    """
+    if not isinstance(data, dict):
+        return DMResponse(), [f"risposta non è un oggetto JSON ({type(data).__name__})"]
+
+    errors: List[str] = []
+    out: Dict[str, Any] = {}
+    for key, value in data.items():
+        coerce = _FIELD_COERCERS.get(key)
+        if coerce is None or value is None:
+            out[key] = value
+            continue
+        try:
+            out[key] = coerce(value)
+        except _Invalid as e:
+            errors.append(f"{key}: {e}")
+
+    if out.get("image_subject") == "":
+        out["image_subject"] = None  # stringa vuota = nessuna immagine (lo schema non ammette null)
+    if require_reply and not out.get("reply_it"):
+        errors.append("reply_it mancante")
+        return DMResponse(), errors
+    return DMResponse(**out), errors
@@ -0,0 +1,65 @@
+# file: engine_loop.py
+"""
+Un unico event loop asyncio, in un thread di lunga durata, per il motore asincrono.
+
+La GUI (o uno script headless) gli passa coroutine con submit() e riceve un
+concurrent.futures.Future: niente QThread nuovo a ogni turno, e tutti gli I/O
+di un turno (LLM, SD, TTS) restano in volo insieme sullo stesso thread.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Dict, Optional
+
+from dm_engine import process_turn_async
+
+# ENGINE_ASYNC=1: la GUI usa dm_engine.process_turn_async su questo loop invece di un QThread per turno
+ENGINE_ASYNC = os.getenv("ENGINE_ASYNC", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+class EngineLoop:
+    """Avvia il loop alla prima submit() e lo tiene vivo per tutta la sessione."""
+
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or not self._loop.is_running():
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def _run() -> None:
+                    asyncio.set_event_loop(loop)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                self._thread = threading.Thread(target=_run, name="engine-loop", daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> Future:
+        """Esegue la coroutine sul loop; il Future si può aspettare da qualsiasi thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_started())
+
+    def stop(self) -> None:
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(loop.stop)
+
+
+# Loop condiviso dall'applicazione
+ENGINE_LOOP = EngineLoop()
+
+
+def run_turn(**turn_kwargs: Any) -> Dict[str, Any]:
+    """Turno completo bloccante sul loop condiviso (uso headless: script, test)."""
+    return ENGINE_LOOP.submit(process_turn_async(**turn_kwargs)).result()
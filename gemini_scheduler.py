@@ -0,0 +1,184 @@
+# file: gemini_scheduler.py
+"""
+Un solo client Gemini per il processo + scheduler delle richieste con quota.
+
+Prima turni (llm_client) e prompt video (comfy_bridge) avevano ognuno il proprio
+genai.Client e nessuno coordinava le chiamate: a raffica arrivavano i 429.
+
+- shared_client(): il client unico (creato alla prima chiamata).
+- SCHEDULER: token bucket a GEMINI_RPM richieste al minuto (default 15, piano free:
+  con una chiave a pagamento impostare GEMINI_RPM al limite del proprio piano), con priorità:
+      interactive (turno del DM) > background (riassunto) > video (prompt I2V).
+  Chi ha priorità più alta passa sempre davanti a chi aspetta, e le ultime
+  GEMINI_INTERACTIVE_RESERVE richieste del bucket restano riservate ai turni.
+  Dopo un 429 il bucket si ferma per il retry-after indicato dal server.
+"""
+from __future__ import annotations
+
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    from google import genai
+except ImportError:
+    genai = None
+
+PRIORITIES = {"interactive": 0, "background": 1, "video": 2}
+
+# Quota per minuto del progetto. Il default è prudente e tarato sul piano free
+# (10-15 RPM a seconda del modello): con una chiave a pagamento (piano Tier 1: 150+ RPM)
+# va alzato, altrimenti lo scheduler rallenta turni che Gemini accetterebbe subito.
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "15") or "15")
+# Richieste che possono partire a raffica (capienza del bucket)
+GEMINI_BURST = float(os.getenv("GEMINI_BURST", "4") or "4")
+# Gettoni che background/video non possono usare: restano per il turno
+GEMINI_INTERACTIVE_RESERVE = float(os.getenv("GEMINI_INTERACTIVE_RESERVE", "1") or "1")
+# Pausa dopo un 429 senza retry-after
+GEMINI_DEFAULT_RETRY_AFTER_SEC = float(os.getenv("GEMINI_DEFAULT_RETRY_AFTER_SEC", "10") or "10")
+
+_RETRY_DELAY_RE = re.compile(r"retry[_ -]?(?:delay|after)['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)\s*s?", re.IGNORECASE)
+
+
+class QuotaWaitTimeout(TimeoutError):
+    """Nessun gettone libero entro il tempo concesso alla richiesta."""
+
+
+def is_rate_limited(err: Exception) -> bool:
+    code = getattr(err, "code", None) or getattr(getattr(err, "response", None), "status_code", None)
+    msg = str(err).lower()
+    return code == 429 or "429" in msg or "resource_exhausted" in msg or "resource exhausted" in msg
+
+
+def retry_after_seconds(err: Exception) -> Optional[float]:
+    """Retry-after dal 429: header HTTP o RetryInfo.retryDelay nel corpo dell'errore."""
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        if value:
+            return float(value)
+    except (TypeError, ValueError, AttributeError):
+        pass
+    match = _RETRY_DELAY_RE.search(str(getattr(err, "details", "") or "") + " " + str(err))
+    return float(match.group(1)) if match else None
+
+
+class GeminiScheduler:
+    def __init__(self, rpm: float = GEMINI_RPM, burst: float = GEMINI_BURST,
+                 reserve: float = GEMINI_INTERACTIVE_RESERVE) -> None:
+        self.rate = max(rpm, 0.1) / 60.0  # gettoni al secondo
+        self.capacity = max(burst, 1.0)
+        self.reserve = min(max(reserve, 0.0), self.capacity - 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+        self._waiters: List[Tuple[int, int]] = []  # heap (priorità, ordine di arrivo)
+        self._seq = itertools.count()
+        self._stats: Dict[str, Dict[str, float]] = {
+            name: {"granted": 0, "timeouts": 0, "waited_sec": 0.0} for name in PRIORITIES}
+        self._rate_limited = 0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait_needed(self, level: int, now: float) -> float:
+        """0 se può partire adesso, altrimenti i secondi da aspettare (stima)."""
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        floor = 0.0 if level == PRIORITIES["interactive"] else self.reserve
+        missing = (floor + 1.0) - self._tokens
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def acquire(self, priority: str = "interactive", timeout: Optional[float] = None,
+                cancelled: Optional[Callable[[], bool]] = None) -> bool:
+        """Attende un gettone. False se scade timeout o cancelled() diventa vero."""
+        level = PRIORITIES.get(priority, PRIORITIES["background"])
+        start = time.monotonic()
+        until = None if timeout is None else start + timeout
+        with self._cond:
+            ticket = (level, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._wait_needed(level, now)
+                    # Solo il primo in coda (priorità più alta, poi il più vecchio) può prendere il gettone
+                    if self._waiters[0] == ticket and wait <= 0:
+                        self._tokens -= 1.0
+                        stats = self._stats[priority if priority in PRIORITIES else "background"]
+                        stats["granted"] += 1
+                        stats["waited_sec"] += now - start
+                        if now - start > 0.5:
+                            print(f"[QUOTA] Richiesta {priority} partita dopo {now - start:.1f}s di attesa.")
+                        return True
+                    if (until is not None and now >= until) or (cancelled is not None and cancelled()):
+                        self._stats[priority if priority in PRIORITIES else "background"]["timeouts"] += 1
+                        return False
+                    step = 0.25 if wait <= 0 else min(wait, 0.25)
+                    if until is not None:
+                        step = min(step, max(until - now, 0.0))
+                    self._cond.wait(step)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def penalize(self, err: Exception) -> float:
+        """Dopo un 429: ferma tutte le richieste per il retry-after del server."""
+        delay = retry_after_seconds(err) or GEMINI_DEFAULT_RETRY_AFTER_SEC
+        with self._cond:
+            self._rate_limited += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._tokens = 0.0
+            self._cond.notify_all()
+        print(f"[QUOTA] 429 da Gemini: pausa di {delay:.1f}s per tutte le richieste.")
+        return delay
+
+    def run(self, call: Callable[[], Any], priority: str = "interactive", timeout: Optional[float] = None,
+            cancelled: Optional[Callable[[], bool]] = None) -> Any:
+        """acquire + call(); un 429 ferma il bucket e l'errore risale al chiamante."""
+        if not self.acquire(priority, timeout=timeout, cancelled=cancelled):
+            raise QuotaWaitTimeout(f"quota Gemini: nessuno slot libero per la richiesta {priority}")
+        try:
+            return call()
+        except Exception as e:
+            if is_rate_limited(e):
+                self.penalize(e)
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                "tokens": round(self._tokens, 2),
+                "blocked_sec": round(max(0.0, self._blocked_until - time.monotonic()), 1),
+                "rate_limited": self._rate_limited,
+                "waiting": len(self._waiters),
+                "by_priority": {k: dict(v) for k, v in self._stats.items()},
+            }
+
+
+SCHEDULER = GeminiScheduler()
+
+_client: Any = None
+_client_lock = threading.Lock()
+
+
+def shared_client(api_key: Optional[str] = None) -> Any:
+    """Il genai.Client del processo (None se google-genai o la chiave mancano)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            key = api_key if api_key is not None else os.getenv("GEMINI_API_KEY", "")
+            if genai is None or not key:
+                return None
+            _client = genai.Client(api_key=key)
+        return _client
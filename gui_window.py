@@ -25,10 +25,20 @@ from dice_widget import DiceRollDialog
 # Moduli GUI rifattorizzati
 from gui_components import ClickableLabel, ImagePreviewDialog, CompanionSelectionDialog
 from gui_worker import SceneWorker
+from engine_loop import ENGINE_ASYNC
+from memory_index import MEMORY, memory_path_for
+from story_summarizer import SUMMARIZER
+from cost_ledger import LEDGER
 
 # Ponte ComfyUI
 import comfy_bridge
 
+# Battute tenute in memoria per il DM: il taglio vero lo fa il budget di token (dm_client.pack_dm_input)
+RECENT_DIALOGUE_KEEP = int(os.getenv("RECENT_DIALOGUE_KEEP", "12") or "12")
+
+# Alla chiusura, attesa massima (ms) perché un turno annullato si fermi
+SCENE_CANCEL_GRACE_MS = 3000
+
 
 # --- NUOVO WORKER PER IL VIDEO (Background Thread) ---
 class VideoWorker(QThread):
@@ -38,11 +48,12 @@ class VideoWorker(QThread):
     finished = Signal(str)  # Emette il percorso del video finale
     error = Signal(str)  # Emette messaggio di errore
 
-    def __init__(self, image_path: str, context_text: str, output_path: str):
+    def __init__(self, image_path: str, context_text: str, output_path: str, prompt_en: Optional[str] = None):
         super().__init__()
         self.image_path = image_path
         self.context_text = context_text
         self.output_path = output_path
+        self.prompt_en = prompt_en
 
     def run(self):
         try:
@@ -50,7 +61,8 @@ class VideoWorker(QThread):
             final_video = comfy_bridge.generate_video_from_image(
                 image_path=self.image_path,
                 text_context=self.context_text,
-                output_path=self.output_path
+                output_path=self.output_path,
+                prompt_en=self.prompt_en,
             )
 
             if final_video and os.path.exists(final_video):
@@ -93,6 +105,8 @@ class GameWindow(QMainWindow):
         self.recent_dialogue: List[Dict[str, str]] = []
         self._image_history: List[str] = []
         self._image_index: int = -1
+        # Per immagine: animation_instructions_en del DM (prompt video già in inglese)
+        self._image_animations: Dict[str, str] = {}
         self._saves_dir = Path("storage/saves")
         self._saves_dir.mkdir(parents=True, exist_ok=True)
 
@@ -101,9 +115,17 @@ class GameWindow(QMainWindow):
         # Threading Scene
         self._scene_thread: Optional[QThread] = None
         self._scene_worker: Optional[SceneWorker] = None
+        self._streamed_reply: str = ""  # narrazione già mostrata in streaming nel turno corrente
+        self._scene_failed: bool = False  # turno corrente scartato (errore LLM)
+        # Durante l'animazione del dado il DM lavora già: i suoi risultati restano in attesa qui
+        self._dice_rolling: bool = False
+        self._held_scene_events: List[tuple] = []
+        # Turni annullati ancora in chiusura (thread, worker): riferimenti tenuti finché il thread esce
+        self._abandoned_scenes: List[tuple] = []
 
         # Threading Video
         self._video_thread: Optional[VideoWorker] = None
+        self._video_auto: bool = False  # video partito da solo (Video automatico): niente lettore né popup
 
         # Voce
         voice_narrator.init_narrator()
@@ -180,6 +202,12 @@ class GameWindow(QMainWindow):
         self.status_label.setStyleSheet("color: #555; font-size: 12pt;")
         left_layout.addWidget(self.status_label)
 
+        # Riepilogo dei consumi della sessione (cost_ledger)
+        self.cost_label = QLabel(LEDGER.rollup_text())
+        self.cost_label.setStyleSheet("color: #777; font-size: 9pt;")
+        self.cost_label.setWordWrap(True)
+        left_layout.addWidget(self.cost_label)
+
         # Pulsanti gestione
         save_load_layout = QHBoxLayout()
         self.save_button = QPushButton("Salva")
@@ -195,6 +223,18 @@ class GameWindow(QMainWindow):
         self.video_button.clicked.connect(self._on_generate_video_clicked)
         left_layout.addWidget(self.video_button)
 
+        # Video con un clic: usa le istruzioni di animazione del DM, senza dialogo né traduzione
+        video_quick_layout = QHBoxLayout()
+        self.quick_video_button = QPushButton("Video dalla scena")
+        self.quick_video_button.setToolTip("Anima l'immagine con le istruzioni di animazione scritte dal DM.")
+        self.quick_video_button.clicked.connect(self._on_quick_video_clicked)
+        video_quick_layout.addWidget(self.quick_video_button)
+        self.auto_video_checkbox = QCheckBox("Video automatico")
+        self.auto_video_checkbox.setToolTip("Genera il video di ogni nuova immagine appena la scena è pronta.")
+        video_quick_layout.addWidget(self.auto_video_checkbox)
+        left_layout.addLayout(video_quick_layout)
+        self.quick_video_button.setEnabled(False)
+
         # === COLONNA DESTRA ===
         right_layout = QVBoxLayout()
         right_layout.setSpacing(12)
@@ -281,6 +321,16 @@ class GameWindow(QMainWindow):
         self.story_edit.append(text)
         self.story_edit.moveCursor(QTextCursor.End)
 
+    def _append_story_chunk(self, text: str) -> None:
+        """Accoda testo in streaming senza andare a capo (la narrazione cresce parola per parola)."""
+        if not text: return
+        self.story_edit.moveCursor(QTextCursor.End)
+        self.story_edit.insertPlainText(text)
+        self.story_edit.moveCursor(QTextCursor.End)
+
+    def _scene_header(self, turn: int) -> str:
+        return "--- INIZIO AVVENTURA ---" if turn <= 1 else f"--- SCENA {turn} ---"
+
     def _show_image(self, img_path: Optional[str]) -> None:
         self._last_image_path = img_path
         if not img_path or not Path(img_path).is_file():
@@ -314,6 +364,11 @@ class GameWindow(QMainWindow):
         has_history = len(self._image_history) > 0
         self.prev_image_button.setEnabled(has_history and self._image_index > 0)
         self.next_image_button.setEnabled(has_history and self._image_index < len(self._image_history) - 1)
+        # Stesse condizioni del bottone video (niente turno né video in corso) + istruzioni disponibili
+        self.quick_video_button.setEnabled(self.video_button.isEnabled() and bool(self._current_animation()))
+
+    def _current_animation(self) -> str:
+        return self._image_animations.get(self._last_image_path or "", "")
 
     def _on_prev_image(self):
         if self._image_index > 0:
@@ -337,77 +392,140 @@ class GameWindow(QMainWindow):
 
     # --- WORKER MANAGEMENT ---
     def _request_scene(self) -> None:
-        if self._scene_thread is not None: return
+        if self._scene_worker is not None: return
+
+        # Riassunto pronto in background: entra nello stato prima della chiamata al DM
+        if SUMMARIZER.apply_pending(self.game_state):
+            self._update_state_panel()
 
         self.status_label.setText("Il narratore sta pensando...")
         self._toggle_controls(False)
+        self._streamed_reply = ""
+        self._scene_failed = False
 
-        self._scene_thread = QThread(self)
-        self._scene_worker = SceneWorker(self.game_state, self.last_action, self.recent_dialogue)
-        self._scene_worker.moveToThread(self._scene_thread)
-
-        self._scene_thread.started.connect(self._scene_worker.run)
+        self._scene_worker = SceneWorker(
+            self.game_state, self.last_action, self.recent_dialogue,
+            synthesize_voice=self.voice_checkbox.isChecked(),
+        )
+        self._scene_worker.partial.connect(self._on_scene_partial)
+        self._scene_worker.state_ready.connect(self._on_scene_state_ready)
+        self._scene_worker.audio_ready.connect(self._on_scene_audio_ready)
+        self._scene_worker.image_ready.connect(self._on_scene_image_ready)
         self._scene_worker.finished.connect(self._on_scene_ready)
         self._scene_worker.error.connect(self._on_scene_error)
-        self._scene_worker.finished.connect(self._cleanup_scene_thread)
-        self._scene_worker.error.connect(lambda e: self._cleanup_scene_thread())
 
+        if ENGINE_ASYNC:
+            # Il turno gira sul loop asyncio condiviso: nessun QThread da creare
+            self._scene_worker.start_async()
+            return
+
+        self._scene_thread = QThread(self)
+        self._scene_worker.moveToThread(self._scene_thread)
+        self._scene_thread.started.connect(self._scene_worker.run)
         self._scene_thread.start()
 
-    def _on_scene_ready(self, reply_it: str, updated_state: dict, visual_en: str, full_data: dict):
-        # 1. CONTROLLO ERRORI
-        is_error = full_data.get("is_error", False)
+    def _hold_while_rolling(self, handler, *args) -> bool:
+        """Se il dado sta ancora rotolando, accoda l'evento del worker e restituisce True."""
+        if not self._dice_rolling:
+            return False
+        self._held_scene_events.append((handler, args))
+        return True
+
+    def _release_held_scene_events(self) -> None:
+        self._dice_rolling = False
+        held, self._held_scene_events = self._held_scene_events, []
+        for handler, args in held:
+            handler(*args)
+
+    def _on_scene_partial(self, chunk: str):
+        if self._hold_while_rolling(self._on_scene_partial, chunk): return
+        # Primo pezzo: intestazione della scena, poi il testo scorre man mano che arriva
+        if not self._streamed_reply:
+            current_turn = int(self.game_state.get("turn", 1))
+            self._append_story(f"\n{self._scene_header(current_turn)}\n")
+            self.status_label.setText("Il narratore sta raccontando...")
+        self._streamed_reply += chunk
+        self._append_story_chunk(chunk)
+
+    def _on_scene_state_ready(self, reply_it: str, updated_state: dict, is_error: bool):
+        if self._hold_while_rolling(self._on_scene_state_ready, reply_it, updated_state, is_error): return
 
+        # 1. CONTROLLO ERRORI
         if is_error:
+            self._scene_failed = True
             self.status_label.setText("Errore LLM: Storia non aggiornata.")
+            if self._streamed_reply:
+                self._append_story("[risposta interrotta]")
             self._append_story(f"\n[SISTEMA]: {reply_it}\n(Questa risposta non è stata salvata. Riprova.)\n")
-            self._cleanup_scene_thread()
             return
 
+        # Numero della scena appena giocata (il motore avanza 'turn' a fine turno, vedi mechanics.py)
+        current_turn = int(self.game_state.get("turn", 1))
+
         # 2. AGGIORNAMENTO DI STATO
         self.game_state = updated_state
 
-        # Fallback se l'IA dimentica il riassunto
+        # Fallback finché il riassunto in background (story_summarizer) non è ancora pronto
         if "story_summary" not in self.game_state or not self.game_state["story_summary"]:
             update_story_summary(self.game_state, reply_it, max_words=120)
 
-        current_turn = int(self.game_state.get("turn", 1))
-        header = "--- INIZIO AVVENTURA ---" if current_turn <= 1 else f"--- SCENA {current_turn} ---"
-
-        # Aggiorna Storia a video
-        self._append_story(f"\n{header}\n{reply_it}\n")
+        # Aggiorna Storia a video (se è già arrivata in streaming chiudiamo solo il paragrafo)
+        if self._streamed_reply:
+            self._append_story_chunk("\n")
+        else:
+            self._append_story(f"\n{self._scene_header(current_turn)}\n{reply_it}\n")
 
         self.recent_dialogue.append({"speaker": "DM", "text": reply_it})
-        self.recent_dialogue = self.recent_dialogue[-3:]
+        self.recent_dialogue = self.recent_dialogue[-RECENT_DIALOGUE_KEEP:]
+        MEMORY.add(current_turn, "DM", reply_it)
+        # Compattazione della memoria ogni N turni, in parallelo al resto della scena
+        SUMMARIZER.maybe_schedule(self.game_state, self.recent_dialogue)
 
-        # AUDIO
-        if self.voice_checkbox.isChecked():
-            voice_narrator.stop()
-            if isinstance(full_data, dict) and "speech_script" in full_data and full_data["speech_script"]:
-                voice_narrator.speak_script(full_data["speech_script"])
-            else:
-                voice_narrator.speak(reply_it)
-
-        # IMMAGINE
-        img_path_str = None
-        if isinstance(full_data, dict) and "image_info" in full_data:
-            info = full_data["image_info"]
-            if isinstance(info, dict):
-                img_path_str = info.get("image_path")
+        self.last_action = None
+        self._update_state_panel()
+        self.status_label.setText("Il narratore sta preparando la scena...")
 
-        if not img_path_str and isinstance(full_data, str) and os.path.isfile(full_data):
-            img_path_str = full_data
+    def _on_scene_audio_ready(self, audio_path: str):
+        if self._hold_while_rolling(self._on_scene_audio_ready, audio_path): return
+        # L'audio arriva appena sintetizzato, senza aspettare l'immagine
+        if self._scene_failed or not self.voice_checkbox.isChecked():
+            voice_narrator.discard_file(audio_path)
+            return
+        voice_narrator.stop()
+        voice_narrator.play_file(audio_path)
 
+    def _on_scene_image_ready(self, image_info: dict):
+        if self._hold_while_rolling(self._on_scene_image_ready, image_info): return
+        img_path_str = image_info.get("image_path")
         if img_path_str and os.path.exists(img_path_str):
             self._register_new_image(img_path_str)
             self.status_label.setText("Immagine generata.")
 
-        self.last_action = None
-        self._update_state_panel()
+    def _on_scene_ready(self, reply_it: str, updated_state: dict, visual_en: str, full_data: dict):
+        if self._hold_while_rolling(self._on_scene_ready, reply_it, updated_state, visual_en, full_data): return
+
+        # Tutti gli stadi sono chiusi: stato, audio e immagine sono già stati mostrati man mano
+        info = full_data.get("image_info") if isinstance(full_data, dict) else None
+        image_path = info.get("image_path") if isinstance(info, dict) else None
+        if not self._scene_failed and not image_path:
+            self.status_label.setText("Scena pronta (nessuna immagine).")
+        self._cleanup_scene_thread()
+        self.cost_label.setText(LEDGER.rollup_text())
+
+        animation = str(full_data.get("animation_instructions_en") or "").strip() if isinstance(full_data, dict) else ""
+        if self._scene_failed or not image_path or not animation:
+            return
+        self._image_animations[image_path] = animation
+        self._update_image_buttons()
+        if self.auto_video_checkbox.isChecked() and self._video_thread is None:
+            self._start_video(image_path, animation, prompt_en=animation, auto=True)
 
     def _on_scene_error(self, message: str):
+        if self._hold_while_rolling(self._on_scene_error, message): return
+
         self.status_label.setText(f"ERRORE: {message}")
         self._append_story(f"\n[ERRORE TECNICO] {message}\n")
+        self._cleanup_scene_thread()
 
     def _cleanup_scene_thread(self):
         if self._scene_thread:
@@ -417,6 +535,34 @@ class GameWindow(QMainWindow):
         self._scene_worker = None
         self._toggle_controls(True)
 
+    def _cancel_scene_thread(self, reason: str) -> None:
+        """Annulla il turno in corso SENZA bloccare la GUI: il thread si chiude da solo."""
+        thread, worker = self._scene_thread, self._scene_worker
+        if worker is None:
+            return
+        worker.cancel(reason)
+        # Niente più risultati dal turno annullato
+        for signal in (worker.partial, worker.state_ready, worker.audio_ready,
+                       worker.image_ready, worker.finished, worker.error):
+            try:
+                signal.disconnect()
+            except (RuntimeError, TypeError):
+                pass
+        if thread is not None:
+            self._abandoned_scenes.append((thread, worker))
+            thread.finished.connect(lambda: self._forget_abandoned_scene(thread))
+            # quit() non interrompe run(): il loop del thread esce appena run() ritorna
+            thread.quit()
+
+        self._scene_thread = None
+        self._scene_worker = None
+        self._dice_rolling = False
+        self._held_scene_events = []
+        self._toggle_controls(True)
+
+    def _forget_abandoned_scene(self, thread: QThread) -> None:
+        self._abandoned_scenes = [(t, w) for t, w in self._abandoned_scenes if t is not thread]
+
     def _toggle_controls(self, enabled: bool):
         self.send_button.setEnabled(enabled)
         self.action_input.setEnabled(enabled)
@@ -425,6 +571,7 @@ class GameWindow(QMainWindow):
         # Il video button è gestito separatamente durante la sua esecuzione
         if not self._video_thread:
             self.video_button.setEnabled(enabled)
+            self._update_image_buttons()
         self.dice_checkbox.setEnabled(enabled)
 
     # --- AZIONI UTENTE ---
@@ -437,16 +584,30 @@ class GameWindow(QMainWindow):
         self.action_input.clear()
 
         self.recent_dialogue.append({"speaker": "Tu", "text": text})
-        self.recent_dialogue = self.recent_dialogue[-4:]
+        self.recent_dialogue = self.recent_dialogue[-RECENT_DIALOGUE_KEEP:]
+        MEMORY.add(self.game_state.get("turn", 1), "Tu", text)
         self.last_action = text
 
         if self.dice_checkbox.isChecked():
             roll_val = roll_d20()
             self.roll_label.setText(f"Lancio in corso...")
             self.dice_checkbox.setChecked(False)
+
+            # Il tiro è già deciso: il DM parte subito e lavora mentre il dado rotola.
+            # I risultati restano in attesa finché l'animazione non emette 'rolled'.
+            update_game_state_after_roll(self.game_state, self.last_action or "", roll_val)
+            self._dice_rolling = True
+            self._held_scene_events = []
+            self._request_scene()
+
             self._dice_dialog = DiceRollDialog(target_value=roll_val, parent=self)
             self._dice_dialog.rolled.connect(lambda res: self._on_dice_finished(res, roll_val))
             self._dice_dialog.exec()
+            # Dialogo chiuso (anche con Esc, senza 'rolled'): gli eventi del turno non restano bloccati
+            if self.roll_label.text() == "Lancio in corso...":
+                self.roll_label.setText(f"Risultato D20: {roll_val}")
+                self._update_state_panel()
+            self._release_held_scene_events()
         else:
             self.game_state["last_roll"] = None
             self.roll_label.setText("Azione narrativa (No Dado).")
@@ -454,11 +615,8 @@ class GameWindow(QMainWindow):
             self._request_scene()
 
     def _on_dice_finished(self, final: int, logical: int):
-        self.game_state["last_roll"] = logical
         self.roll_label.setText(f"Risultato D20: {logical}")
-        update_game_state_after_roll(self.game_state, self.last_action or "", logical)
         self._update_state_panel()
-        self._request_scene()
 
     # --- SALVATAGGIO ---
     def _on_save_game(self):
@@ -466,6 +624,7 @@ class GameWindow(QMainWindow):
         filename, _ = QFileDialog.getSaveFileName(self, "Salva", str(default_path), "JSON (*.json)")
         if not filename: return
 
+        SUMMARIZER.apply_pending(self.game_state)
         data = {
             "game_state": self.game_state,
             "recent_dialogue": self.recent_dialogue,
@@ -473,11 +632,14 @@ class GameWindow(QMainWindow):
             "story_text": self.story_edit.toPlainText(),
             "last_image_path": self._last_image_path,
             "image_history": self._image_history,
-            "image_index": self._image_index
+            "image_index": self._image_index,
+            "image_animations": self._image_animations,
         }
         try:
             with open(filename, "w", encoding="utf-8") as f:
                 json.dump(data, f, ensure_ascii=False, indent=2)
+            # Memoria dei turni passati accanto al salvataggio
+            MEMORY.save(memory_path_for(filename))
             self.status_label.setText("Sessione salvata.")
         except Exception as e:
             QMessageBox.critical(self, "Errore", str(e))
@@ -487,17 +649,22 @@ class GameWindow(QMainWindow):
         if filename: self._load_session_from_path(filename)
 
     def _load_session_from_path(self, filename: str):
-        self._cleanup_scene_thread()
+        self._cancel_scene_thread("sessione caricata")
         voice_narrator.stop()
         try:
             with open(filename, "r", encoding="utf-8") as f:
                 data = json.load(f)
             self.game_state = data.get("game_state", {})
+            SUMMARIZER.reset()
+            MEMORY.load(memory_path_for(filename))
+            LEDGER.new_session()
+            self.cost_label.setText(LEDGER.rollup_text())
             self.recent_dialogue = data.get("recent_dialogue", [])
             self.last_action = data.get("last_action")
             self._last_image_path = data.get("last_image_path")
             self._image_history = data.get("image_history", [])
             self._image_index = data.get("image_index", -1)
+            self._image_animations = data.get("image_animations", {})
             self.story_edit.setPlainText(data.get("story_text", ""))
 
             self._update_state_panel()
@@ -526,10 +693,18 @@ class GameWindow(QMainWindow):
             default_context
         )
         if not ok: return
-        context_text = user_input.strip()
+        self._start_video(self._last_image_path, user_input.strip())
+
+    def _on_quick_video_clicked(self):
+        animation = self._current_animation()
+        if not self._last_image_path or not os.path.exists(self._last_image_path) or not animation:
+            QMessageBox.warning(self, "Attenzione", "Nessuna istruzione di animazione per questa immagine.")
+            return
+        self._start_video(self._last_image_path, animation, prompt_en=animation)
 
+    def _start_video(self, image_path: str, context_text: str, prompt_en: Optional[str] = None, auto: bool = False):
         # 3. Setup Percorso
-        image_stem = Path(self._last_image_path).stem
+        image_stem = Path(image_path).stem
         expected_video_path = Path("storage/videos") / f"{image_stem}_comfy.mp4"
 
         # Rimuove vecchio file
@@ -542,9 +717,11 @@ class GameWindow(QMainWindow):
         # 4. AVVIO THREAD
         self.status_label.setText("ComfyUI in background... La finestra rimane attiva.")
         self.video_button.setEnabled(False)
+        self.quick_video_button.setEnabled(False)
         self.video_button.setText("Video in lavorazione...")
 
-        self._video_thread = VideoWorker(self._last_image_path, context_text, str(expected_video_path))
+        self._video_auto = auto
+        self._video_thread = VideoWorker(image_path, context_text, str(expected_video_path), prompt_en=prompt_en)
         self._video_thread.finished.connect(self._on_video_finished)
         self._video_thread.error.connect(self._on_video_error)
         self._video_thread.start()
@@ -554,6 +731,8 @@ class GameWindow(QMainWindow):
         self._video_thread = None
         self.video_button.setEnabled(True)
         self.video_button.setText("Genera Video (ComfyUI)")
+        self._update_image_buttons()
+        self.cost_label.setText(LEDGER.rollup_text())
 
         # Normalizza percorso (importante su Windows)
         try:
@@ -561,6 +740,10 @@ class GameWindow(QMainWindow):
         except Exception:
             pass
 
+        if self._video_auto:
+            self.status_label.setText(f"Video automatico pronto: {Path(path_str).name}")
+            return
+
         self.status_label.setText("Video creato! Apro il lettore...")
 
         # 1) Tentativo standard Qt (usa il player predefinito)
@@ -597,7 +780,12 @@ class GameWindow(QMainWindow):
         self._video_thread = None
         self.video_button.setEnabled(True)
         self.video_button.setText("Genera Video (ComfyUI)")
+        self._update_image_buttons()
+        self.cost_label.setText(LEDGER.rollup_text())
         self.status_label.setText("Errore video.")
+        if self._video_auto:
+            print(f"[VIDEO] Video automatico fallito: {err_msg}")
+            return
         QMessageBox.warning(self, "Errore", f"Errore generazione video:\n{err_msg}")
 
     def closeEvent(self, event):
@@ -614,10 +802,15 @@ class GameWindow(QMainWindow):
 
         if msg.exec() == QMessageBox.Yes:
             voice_narrator.stop()
-            self._cleanup_scene_thread()
+            self._cancel_scene_thread("finestra chiusa")
+            SUMMARIZER.shutdown()
+            # Attesa breve e limitata: LLM, SD e TTS controllano l'annullamento e si fermano presto
+            for thread, _worker in list(self._abandoned_scenes):
+                thread.wait(SCENE_CANCEL_GRACE_MS)
             if self._video_thread and self._video_thread.isRunning():
                 self._video_thread.quit()
                 self._video_thread.wait()
+            comfy_bridge.PROMPT_CACHE.flush()
             event.accept()
         else:
             event.ignore()
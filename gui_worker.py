@@ -1,61 +1,131 @@
 # file: gui_worker.py
 import copy
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 from PySide6.QtCore import QObject, Signal
 
-from dm_engine import process_turn
+from cost_ledger import LEDGER
+from deadline import Deadline
+from dm_engine import process_turn, process_turn_async
+from engine_loop import ENGINE_LOOP
 
 class SceneWorker(QObject):
     """
     Worker eseguito in un QThread:
     - Chiama il DM (LLM) tramite process_turn
-    - Genera l'immagine (Stable Diffusion)
+    - Genera l'immagine (Stable Diffusion) e l'audio della narrazione in parallelo
+
+    Ogni stadio del turno ha il suo segnale, così la GUI aggiorna ogni parte appena è pronta.
+    Il turno ha una scadenza (deadline.TURN_DEADLINE_SEC); cancel() lo annulla da qualsiasi thread.
     """
+    partial = Signal(str)  # pezzi di reply_it in streaming
+    state_ready = Signal(str, dict, bool)  # reply_it, updated_state, is_error
+    audio_ready = Signal(str)  # percorso dell'audio già sintetizzato
+    image_ready = Signal(dict)  # image_info (image_path, visual_en)
     finished = Signal(str, dict, str, object)  # reply_it, updated_state, visual_en, img_path
     error = Signal(str)
 
-    def __init__(self, game_state: dict, last_action: Optional[str], recent_dialogue: List[Dict[str, str]]) -> None:
+    def __init__(
+        self,
+        game_state: dict,
+        last_action: Optional[str],
+        recent_dialogue: List[Dict[str, str]],
+        synthesize_voice: bool = False,
+    ) -> None:
         super().__init__()
         self._game_state = copy.deepcopy(game_state)
         self._last_action = last_action
         self._recent_dialogue = list(recent_dialogue)
+        self._synthesize_voice = synthesize_voice
+        self._dm_output: Dict[str, Any] = {}
+        self.deadline = Deadline()
+
+    def cancel(self, reason: str = "turno annullato") -> None:
+        # Chiamato dal thread della GUI: il worker è bloccato in run(), niente segnali
+        self.deadline.cancel(reason)
+
+    def _on_stage(self, name: str, value: Any) -> None:
+        # Chiamato dai thread degli stadi: i segnali arrivano alla GUI in coda (queued)
+        if name == "llm" and isinstance(value, dict):
+            self._dm_output = value
+        elif name == "state":
+            self.state_ready.emit(
+                str(self._dm_output.get("reply_it", "") or ""),
+                value,
+                bool(self._dm_output.get("is_error", False)),
+            )
+        elif name == "tts" and value:
+            self.audio_ready.emit(str(value))
+        elif name == "image" and isinstance(value, dict) and value.get("image_path"):
+            self.image_ready.emit(value)
+
+    def _turn_kwargs(self) -> Dict[str, Any]:
+        main_quest = str(self._game_state.get("main_quest") or "")
+        story_summary = str(self._game_state.get("story_summary") or "")
+
+        # Normalizzazione dialogo
+        recent_dialogue: List[Dict[str, str]] = []
+        for item in self._recent_dialogue:
+            if isinstance(item, dict) and "speaker" in item and "text" in item:
+                recent_dialogue.append({
+                    "speaker": str(item["speaker"]),
+                    "text": str(item["text"]),
+                })
+
+        return dict(
+            main_quest=main_quest,
+            story_summary=story_summary,
+            game_state=self._game_state,
+            recent_dialogue=recent_dialogue,
+            player_input=self._last_action or "",
+            generate_image=True,
+            on_reply_chunk=self.partial.emit,
+            synthesize_voice=self._synthesize_voice,
+            on_stage=self._on_stage,
+            deadline=self.deadline,
+        )
+
+    def _emit_finished(self, result: Dict[str, Any]) -> None:
+        reply_it: str = result.get("reply_it", "") or ""
+        updated_state: dict = result.get("game_state", self._game_state)
+        image_info = result.get("image_info")
+
+        if isinstance(image_info, dict):
+            visual_en: str = image_info.get("visual_en", "") or ""
+        else:
+            visual_en = ""
+
+        self.finished.emit(reply_it, updated_state, visual_en, result)
 
     def run(self) -> None:
         try:
-            main_quest = str(self._game_state.get("main_quest") or "")
-            story_summary = str(self._game_state.get("story_summary") or "")
-
-            # Normalizzazione dialogo
-            recent_dialogue: List[Dict[str, str]] = []
-            for item in self._recent_dialogue:
-                if isinstance(item, dict) and "speaker" in item and "text" in item:
-                    recent_dialogue.append({
-                        "speaker": str(item["speaker"]),
-                        "text": str(item["text"]),
-                    })
-
             # Chiamata al motore centrale
-            result = process_turn(
-                main_quest=main_quest,
-                story_summary=story_summary,
-                game_state=self._game_state,
-                recent_dialogue=recent_dialogue,
-                player_input=self._last_action or "",
-                generate_image=True,
-            )
+            LEDGER.begin_turn(self._game_state.get("turn"))
+            try:
+                result = process_turn(**self._turn_kwargs())
+            finally:
+                turn_cost = LEDGER.end_turn()
+            result["cost"] = turn_cost
+            self._emit_finished(result)
 
-            reply_it: str = result.get("reply_it", "") or ""
-            updated_state: dict = result.get("game_state", self._game_state)
-            image_info = result.get("image_info")
+        except Exception as e:
+            self.error.emit(str(e))
+
+    def start_async(self) -> None:
+        """Alternativa a run() in un QThread: il turno gira sul loop asyncio condiviso.
 
-            if isinstance(image_info, dict):
-                visual_en: str = image_info.get("visual_en", "") or ""
-                img_path = image_info.get("image_path")
-            else:
-                visual_en = ""
-                img_path = None
+        Il worker resta nel thread della GUI; i segnali emessi dal loop arrivano in coda.
+        """
+        ENGINE_LOOP.submit(self._run_async())
 
-            self.finished.emit(reply_it, updated_state, visual_en, result)
+    async def _run_async(self) -> None:
+        try:
+            LEDGER.begin_turn(self._game_state.get("turn"))
+            try:
+                result = await process_turn_async(**self._turn_kwargs())
+            finally:
+                turn_cost = LEDGER.end_turn()
+            result["cost"] = turn_cost
+            self._emit_finished(result)
 
         except Exception as e:
-            self.error.emit(str(e))
\ No newline at end of file
+            self.error.emit(str(e))
@@ -0,0 +1,178 @@
+# file: json_stream.py
+"""
+Lettore JSON incrementale per le risposte in streaming del DM.
+
+Il modello scrive un unico oggetto JSON un pezzo alla volta. Questo lettore:
+- emette il testo PARZIALE dei campi stringa richiesti (es. 'reply_it') appena arriva;
+- emette ogni campo di primo livello COMPLETO appena il suo valore si chiude.
+
+Non sostituisce il parsing finale (_repair_json): serve solo ad anticipare i dati.
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class JsonFieldStream:
+    """Macchina a stati minimale sui campi di primo livello di un oggetto JSON."""
+
+    def __init__(
+        self,
+        partial_keys: Iterable[str] = ("reply_it",),
+        on_partial: Optional[Callable[[str, str], None]] = None,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+    ) -> None:
+        self._partial_keys = set(partial_keys)
+        self._on_partial = on_partial
+        self._on_field = on_field
+
+        self._buf = ""
+        self._pos = 0
+        self._started = False  # visto il '{' iniziale (salta code fence / testo spurio)
+        self._done = False
+
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+        self._key: Optional[str] = None
+        self._key_start = -1
+        self._expect = "key"  # key -> colon -> value -> comma
+        self._value_start = -1
+        self._emitted: Dict[str, int] = {}
+
+        self.fields: Dict[str, Any] = {}
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def feed(self, chunk: str) -> None:
+        if self._done or not chunk:
+            return
+        self._buf += chunk
+
+        while self._pos < len(self._buf) and not self._done:
+            self._step(self._buf[self._pos])
+            self._pos += 1
+
+        # Stringa ancora aperta: emettiamo il pezzo già decodificabile
+        if self._in_string and self._depth == 1 and self._expect == "value_string":
+            self._emit_partial()
+
+    # ------------------------------------------------------------------
+    # Interni
+    # ------------------------------------------------------------------
+
+    def _step(self, ch: str) -> None:
+        if not self._started:
+            if ch == "{":
+                self._started = True
+                self._depth = 1
+            return
+
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                self._close_string()
+            return
+
+        if ch == '"':
+            self._in_string = True
+            if self._depth == 1:
+                if self._expect == "key":
+                    self._key_start = self._pos
+                elif self._expect == "value":
+                    self._value_start = self._pos
+                    self._expect = "value_string"
+            return
+
+        if ch in "{[":
+            if self._depth == 1 and self._expect == "value":
+                self._value_start = self._pos
+                self._expect = "value_nested"
+            self._depth += 1
+            return
+
+        if ch in "}]":
+            self._depth -= 1
+            if self._depth == 1 and self._expect == "value_nested":
+                self._finish_value(self._pos + 1)
+            elif self._depth == 0:
+                if self._expect == "value_scalar":
+                    self._finish_value(self._pos)
+                self._done = True
+            return
+
+        if self._depth != 1:
+            return
+
+        if ch == ":" and self._expect == "colon":
+            self._expect = "value"
+        elif ch == ",":
+            if self._expect == "value_scalar":
+                self._finish_value(self._pos)
+            self._expect = "key"
+        elif self._expect == "value" and not ch.isspace():
+            # numeri, true/false/null
+            self._value_start = self._pos
+            self._expect = "value_scalar"
+
+    def _close_string(self) -> None:
+        if self._depth != 1:
+            return
+        if self._expect == "key":
+            try:
+                self._key = json.loads(self._buf[self._key_start : self._pos + 1])
+            except ValueError:
+                self._key = None
+            self._expect = "colon"
+        elif self._expect == "value_string":
+            self._emit_partial()
+            self._finish_value(self._pos + 1)
+
+    def _finish_value(self, end: int) -> None:
+        raw = self._buf[self._value_start : end].strip()
+        self._expect = "comma"
+        if self._key is None:
+            return
+        try:
+            value = json.loads(raw, strict=False)
+        except ValueError:
+            return
+        self.fields[self._key] = value
+        if self._on_field:
+            self._on_field(self._key, value)
+
+    def _emit_partial(self) -> None:
+        key = self._key
+        if key is None or key not in self._partial_keys or not self._on_partial:
+            return
+        text = self._decode(self._buf[self._value_start + 1 : self._pos])
+        already = self._emitted.get(key, 0)
+        if len(text) > already:
+            self._emitted[key] = len(text)
+            self._on_partial(key, text[already:])
+
+    @staticmethod
+    def _decode(raw: str) -> str:
+        # Tronca escape incompleti in coda (es. '\' o '\u00') prima di decodificare
+        cut = raw.rfind("\\")
+        if cut != -1:
+            backslashes = cut + 1 - len(raw[:cut].rstrip("\\"))
+            tail = raw[cut:]
+            if backslashes % 2 == 1 and (len(tail) < 2 or (tail[1] == "u" and len(tail) < 6)):
+                raw = raw[:cut]
+        try:
+            text = json.loads(f'"{raw}"', strict=False)
+        except ValueError:
+            return ""
+        # Coppia surrogata spezzata (emoji con escape \uXXXX): aspettiamo la seconda metà
+        if text and "\ud800" <= text[-1] <= "\udbff":
+            text = text[:-1]
+        return text
@@ -0,0 +1,316 @@
+# file: llm_backends.py
+"""
+Backend LLM intercambiabili + router per latenza.
+
+Un backend sa fare due cose: generate() (testo completo) e stream() (pezzi di testo).
+Il backend Gemini vive in llm_client (context cache, config genai); qui ci sono:
+- OpenAICompatBackend: qualsiasi server /v1/chat/completions (llama.cpp, vLLM, LM Studio...)
+- StubBackend: risposte finte deterministiche, per far girare il motore offline
+- BackendRouter: sceglie il backend sano più veloce (latenza media mobile + tasso d'errore)
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Sequence
+
+from cost_ledger import LEDGER, usage_from_openai
+
+# Import morbido: senza requests resta disponibile solo Gemini / stub
+try:
+    import requests
+except ImportError:
+    requests = None
+
+# Import morbido: senza aiohttp lo streaming asincrono passa da un thread (vedi LLMBackend.astream)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Server OpenAI-compatibile (es. llama.cpp: http://127.0.0.1:8080)
+OPENAI_COMPAT_URL = os.getenv("OPENAI_COMPAT_URL", "").strip().rstrip("/")
+OPENAI_COMPAT_MODEL = os.getenv("OPENAI_COMPAT_MODEL", "local-model")
+OPENAI_COMPAT_API_KEY = os.getenv("OPENAI_COMPAT_API_KEY", "")
+OPENAI_COMPAT_TIMEOUT_SEC = float(os.getenv("OPENAI_COMPAT_TIMEOUT_SEC", "180") or "180")
+
+# Stub: JSON di risposta da file (facoltativo) e ritardo simulato
+LLM_STUB_RESPONSE_PATH = os.getenv("LLM_STUB_RESPONSE_PATH", "")
+LLM_STUB_DELAY_SEC = float(os.getenv("LLM_STUB_DELAY_SEC", "0") or "0")
+
+# Router: peso dell'ultimo campione nella media mobile, finestra per il tasso d'errore
+ROUTER_EWMA_ALPHA = 0.3
+ROUTER_ERROR_WINDOW = 10
+ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_BACKEND_MAX_ERROR_RATE", "0.5") or "0.5")
+# Un backend "malato" torna in gioco dopo N secondi dall'ultimo errore
+ROUTER_COOLDOWN_SEC = float(os.getenv("LLM_BACKEND_COOLDOWN_SEC", "60") or "60")
+# Ogni N chiamate il secondo backend sano va in testa, così la sua latenza resta aggiornata
+ROUTER_PROBE_EVERY = int(os.getenv("LLM_BACKEND_PROBE_EVERY", "20") or "20")
+
+
+class LLMBackend:
+    """Interfaccia comune. model può essere ignorato da backend con un modello fisso."""
+
+    name = "base"
+
+    def available(self) -> bool:
+        return True
+
+    def generate(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+                 cache_key: Optional[str] = None, **kwargs: Any) -> Optional[str]:
+        raise NotImplementedError
+
+    def stream(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+               cache_key: Optional[str] = None, **kwargs: Any) -> Iterator[str]:
+        # Default: nessuno streaming vero, un unico pezzo
+        text = self.generate(system_prompt, user_input, model=model, cache_key=cache_key, **kwargs)
+        if text:
+            yield text
+
+    async def astream(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+                      cache_key: Optional[str] = None, **kwargs: Any) -> AsyncIterator[str]:
+        """Versione asincrona di stream(). Default: lo stream sincrono gira in un thread
+        e i pezzi arrivano al loop tramite una coda."""
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        done = object()
+
+        def _pump() -> None:
+            try:
+                for piece in self.stream(system_prompt, user_input, model=model, cache_key=cache_key, **kwargs):
+                    loop.call_soon_threadsafe(queue.put_nowait, piece)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        loop.run_in_executor(None, _pump)
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def _wants_json(kwargs: Dict[str, Any]) -> bool:
+    return (kwargs.get("response_mime_type") or "application/json") == "application/json"
+
+
+class OpenAICompatBackend(LLMBackend):
+    """POST {base_url}/v1/chat/completions, con SSE per lo streaming."""
+
+    name = "openai"
+
+    def __init__(self, base_url: str = OPENAI_COMPAT_URL, model: str = OPENAI_COMPAT_MODEL,
+                 api_key: str = OPENAI_COMPAT_API_KEY, timeout: float = OPENAI_COMPAT_TIMEOUT_SEC) -> None:
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def available(self) -> bool:
+        return requests is not None and bool(self.base_url)
+
+    def _body(self, system_prompt: str, user_input: str, stream: bool, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        body: Dict[str, Any] = {
+            # I nomi dei modelli Gemini (tier fast/pro) qui non hanno senso: modello del server
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_input},
+            ],
+            "temperature": float(kwargs.get("temperature", 0.9)),
+            "top_p": float(kwargs.get("top_p", 0.95)),
+            "stream": stream,
+        }
+        if _wants_json(kwargs) and kwargs.get("response_schema"):
+            # Structured output (vLLM, llama.cpp server, OpenAI): il server vincola la risposta allo schema
+            body["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "dm_response", "schema": kwargs["response_schema"]},
+            }
+        elif _wants_json(kwargs):
+            body["response_format"] = {"type": "json_object"}
+        return body
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    def _timeout(self, kwargs: Dict[str, Any]) -> float:
+        return min(self.timeout, float(kwargs.get("timeout_sec") or self.timeout))
+
+    def _request(self, system_prompt: str, user_input: str, stream: bool, kwargs: Dict[str, Any]) -> Any:
+        response = requests.post(f"{self.base_url}/v1/chat/completions",
+                                 json=self._body(system_prompt, user_input, stream, kwargs),
+                                 headers=self._headers(), timeout=self._timeout(kwargs), stream=stream)
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _sse_piece(raw: bytes) -> Optional[str]:
+        """Contenuto di una riga SSE; "" per [DONE], None se la riga non porta testo."""
+        # Le righe SSE arrivano spesso senza charset: decodifica esplicita
+        line = raw.decode("utf-8", errors="replace").strip() if raw else ""
+        if not line.startswith("data:"):
+            return None
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return ""
+        choices = json.loads(data).get("choices") or [{}]
+        return (choices[0].get("delta") or {}).get("content") or None
+
+    def generate(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+                 cache_key: Optional[str] = None, **kwargs: Any) -> Optional[str]:
+        data = self._request(system_prompt, user_input, False, kwargs).json()
+        LEDGER.record_llm(data.get("model") or self.model, usage_from_openai(data.get("usage")),
+                          str(kwargs.get("cost_source") or kwargs.get("priority") or "interactive"))
+        return data["choices"][0]["message"].get("content")
+
+    def stream(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+               cache_key: Optional[str] = None, **kwargs: Any) -> Iterator[str]:
+        with self._request(system_prompt, user_input, True, kwargs) as response:
+            for raw in response.iter_lines():
+                piece = self._sse_piece(raw)
+                if piece == "":
+                    break
+                if piece:
+                    yield piece
+
+    async def astream(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+                      cache_key: Optional[str] = None, **kwargs: Any) -> AsyncIterator[str]:
+        if aiohttp is None:
+            async for piece in super().astream(system_prompt, user_input, model=model,
+                                               cache_key=cache_key, **kwargs):
+                yield piece
+            return
+        timeout = aiohttp.ClientTimeout(total=self._timeout(kwargs))
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(f"{self.base_url}/v1/chat/completions",
+                                    json=self._body(system_prompt, user_input, True, kwargs),
+                                    headers=self._headers()) as response:
+                response.raise_for_status()
+                async for raw in response.content:
+                    piece = self._sse_piece(raw)
+                    if piece == "":
+                        break
+                    if piece:
+                        yield piece
+
+
+class StubBackend(LLMBackend):
+    """Risposte finte e deterministiche: nessuna rete, utile per test e sviluppo della GUI."""
+
+    name = "stub"
+
+    DEFAULT_RESPONSE: Dict[str, Any] = {
+        "reply_it": "Il narratore (stub) osserva la scena in silenzio: nulla di nuovo accade.",
+        "state_patch": [],
+        "intents": [],
+        "image_subject": None,
+        "tags_en": [],
+        "visual_en": "",
+        "animation_instructions_en": "",
+    }
+
+    def __init__(self, response_path: str = LLM_STUB_RESPONSE_PATH, delay_sec: float = LLM_STUB_DELAY_SEC,
+                 chunk_chars: int = 24) -> None:
+        self.response_path = response_path
+        self.delay_sec = delay_sec
+        self.chunk_chars = chunk_chars
+
+    def _response(self) -> Dict[str, Any]:
+        if self.response_path:
+            try:
+                return json.loads(Path(self.response_path).read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                print(f"[LLM] Stub: risposta da file non leggibile ({e}), uso quella di default.")
+        return dict(self.DEFAULT_RESPONSE)
+
+    def generate(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+                 cache_key: Optional[str] = None, **kwargs: Any) -> Optional[str]:
+        if self.delay_sec:
+            time.sleep(self.delay_sec)
+        response = self._response()
+        if not _wants_json(kwargs):
+            return str(response.get("reply_it", ""))
+        return json.dumps(response, ensure_ascii=False)
+
+    def stream(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+               cache_key: Optional[str] = None, **kwargs: Any) -> Iterator[str]:
+        text = self.generate(system_prompt, user_input, model=model, cache_key=cache_key, **kwargs) or ""
+        for i in range(0, len(text), self.chunk_chars):
+            yield text[i : i + self.chunk_chars]
+
+
+class _Health:
+    def __init__(self) -> None:
+        self.latency: Dict[str, Optional[float]] = {"call": None, "stream": None}
+        self.outcomes: Deque[bool] = deque(maxlen=ROUTER_ERROR_WINDOW)
+        self.last_error_at = 0.0
+        self.calls = 0
+
+    def error_rate(self) -> float:
+        return (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0
+
+
+class BackendRouter:
+    """Ordina i backend: prima i sani per latenza (media mobile), in fondo quelli in errore."""
+
+    def __init__(self, backends: Sequence[LLMBackend]) -> None:
+        self.backends = list(backends)
+        self._lock = threading.Lock()
+        self._health: Dict[str, _Health] = {b.name: _Health() for b in self.backends}
+        self._calls = 0
+
+    def _healthy(self, health: _Health, now: float) -> bool:
+        if len(health.outcomes) < 3 or health.error_rate() < ROUTER_MAX_ERROR_RATE:
+            return True
+        return now - health.last_error_at >= ROUTER_COOLDOWN_SEC
+
+    def candidates(self, kind: str = "call") -> List[LLMBackend]:
+        """Backend da provare in ordine (kind: 'call' latenza totale, 'stream' primo pezzo)."""
+        now = time.monotonic()
+        with self._lock:
+            self._calls += 1
+            usable = [b for b in self.backends if b.available()]
+            healthy = [b for b in usable if self._healthy(self._health[b.name], now)]
+            sick = [b for b in usable if b not in healthy]
+            # Latenza ignota = 0: un backend mai provato viene campionato subito (ordine di config a parità)
+            healthy.sort(key=lambda b: self._health[b.name].latency[kind] or 0.0)
+            if len(healthy) > 1 and ROUTER_PROBE_EVERY and self._calls % ROUTER_PROBE_EVERY == 0:
+                healthy[0], healthy[1] = healthy[1], healthy[0]
+            return healthy + sick
+
+    def record(self, name: str, seconds: Optional[float], ok: bool, kind: str = "call") -> None:
+        with self._lock:
+            health = self._health[name]
+            health.calls += 1
+            health.outcomes.append(ok)
+            if not ok:
+                health.last_error_at = time.monotonic()
+            elif seconds is not None:
+                prev = health.latency[kind]
+                health.latency[kind] = seconds if prev is None else (
+                    ROUTER_EWMA_ALPHA * seconds + (1 - ROUTER_EWMA_ALPHA) * prev)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                b.name: {
+                    "available": b.available(),
+                    "healthy": self._healthy(self._health[b.name], now),
+                    "calls": self._health[b.name].calls,
+                    "error_rate": self._health[b.name].error_rate(),
+                    "latency_sec": self._health[b.name].latency["call"],
+                    "first_chunk_sec": self._health[b.name].latency["stream"],
+                }
+                for b in self.backends
+            }
@@ -0,0 +1,188 @@
+# file: llm_cache.py
+"""
+Registrazione / riproduzione delle chiamate LLM (llm_client.call_llm e stream).
+
+LLM_CACHE_MODE:
+- "passthrough" (default): nessun effetto, ogni chiamata va al modello;
+- "record": chiamata reale, e ogni risposta riuscita viene salvata su disco;
+- "replay": nessuna chiamata di rete; la risposta arriva dal disco (miss = errore).
+
+La chiave è l'hash di prompt di sistema + input JSON del turno + parametri di
+generazione (modello, mime, schema, temperature...). I parametri che non cambiano
+il testo (timeout, deadline, priorità) sono esclusi.
+
+Con "replay" si può profilare il resto della pipeline (prompt, SD, GUI) in modo
+deterministico e offline; con "record" si catturano sessioni reali come fixture.
+Lo store è una cartella di file JSON, uno per risposta, con limite di dimensione:
+oltre LLM_CACHE_MAX_MB si eliminano le voci usate meno di recente.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+CACHE_MODES = ("passthrough", "record", "replay")
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "passthrough").strip().lower()
+if LLM_CACHE_MODE not in CACHE_MODES:
+    print(f"[LLM-CACHE] Modalità '{LLM_CACHE_MODE}' sconosciuta, uso 'passthrough'.")
+    LLM_CACHE_MODE = "passthrough"
+LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", "storage/llm_cache"))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "200") or "200")
+# Replay degli stream con i tempi registrati (1) o istantaneo (0, default: benchmark della pipeline)
+LLM_CACHE_REPLAY_TIMING = os.getenv("LLM_CACHE_REPLAY_TIMING", "0").strip().lower() in ("1", "true", "yes", "on")
+
+# Parametri che non influiscono sul testo generato: fuori dalla chiave
+_VOLATILE_PARAMS = ("timeout_sec", "deadline", "priority", "cost_source")
+
+
+def fingerprint(system_prompt: str, user_input: str, model: Optional[str], params: Dict[str, Any]) -> str:
+    stable = {k: v for k, v in params.items() if k not in _VOLATILE_PARAMS}
+    blob = json.dumps(
+        {"system": system_prompt, "input": user_input, "model": model, "params": stable},
+        ensure_ascii=False, sort_keys=True, default=str,
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class StreamRecorder:
+    """Avvolge on_chunk: passa i pezzi al chiamante e li annota con il loro istante."""
+
+    def __init__(self, on_chunk: Optional[Callable[[str], None]]) -> None:
+        self._on_chunk = on_chunk
+        self._start = time.monotonic()
+        self.chunks: List[Tuple[float, str]] = []
+
+    def __call__(self, piece: str) -> None:
+        self.chunks.append((round(time.monotonic() - self._start, 3), piece))
+        if self._on_chunk:
+            self._on_chunk(piece)
+
+
+class LLMCache:
+    def __init__(self, mode: str = LLM_CACHE_MODE, root: Path = LLM_CACHE_DIR,
+                 max_bytes: int = int(LLM_CACHE_MAX_MB * 1024 * 1024)) -> None:
+        self.mode = mode
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes: Optional[Dict[Path, int]] = None  # indice dimensioni, letto alla prima scrittura
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self.evicted = 0
+        if mode != "passthrough":
+            print(f"[LLM-CACHE] Modalità {mode} ({root})")
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    # --- lettura ---
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)  # ultimo uso, per l'eviction LRU
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def replay(self, key: str, on_chunk: Optional[Callable[[str], None]] = None,
+               sleep: Callable[[float], Any] = time.sleep) -> Dict[str, Any]:
+        """Risultato nello stesso formato di call_llm; gli stream ripassano i pezzi a on_chunk."""
+        entry = self.get(key)
+        if entry is None:
+            print(f"[LLM-CACHE] Replay: nessuna registrazione per {key[:12]}.")
+            return {"content": None, "error": f"Replay: nessuna registrazione per {key[:12]}"}
+        if on_chunk:
+            elapsed = 0.0
+            for offset, piece in entry.get("chunks") or [(0.0, entry.get("content") or "")]:
+                if LLM_CACHE_REPLAY_TIMING and offset > elapsed:
+                    sleep(offset - elapsed)
+                    elapsed = offset
+                on_chunk(piece)
+        print(f"[LLM-CACHE] Replay {key[:12]} ({self.hits} hit, {self.misses} miss)")
+        return {"content": entry.get("content"), "error": None}
+
+    # --- scrittura ---
+
+    def record(self, key: str, result: Dict[str, Any], model: Optional[str] = None,
+               chunks: Optional[List[Tuple[float, str]]] = None) -> None:
+        """Salva solo risposte complete e senza errori."""
+        if not result.get("content") or result.get("error"):
+            return
+        entry = {
+            "key": key,
+            "model": model,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "content": result["content"],
+            "chunks": chunks or None,
+        }
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+            size = path.stat().st_size
+        except OSError as e:
+            print(f"[LLM-CACHE] Registrazione fallita: {e}")
+            return
+        with self._lock:
+            self.recorded += 1
+            sizes = self._index()
+            sizes[path] = size
+            self._evict(sizes, keep=path)
+
+    def _index(self) -> Dict[Path, int]:
+        if self._sizes is None:
+            self._sizes = {p: p.stat().st_size for p in self.root.glob("*/*.json")}
+        return self._sizes
+
+    def _evict(self, sizes: Dict[Path, int], keep: Path) -> None:
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+        # Le meno usate prima (mtime aggiornato a ogni lettura); quella appena scritta resta
+        for path in sorted(sizes, key=lambda p: p.stat().st_mtime if p.exists() else 0):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total -= sizes.pop(path)
+            try:
+                path.unlink()
+                self.evicted += 1
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+                "evicted": self.evicted,
+                "bytes": sum(self._sizes.values()) if self._sizes is not None else None,
+            }
+
+
+LLM_CACHE = LLMCache()
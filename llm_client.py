@@ -1,12 +1,34 @@
 # file: llm_client.py
 from __future__ import annotations
 
+import asyncio
+import itertools
 import os
-from typing import Any, Dict, Optional
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Tuple
 
 from dotenv import load_dotenv
-from google import genai
-from google.genai import types
+
+from deadline import Deadline, TurnCancelled
+from cost_ledger import LEDGER, usage_from_gemini
+from gemini_scheduler import SCHEDULER, QuotaWaitTimeout, is_rate_limited, shared_client
+from llm_backends import BackendRouter, LLMBackend, OpenAICompatBackend, StubBackend
+from llm_cache import LLM_CACHE, StreamRecorder, fingerprint
+
+# Import morbido: senza google-genai restano i backend locali (LLM_BACKENDS)
+try:
+    from google import genai
+    from google.genai import types
+except ImportError:
+    genai = None
+    types = None
 
 # -------------------- CONFIGURAZIONE --------------------
 
@@ -15,49 +37,998 @@ load_dotenv()
 # Modello: lascia come nel tuo progetto (puoi cambiarlo a piacere)
 MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-3-pro-preview")
 
-client: Optional[genai.Client] = None
-try:
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise ValueError("La variabile d'ambiente GEMINI_API_KEY non è impostata.")
-    client = genai.Client(api_key=api_key)
-    print(f"[LLM] Client inizializzato con modello: {MODEL_NAME}")
-except Exception as e:
-    print(f"[LLM] ERRORE CRITICO: Impossibile inizializzare il client. {e}")
-    client = None
+# Backend da usare, in ordine di preferenza iniziale (es. "gemini,openai" o "stub")
+LLM_BACKENDS = [b.strip().lower() for b in os.getenv("LLM_BACKENDS", "gemini").split(",") if b.strip()]
 
 
-def call_llm(system_prompt: str, user_input_json: str, **kwargs: Any) -> Dict[str, Any]:
-    if not client:
-        return {"content": None, "error": "Client API non disponibile."}
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).strip().lower() not in ("0", "false", "no", "off", "")
 
-    try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=[user_input_json],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                system_instruction=system_prompt,
-                temperature=float(kwargs.get("temperature", 0.9)),
-                top_p=float(kwargs.get("top_p", 0.95)),
-                top_k=int(kwargs.get("top_k", 40)),
-                # Note: leaving your permissive safety settings as-is.
-                safety_settings=[
-                    types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_NONE"),
-                    types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_NONE"),
-                    types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_NONE"),
-                    types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_NONE"),
-                ],
-            ),
+
+# -------------------- CONTEXT CACHE (prompt statico lato server) --------------------
+
+# Il prompt di sistema (Canovaccio + campagna + istruzioni memoria) è identico turno dopo turno:
+# lo carichiamo una volta come cached content e a ogni chiamata inviamo solo l'handle.
+CONTEXT_CACHE_ENABLED = _env_flag("GEMINI_CONTEXT_CACHE", "1")
+CONTEXT_CACHE_TTL_SEC = int(os.getenv("GEMINI_CACHE_TTL_SEC", "3600") or "3600")
+# Rinnova il TTL quando mancano meno di N secondi alla scadenza
+CONTEXT_CACHE_REFRESH_MARGIN_SEC = int(os.getenv("GEMINI_CACHE_REFRESH_MARGIN_SEC", "300") or "300")
+# Dopo un errore di creazione (es. prompt sotto la soglia minima) non riprovare per N secondi
+CONTEXT_CACHE_RETRY_AFTER_SEC = int(os.getenv("GEMINI_CACHE_RETRY_AFTER_SEC", "600") or "600")
+# Stub locale al posto di client.caches (test offline)
+CONTEXT_CACHE_STUB = _env_flag("GEMINI_CACHE_STUB", "0")
+# Attesa massima di uno slot di quota per le richieste accessorie (create/update della cache,
+# count_tokens): oltre, il turno va avanti senza (prompt completo / stima dei token)
+GEMINI_AUX_QUOTA_WAIT_SEC = float(os.getenv("GEMINI_AUX_QUOTA_WAIT_SEC", "5") or "5")
+
+
+class LocalCacheStub:
+    """Imita client.caches (create/update/delete) in memoria, senza rete."""
+
+    def __init__(self) -> None:
+        self._items: Dict[str, datetime] = {}
+
+    def create(self, model: str, config: Any) -> Any:
+        name = f"cachedContents/stub-{uuid.uuid4().hex[:12]}"
+        self._items[name] = _expiry_from_ttl(getattr(config, "ttl", None))
+        return SimpleNamespace(name=name, model=model, expire_time=self._items[name])
+
+    def update(self, name: str, config: Any) -> Any:
+        expire = self._items.get(name)
+        if expire is None or expire <= datetime.now(timezone.utc):
+            self._items.pop(name, None)
+            raise LookupError(f"404 NOT_FOUND: CachedContent {name} not found")
+        self._items[name] = _expiry_from_ttl(getattr(config, "ttl", None))
+        return SimpleNamespace(name=name, expire_time=self._items[name])
+
+    def delete(self, name: str) -> None:
+        self._items.pop(name, None)
+
+
+def _expiry_from_ttl(ttl: Optional[str]) -> datetime:
+    seconds = CONTEXT_CACHE_TTL_SEC
+    if ttl and str(ttl).endswith("s"):
+        try:
+            seconds = int(float(str(ttl)[:-1]))
+        except ValueError:
+            pass
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+class ContextCache:
+    """
+    Handle di cached content indicizzati per (hash del prompt, modello).
+
+    - hit: handle valido e lontano dalla scadenza
+    - refresh: vicino alla scadenza -> update del TTL
+    - miss: assente/scaduto/refresh fallito -> nuova creazione
+    """
+
+    def __init__(self, caches_api: Any, ttl_sec: int = CONTEXT_CACHE_TTL_SEC,
+                 refresh_margin_sec: int = CONTEXT_CACHE_REFRESH_MARGIN_SEC) -> None:
+        self._api = caches_api
+        self._ttl = f"{int(ttl_sec)}s"
+        self._margin = refresh_margin_sec
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], Tuple[str, float]] = {}  # -> (name, expire_ts)
+        self._failed_until: Dict[Tuple[str, str], float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def handle_for(self, key: str, model: str, system_prompt: str) -> Optional[str]:
+        """Nome del cached content da usare, o None (si invia il prompt per intero)."""
+        k = (key, model)
+        now = time.time()
+        with self._lock:
+            if self._failed_until.get(k, 0.0) > now:
+                self.misses += 1
+                return None
+
+            entry = self._entries.get(k)
+            if entry and now < entry[1] - self._margin:
+                self.hits += 1
+                return entry[0]
+
+            if entry and now < entry[1]:
+                try:
+                    updated = self._remote(lambda: self._api.update(
+                        name=entry[0], config=types.UpdateCachedContentConfig(ttl=self._ttl)))
+                    self._entries[k] = (entry[0], self._expire_ts(updated, now))
+                    self.refreshes += 1
+                    self.hits += 1
+                    return entry[0]
+                except QuotaWaitTimeout:
+                    # Quota piena: l'handle è ancora valido, lo rinnoveremo alla prossima chiamata
+                    self.hits += 1
+                    return entry[0]
+                except Exception as e:
+                    print(f"[LLM] Refresh cache fallito, la ricreo: {e}")
+
+            self.misses += 1
+            self._entries.pop(k, None)
+            try:
+                created = self._remote(lambda: self._api.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        ttl=self._ttl,
+                        display_name=f"luna-dm-{key}",
+                    ),
+                ))
+                self._entries[k] = (created.name, self._expire_ts(created, now))
+                print(f"[LLM] Context cache creata: {created.name} (prompt {key}, {model})")
+                return created.name
+            except QuotaWaitTimeout:
+                # Niente slot per la creazione: questo turno va col prompt completo, la prossima volta si riprova
+                print("[LLM] Quota piena: context cache rimandata, uso il prompt completo.")
+                return None
+            except Exception as e:
+                self.errors += 1
+                self._failed_until[k] = now + CONTEXT_CACHE_RETRY_AFTER_SEC
+                print(f"[LLM] Context cache non disponibile, uso il prompt completo: {e}")
+                return None
+
+    def _remote(self, call: Callable[[], Any]) -> Any:
+        # Create/update sono richieste Gemini: passano dalla quota come i turni (lo stub locale no)
+        if isinstance(self._api, LocalCacheStub):
+            return call()
+        return SCHEDULER.run(call, "interactive", timeout=GEMINI_AUX_QUOTA_WAIT_SEC)
+
+    def invalidate(self, key: str, model: str) -> None:
+        with self._lock:
+            self._entries.pop((key, model), None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "errors": self.errors,
+                "hit_ratio": (self.hits / total) if total else 0.0,
+            }
+
+    def _expire_ts(self, obj: Any, now: float) -> float:
+        expire = getattr(obj, "expire_time", None)
+        if isinstance(expire, datetime):
+            return expire.timestamp()
+        return now + float(self._ttl[:-1])
+
+
+def _is_cache_error(err: Exception) -> bool:
+    msg = str(err).lower()
+    return "cachedcontent" in msg or "cached_content" in msg or "cached content" in msg
+
+
+def _is_schema_error(err: Exception) -> bool:
+    code = getattr(err, "code", None) or getattr(err, "status_code", None)
+    msg = str(err).lower()
+    return code == 400 and ("schema" in msg or "response_json" in msg)
+
+
+# -------------------- ROUTING PER TURNO (fast / pro) --------------------
+
+# Turni banali ("mi guardo intorno") vanno al modello veloce, quelli delicati al pro.
+FAST_MODEL_NAME = os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash")
+MODEL_TIERS = {"fast": FAST_MODEL_NAME, "pro": MODEL_NAME}
+ROUTING_ENABLED = _env_flag("LLM_ROUTING", "1")
+# Punteggio minimo per usare il pro (soglie da tarare coi log [ROUTER])
+ROUTE_PRO_SCORE = int(os.getenv("LLM_ROUTE_PRO_SCORE", "2") or "2")
+# Input "lungo" / "molto lungo" in caratteri
+ROUTE_LONG_INPUT = int(os.getenv("LLM_ROUTE_LONG_INPUT", "160") or "160")
+ROUTE_VERY_LONG_INPUT = int(os.getenv("LLM_ROUTE_VERY_LONG_INPUT", "400") or "400")
+# Campioni di latenza tenuti per tier
+ROUTE_LATENCY_WINDOW = 50
+
+
+def score_turn(signals: Dict[str, Any]) -> Tuple[int, List[str]]:
+    """Punteggio di complessità del turno. Restituisce (punteggio, motivi)."""
+    score = 0
+    reasons: List[str] = []
+    if signals.get("previous_error"):
+        # Il turno precedente è fallito: niente risparmi, si va sul sicuro
+        score += ROUTE_PRO_SCORE
+        reasons.append("errore precedente")
+    if signals.get("act_change_pending"):
+        score += ROUTE_PRO_SCORE
+        reasons.append("cambio atto in vista")
+    if signals.get("rolled"):
+        score += 2
+        reasons.append("dado tirato")
+    chars = int(signals.get("input_chars") or 0)
+    if chars >= ROUTE_VERY_LONG_INPUT:
+        score += 2
+        reasons.append(f"input molto lungo ({chars})")
+    elif chars >= ROUTE_LONG_INPUT:
+        score += 1
+        reasons.append(f"input lungo ({chars})")
+    return score, reasons
+
+
+class TierRouter:
+    """Sceglie il tier per turno e tiene le latenze osservate di ogni tier."""
+
+    def __init__(self, tiers: Dict[str, str], enabled: bool = ROUTING_ENABLED) -> None:
+        self.tiers = dict(tiers)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._latency: Dict[str, Deque[float]] = {t: deque(maxlen=ROUTE_LATENCY_WINDOW) for t in tiers}
+        self._first_chunk: Dict[str, Deque[float]] = {t: deque(maxlen=ROUTE_LATENCY_WINDOW) for t in tiers}
+        self._errors: Dict[str, int] = {t: 0 for t in tiers}
+        self._routed: Dict[str, int] = {t: 0 for t in tiers}
+
+    def route(self, signals: Dict[str, Any]) -> Tuple[str, str]:
+        """(tier, modello) per questo turno."""
+        score, reasons = score_turn(signals)
+        tier = "pro" if (not self.enabled or score >= ROUTE_PRO_SCORE) else "fast"
+        with self._lock:
+            self._routed[tier] += 1
+        why = ", ".join(reasons) or "turno semplice"
+        print(f"[ROUTER] Tier {tier} ({self.tiers[tier]}): punteggio {score}/{ROUTE_PRO_SCORE} — {why}")
+        return tier, self.tiers[tier]
+
+    def record(self, tier: str, seconds: float, first_chunk: Optional[float] = None,
+               error: bool = False) -> None:
+        with self._lock:
+            if error:
+                self._errors[tier] += 1
+            else:
+                self._latency[tier].append(seconds)
+                if first_chunk is not None:
+                    self._first_chunk[tier].append(first_chunk)
+        stats = self.stats()[tier]
+        first = f", primo pezzo {first_chunk:.2f}s" if first_chunk is not None else ""
+        print(f"[ROUTER] Latenza {tier}: {seconds:.2f}s{first} "
+              f"(media {stats['avg_sec']:.2f}s, p90 {stats['p90_sec']:.2f}s, n={stats['samples']}, "
+              f"errori {stats['errors']})")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            out: Dict[str, Dict[str, Any]] = {}
+            for tier, model in self.tiers.items():
+                samples = sorted(self._latency[tier])
+                firsts = list(self._first_chunk[tier])
+                out[tier] = {
+                    "model": model,
+                    "routed": self._routed[tier],
+                    "samples": len(samples),
+                    "errors": self._errors[tier],
+                    "avg_sec": (sum(samples) / len(samples)) if samples else 0.0,
+                    "p90_sec": samples[min(len(samples) - 1, int(len(samples) * 0.9))] if samples else 0.0,
+                    "first_chunk_avg_sec": (sum(firsts) / len(firsts)) if firsts else 0.0,
+                }
+            return out
+
+
+_router = TierRouter(MODEL_TIERS)
+
+
+def route_model(signals: Dict[str, Any]) -> Tuple[str, str]:
+    """Tier e modello per il turno. signals: rolled, input_chars, act_change_pending, previous_error."""
+    return _router.route(signals)
+
+
+def record_route_latency(tier: str, seconds: float, first_chunk: Optional[float] = None,
+                         error: bool = False) -> None:
+    _router.record(tier, seconds, first_chunk=first_chunk, error=error)
+
+
+def routing_stats() -> Dict[str, Dict[str, Any]]:
+    """Latenze e conteggi per tier (per tarare le soglie)."""
+    return _router.stats()
+
+
+# -------------------- BACKEND GEMINI --------------------
+
+# response_schema (kwargs) è JSON Schema: va nel campo response_json_schema, presente solo
+# nelle versioni recenti di google-genai. Senza, si resta in JSON mode semplice.
+_SCHEMA_CONFIG_SUPPORTED = types is not None and "response_json_schema" in getattr(
+    types.GenerateContentConfig, "model_fields", {})
+
+
+def _build_config(system_prompt: str, cached_content: Optional[str] = None,
+                  **kwargs: Any) -> types.GenerateContentConfig:
+    # Con un cached content il prompt di sistema è già lato server: non va reinviato
+    extra: Dict[str, Any] = {"cached_content": cached_content} if cached_content else {
+        "system_instruction": system_prompt}
+    mime_type = kwargs.get("response_mime_type") or "application/json"
+    if kwargs.get("response_schema") and mime_type == "application/json" and _SCHEMA_CONFIG_SUPPORTED:
+        # Output vincolato allo schema: niente JSON da riparare
+        extra["response_json_schema"] = kwargs["response_schema"]
+    if kwargs.get("timeout_sec"):
+        # Timeout HTTP della singola richiesta (millisecondi), dalla scadenza del turno
+        extra["http_options"] = types.HttpOptions(timeout=int(float(kwargs["timeout_sec"]) * 1000))
+    return types.GenerateContentConfig(
+        # "text/plain" per la sola narrazione (split call), JSON per tutto il resto
+        response_mime_type=mime_type,
+        **extra,
+        temperature=float(kwargs.get("temperature", 0.9)),
+        top_p=float(kwargs.get("top_p", 0.95)),
+        top_k=int(kwargs.get("top_k", 40)),
+        # Note: leaving your permissive safety settings as-is.
+        safety_settings=[
+            types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_NONE"),
+            types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_NONE"),
+            types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_NONE"),
+            types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_NONE"),
+        ],
+    )
+
+
+class GeminiBackend(LLMBackend):
+    """google-genai con context cache. Il client nasce alla prima chiamata, non all'import."""
+
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str] = None) -> None:
+        self._api_key = api_key if api_key is not None else os.getenv("GEMINI_API_KEY", "")
+        self._client: Any = None
+        self._failed = False
+        self._schema_rejected = False
+        self._lock = threading.Lock()
+        self.context_cache: Optional[ContextCache] = None
+
+    def available(self) -> bool:
+        return genai is not None and bool(self._api_key) and not self._failed
+
+    @property
+    def client(self) -> Any:
+        with self._lock:
+            if self._client is None and not self._failed:
+                try:
+                    if genai is None:
+                        raise ImportError("google-genai non installato.")
+                    if not self._api_key:
+                        raise ValueError("La variabile d'ambiente GEMINI_API_KEY non è impostata.")
+                    # Client unico del processo, condiviso con comfy_bridge
+                    self._client = shared_client(self._api_key)
+                    if self._client is None:
+                        raise RuntimeError("genai.Client non creato.")
+                    print(f"[LLM] Client inizializzato con modello: {MODEL_NAME}")
+                except Exception as e:
+                    print(f"[LLM] ERRORE CRITICO: Impossibile inizializzare il client. {e}")
+                    self._failed = True
+                    return None
+                if CONTEXT_CACHE_ENABLED:
+                    self.context_cache = ContextCache(
+                        LocalCacheStub() if CONTEXT_CACHE_STUB else self._client.caches)
+            return self._client
+
+    def _cached_content_for(self, system_prompt: str, cache_key: Optional[str], model: str) -> Optional[str]:
+        cache = self.context_cache
+        if not cache or not cache_key:
+            return None
+        # Il cached content è legato al modello: ogni modello ha la sua voce
+        name = cache.handle_for(cache_key, model, system_prompt)
+        stats = cache.stats()
+        print(f"[LLM] Context cache hit ratio: {stats['hit_ratio']:.0%} ({stats['hits']}/{stats['hits'] + stats['misses']})")
+        return name
+
+    def _schema_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        if self._schema_rejected and kwargs.get("response_schema"):
+            return {k: v for k, v in kwargs.items() if k != "response_schema"}
+        return kwargs
+
+    def _reject_schema(self, err: Exception) -> None:
+        # Il modello/endpoint non accetta lo schema: da qui in poi JSON mode semplice (+ validatore)
+        print(f"[LLM] response_schema rifiutato ({err}): continuo senza schema.")
+        self._schema_rejected = True
+
+    @staticmethod
+    def _cost_source(kwargs: Dict[str, Any]) -> str:
+        # Voce del registro costi: la priorità, salvo i duplicati (hedge)
+        return str(kwargs.get("cost_source") or kwargs.get("priority") or "interactive")
+
+    @staticmethod
+    def _quota(kwargs: Dict[str, Any]) -> Tuple[str, Optional[float]]:
+        # Priorità nello scheduler (interactive se non indicata) e attesa massima di uno slot
+        timeout = kwargs.get("timeout_sec")
+        return str(kwargs.get("priority") or "interactive"), float(timeout) if timeout else None
+
+    async def _admit_async(self, kwargs: Dict[str, Any]) -> None:
+        priority, timeout = self._quota(kwargs)
+        if not await asyncio.to_thread(SCHEDULER.acquire, priority, timeout):
+            raise QuotaWaitTimeout(f"quota Gemini: nessuno slot libero per la richiesta {priority}")
+
+    def _generate_with_cache(self, call: Callable[[types.GenerateContentConfig], Any], system_prompt: str,
+                             cache_key: Optional[str], model: str, **kwargs: Any) -> Any:
+        """Esegue call(config) usando la context cache; se l'handle non è più valido riprova senza."""
+        kwargs = self._schema_kwargs(kwargs)
+        cached = self._cached_content_for(system_prompt, cache_key, model)
+        try:
+            return call(_build_config(system_prompt, cached_content=cached, **kwargs))
+        except Exception as e:
+            if kwargs.get("response_schema") and _is_schema_error(e):
+                self._reject_schema(e)
+                return self._generate_with_cache(call, system_prompt, cache_key, model, **kwargs)
+            if not (cached and _is_cache_error(e)):
+                raise
+            # Handle scaduto/cancellato lato server: lo scartiamo e riproviamo col prompt completo
+            print(f"[LLM] Cached content non valido ({e}), riprovo senza cache.")
+            self.context_cache.invalidate(cache_key, model)
+            return call(_build_config(system_prompt, **kwargs))
+
+    def generate(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+                 cache_key: Optional[str] = None, **kwargs: Any) -> Optional[str]:
+        client = self.client
+        if client is None:
+            raise RuntimeError("Client API non disponibile.")
+        model = model or MODEL_NAME
+        priority, timeout = self._quota(kwargs)
+        response = self._generate_with_cache(
+            lambda config: SCHEDULER.run(lambda: client.models.generate_content(
+                model=model,
+                contents=[user_input],
+                config=config,
+            ), priority, timeout=timeout),
+            system_prompt, cache_key, model, **kwargs,
+        )
+        LEDGER.record_llm(model, usage_from_gemini(getattr(response, "usage_metadata", None)), self._cost_source(kwargs))
+        return getattr(response, "text", None)
+
+    def stream(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+               cache_key: Optional[str] = None, **kwargs: Any) -> Iterator[str]:
+        client = self.client
+        if client is None:
+            raise RuntimeError("Client API non disponibile.")
+        model = model or MODEL_NAME
+        priority, timeout = self._quota(kwargs)
+
+        def _open(config: types.GenerateContentConfig) -> Any:
+            # Legge già il primo pezzo: gli errori di richiesta (es. cache scaduta) emergono qui
+            def _first() -> Any:
+                stream = iter(client.models.generate_content_stream(
+                    model=model,
+                    contents=[user_input],
+                    config=config,
+                ))
+                first = next(stream, None)
+                return itertools.chain([first] if first is not None else [], stream)
+            return SCHEDULER.run(_first, priority, timeout=timeout)
+
+        usage = None
+        try:
+            for chunk in self._generate_with_cache(_open, system_prompt, cache_key, model, **kwargs):
+                # usage_metadata completo arriva con l'ultimo pezzo
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                piece = getattr(chunk, "text", None)
+                if piece:
+                    yield piece
+        finally:
+            LEDGER.record_llm(model, usage_from_gemini(usage), self._cost_source(kwargs))
+
+    async def astream(self, system_prompt: str, user_input: str, model: Optional[str] = None,
+                      cache_key: Optional[str] = None, **kwargs: Any) -> AsyncIterator[str]:
+        """Streaming nativo asincrono (client.aio): nessun thread occupato durante l'attesa."""
+        client = self.client
+        if client is None:
+            raise RuntimeError("Client API non disponibile.")
+        model = model or MODEL_NAME
+
+        async def _open(cached: Optional[str]) -> AsyncIterator[Any]:
+            await self._admit_async(kwargs)
+            return await client.aio.models.generate_content_stream(
+                model=model,
+                contents=[user_input],
+                config=_build_config(system_prompt, cached_content=cached, **self._schema_kwargs(kwargs)),
+            )
+
+        # La creazione/refresh della cache è una chiamata di rete sincrona: fuori dal loop
+        cached = await asyncio.to_thread(self._cached_content_for, system_prompt, cache_key, model)
+        try:
+            stream = await _open(cached)
+            first = await anext(stream, None)
+        except Exception as e:
+            if is_rate_limited(e):
+                SCHEDULER.penalize(e)
+                raise
+            if kwargs.get("response_schema") and not self._schema_rejected and _is_schema_error(e):
+                self._reject_schema(e)
+                stream = await _open(cached)
+                first = await anext(stream, None)
+            elif cached and _is_cache_error(e):
+                # Handle scaduto/cancellato lato server: lo scartiamo e riproviamo col prompt completo
+                print(f"[LLM] Cached content non valido ({e}), riprovo senza cache.")
+                self.context_cache.invalidate(cache_key, model)
+                stream = await _open(None)
+                first = await anext(stream, None)
+            else:
+                raise
+
+        if first is None:
+            return
+        usage = getattr(first, "usage_metadata", None)
+        try:
+            piece = getattr(first, "text", None)
+            if piece:
+                yield piece
+            async for chunk in stream:
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                piece = getattr(chunk, "text", None)
+                if piece:
+                    yield piece
+        finally:
+            LEDGER.record_llm(model, usage_from_gemini(usage), self._cost_source(kwargs))
+
+    def count_tokens(self, text: str, model: Optional[str] = None) -> Optional[int]:
+        client = self.client if self.available() else None
+        if client is None:
+            return None
+        result = SCHEDULER.run(lambda: client.models.count_tokens(model=model or MODEL_NAME, contents=[text]),
+                               "interactive", timeout=GEMINI_AUX_QUOTA_WAIT_SEC)
+        return int(getattr(result, "total_tokens", 0) or 0) or None
+
+
+_gemini = GeminiBackend()
+_BACKEND_FACTORIES: Dict[str, Callable[[], LLMBackend]] = {
+    "gemini": lambda: _gemini,
+    "openai": OpenAICompatBackend,
+    "stub": StubBackend,
+}
+
+
+def _make_backends(names: List[str]) -> List[LLMBackend]:
+    backends = []
+    for name in names:
+        if name not in _BACKEND_FACTORIES:
+            print(f"[LLM] Backend sconosciuto in LLM_BACKENDS: '{name}' (ignorato)")
+            continue
+        backends.append(_BACKEND_FACTORIES[name]())
+    return backends
+
+
+_backend_router = BackendRouter(_make_backends(LLM_BACKENDS))
+
+
+def backend_stats() -> Dict[str, Dict[str, Any]]:
+    """Latenza media mobile, tasso d'errore e salute di ogni backend."""
+    return _backend_router.stats()
+
+
+def context_cache_stats() -> Dict[str, Any]:
+    """Statistiche della context cache (hit ratio compreso)."""
+    cache = _gemini.context_cache
+    return cache.stats() if cache else {"enabled": False}
+
+
+# -------------------- RESILIENZA (retry + hedging) --------------------
+
+# Tempo massimo complessivo di una chiamata, tentativi e duplicati compresi
+LLM_RETRY_BUDGET_SEC = float(os.getenv("LLM_RETRY_BUDGET_SEC", "90") or "90")
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3") or "3")
+# Backoff esponenziale con jitter: base * 2^(tentativo-1), * [0.5, 1.5)
+LLM_RETRY_BASE_SEC = float(os.getenv("LLM_RETRY_BASE_SEC", "0.8") or "0.8")
+LLM_RETRY_MAX_SEC = float(os.getenv("LLM_RETRY_MAX_SEC", "8") or "8")
+# Hedging: se la richiesta supera il p95 osservato, ne parte un duplicato (vince la prima valida)
+LLM_HEDGE = _env_flag("LLM_HEDGE", "1")
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "8") or "8")
+LLM_HEDGE_MIN_DELAY_SEC = float(os.getenv("LLM_HEDGE_MIN_DELAY_SEC", "2") or "2")
+LLM_LATENCY_WINDOW = 100
+
+# Errori per cui ha senso riprovare (rete, sovraccarico, rate limit)
+_TRANSIENT_CODES = (408, 429, 500, 502, 503, 504)
+_TRANSIENT_MARKERS = ("timeout", "timed out", "deadline", "unavailable", "overloaded",
+                      "resource_exhausted", "rate limit", "connection", "temporarily",
+                      "risposta vuota")
+
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm-hedge")
+
+
+def _is_transient(err: Exception) -> bool:
+    if isinstance(err, QuotaWaitTimeout):
+        # Attesa di quota già esaurita: riprovare vorrebbe dire aspettare di nuovo lo stesso slot
+        return False
+    code = getattr(err, "code", None) or getattr(getattr(err, "response", None), "status_code", None)
+    if isinstance(code, int) and code in _TRANSIENT_CODES:
+        return True
+    if isinstance(err, (TimeoutError, ConnectionError)):
+        return True
+    msg = str(err).lower()
+    return any(str(c) in msg for c in _TRANSIENT_CODES) or any(m in msg for m in _TRANSIENT_MARKERS)
+
+
+def _backoff_delay(attempt: int) -> float:
+    return min(LLM_RETRY_MAX_SEC, LLM_RETRY_BASE_SEC * (2 ** (attempt - 1))) * random.uniform(0.5, 1.5)
+
+
+class LatencyWindow:
+    """Latenze recenti delle chiamate riuscite, per modello (serve il p95 per l'hedging)."""
+
+    def __init__(self, size: int = LLM_LATENCY_WINDOW) -> None:
+        self._size = size
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self._size)).append(seconds)
+
+    def p95(self, key: str) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(key) or ())
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+_latency = LatencyWindow()
+_resilience = {"retries": 0, "hedges": 0, "hedge_wins": 0, "budget_exhausted": 0}
+_resilience_lock = threading.Lock()
+
+
+def _count(event: str) -> None:
+    with _resilience_lock:
+        _resilience[event] += 1
+
+
+def resilience_stats() -> Dict[str, Any]:
+    """Retry, duplicati (hedge) e quante volte il duplicato ha vinto."""
+    with _resilience_lock:
+        return dict(_resilience)
+
+
+def _generate_once(system_prompt: str, user_input_json: str, cache_key: Optional[str],
+                   model: Optional[str], **kwargs: Any) -> Dict[str, Any]:
+    """Un passaggio sui backend in ordine di router. 'retryable' dice se vale la pena riprovare."""
+    backends = _backend_router.candidates("call")
+    if not backends:
+        return {"content": None, "error": "Client API non disponibile.", "retryable": False}
+
+    errors = []
+    retryable = False
+    for backend in backends:
+        start = time.monotonic()
+        try:
+            text = backend.generate(system_prompt, user_input_json, model=model, cache_key=cache_key, **kwargs)
+            if not text:
+                raise ValueError("Risposta vuota dal modello.")
+        except Exception as e:
+            _backend_router.record(backend.name, None, ok=False)
+            errors.append(f"{backend.name}: {e}")
+            retryable = retryable or _is_transient(e)
+            print(f"[LLM] Errore durante la generazione ({backend.name}): {e}")
+            continue
+        _backend_router.record(backend.name, time.monotonic() - start, ok=True)
+        return {"content": text, "error": None, "retryable": False}
+
+    return {"content": None, "error": f"Errore durante la generazione: {'; '.join(errors)}",
+            "retryable": retryable}
+
+
+# Ogni quanto l'attesa controlla se il turno è stato annullato
+_CANCEL_POLL_SEC = 0.25
+
+
+def _wait_slice(pending: Any, until: float, turn: Optional[Deadline], **kwargs: Any) -> Tuple[Any, Any]:
+    """wait() a fette, così un annullamento del turno viene visto entro _CANCEL_POLL_SEC."""
+    while True:
+        if turn is not None and turn.cancelled:
+            return set(), pending
+        step = min(_CANCEL_POLL_SEC, until - time.monotonic())
+        if step <= 0:
+            return set(), pending
+        done, not_done = wait(pending, timeout=step, **kwargs)
+        if done:
+            return done, not_done
+
+
+def _hedged(call: Callable[..., Dict[str, Any]], latency_key: str, deadline: float,
+            turn: Optional[Deadline] = None) -> Dict[str, Any]:
+    """Esegue call(); se supera il p95 ne lancia un duplicato e tiene la prima risposta valida.
+
+    Il duplicato riceve cost_source="hedge": nel registro dei costi non conta come lavoro del turno.
+    """
+    start = time.monotonic()
+    hedge_after = _latency.p95(latency_key) if LLM_HEDGE else None
+    if hedge_after is not None:
+        hedge_after = max(hedge_after, LLM_HEDGE_MIN_DELAY_SEC)
+
+    primary = _HEDGE_EXECUTOR.submit(call)
+    pending = {primary}
+    if hedge_after is not None and start + hedge_after < deadline:
+        done, _ = _wait_slice(pending, start + hedge_after, turn)
+        if not done and not (turn and turn.cancelled):
+            print(f"[LLM] Nessuna risposta dopo {hedge_after:.1f}s (p95): invio una richiesta duplicata.")
+            _count("hedges")
+            pending.add(_HEDGE_EXECUTOR.submit(call, cost_source="hedge"))
+
+    last: Dict[str, Any] = {"content": None, "error": "Budget di tempo esaurito.", "retryable": False}
+    while pending:
+        if turn is not None and turn.cancelled:
+            last = {"content": None, "error": f"Chiamata annullata: {turn.reason}", "retryable": False}
+            break
+        if deadline - time.monotonic() <= 0:
+            _count("budget_exhausted")
+            break
+        done, pending = _wait_slice(pending, deadline, turn, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"content": None, "error": f"Errore durante la generazione: {e}",
+                          "retryable": _is_transient(e)}
+            if result.get("content"):
+                if future is not primary:
+                    _count("hedge_wins")
+                    print("[LLM] Ha risposto prima la richiesta duplicata.")
+                _latency.add(latency_key, time.monotonic() - start)
+                return result
+            last = result
+    return last
+
+
+# -------------------- CHIAMATE --------------------
+
+def _call_budget(turn: Optional[Deadline]) -> float:
+    """Istante (monotonic) oltre il quale la chiamata rinuncia: budget LLM o scadenza del turno."""
+    budget = turn.remaining(LLM_RETRY_BUDGET_SEC) if turn is not None else LLM_RETRY_BUDGET_SEC
+    return time.monotonic() + budget
+
+
+def _retry_pause(attempt: int, until: float, turn: Optional[Deadline]) -> Optional[float]:
+    """Pausa prima del prossimo tentativo, o None se non c'è più tempo."""
+    delay = _backoff_delay(attempt)
+    if time.monotonic() + delay >= until or (turn is not None and turn.expired()):
+        _count("budget_exhausted")
+        return None
+    return delay
+
+
+def _record_key(system_prompt: str, user_input_json: str, model: Optional[str],
+                kwargs: Dict[str, Any]) -> Optional[str]:
+    """Chiave per record/replay (llm_cache); None in passthrough."""
+    if LLM_CACHE.mode == "passthrough":
+        return None
+    return fingerprint(system_prompt, user_input_json, model or MODEL_NAME, kwargs)
+
+
+def call_llm(system_prompt: str, user_input_json: str, cache_key: Optional[str] = None,
+             model: Optional[str] = None, deadline: Optional[Deadline] = None,
+             **kwargs: Any) -> Dict[str, Any]:
+    """Chiamata bloccante. cache_key (es. hash del prompt compilato) abilita la context cache.
+
+    model sostituisce MODEL_NAME per questa chiamata; response_mime_type (kwargs)
+    permette risposte in testo semplice. Il backend è scelto dal router (il più veloce
+    tra i sani); se fallisce si passa al successivo.
+
+    Resilienza: errori transitori -> retry con backoff; richiesta più lenta del p95
+    -> duplicato (hedge). Tutto entro LLM_RETRY_BUDGET_SEC e la scadenza del turno (deadline).
+    Con LLM_CACHE_MODE=record/replay la risposta viene salvata / letta da llm_cache.
+    """
+    record_key = _record_key(system_prompt, user_input_json, model, kwargs)
+    if record_key and LLM_CACHE.replaying:
+        return LLM_CACHE.replay(record_key)
+
+    until = _call_budget(deadline)
+    latency_key = f"{model or MODEL_NAME}:{kwargs.get('response_mime_type') or 'application/json'}"
+    attempt = 0
+    while True:
+        attempt += 1
+        timeout_sec = max(0.1, until - time.monotonic())
+        result = _hedged(
+            lambda **extra: _generate_once(system_prompt, user_input_json, cache_key, model,
+                                           timeout_sec=timeout_sec, **kwargs, **extra),
+            latency_key, until, deadline,
         )
+        if result.get("content") or not result.get("retryable") or attempt >= LLM_MAX_ATTEMPTS:
+            break
+        delay = _retry_pause(attempt, until, deadline)
+        if delay is None:
+            break
+        _count("retries")
+        print(f"[LLM] Errore transitorio, nuovo tentativo {attempt + 1}/{LLM_MAX_ATTEMPTS} tra {delay:.1f}s.")
+        if deadline is not None and deadline.sleep(delay):
+            break
+        if deadline is None:
+            time.sleep(delay)
 
-        text = getattr(response, "text", None)
-        if not text:
-            return {"content": None, "error": "Risposta vuota dal modello."}
+    final = {"content": result.get("content"), "error": result.get("error")}
+    if record_key:
+        LLM_CACHE.record(record_key, final, model=model or MODEL_NAME)
+    return final
 
-        return {"content": text, "error": None}
 
+def count_tokens(text: str, model: Optional[str] = None) -> Optional[int]:
+    """Conteggio ESATTO dei token via API Gemini (None se non disponibile)."""
+    if not text or "gemini" not in LLM_BACKENDS:
+        return None
+    try:
+        return _gemini.count_tokens(text, model=model)
     except Exception as e:
-        error_msg = f"Errore durante la generazione: {e}"
-        print(f"[LLM] {error_msg}")
-        return {"content": None, "error": error_msg}
+        print(f"[LLM] count_tokens non disponibile: {e}")
+        return None
+
+
+def _stream_once(system_prompt: str, user_input_json: str, on_chunk: Optional[Callable[[str], None]],
+                 cache_key: Optional[str], model: Optional[str], deadline: Optional[Deadline] = None,
+                 **kwargs: Any) -> Dict[str, Any]:
+    backends = _backend_router.candidates("stream")
+    if not backends:
+        return {"content": None, "error": "Client API non disponibile.", "retryable": False}
+
+    errors = []
+    retryable = False
+    for backend in backends:
+        parts = []
+        start = time.monotonic()
+        first_chunk: Optional[float] = None
+        try:
+            for piece in backend.stream(system_prompt, user_input_json, model=model,
+                                        cache_key=cache_key, **kwargs):
+                if deadline is not None:
+                    deadline.check("stream LLM")
+                if first_chunk is None:
+                    first_chunk = time.monotonic() - start
+                parts.append(piece)
+                if on_chunk:
+                    try:
+                        on_chunk(piece)
+                    except Exception as cb_err:
+                        # Un errore della GUI non deve interrompere lo stream del modello
+                        print(f"[LLM] Errore callback stream: {cb_err}")
+            if not parts:
+                raise ValueError("Risposta vuota dal modello.")
+        except TurnCancelled as e:
+            # Annullamento: non è colpa del backend, niente errore nel router né altri tentativi
+            print(f"[LLM] Stream interrotto: {e}")
+            return {"content": "".join(parts) or None, "error": f"Chiamata annullata: {e}", "retryable": False}
+        except Exception as e:
+            _backend_router.record(backend.name, None, ok=False, kind="stream")
+            error_msg = f"Errore durante lo streaming ({backend.name}): {e}"
+            print(f"[LLM] {error_msg}")
+            if parts:
+                # Restituiamo comunque il parziale: il chiamante decide se è recuperabile
+                return {"content": "".join(parts), "error": error_msg, "retryable": False}
+            errors.append(f"{backend.name}: {e}")
+            retryable = retryable or _is_transient(e)
+            continue
+
+        _backend_router.record(backend.name, first_chunk, ok=True, kind="stream")
+        return {"content": "".join(parts), "error": None, "retryable": False}
+
+    return {"content": None, "error": f"Errore durante lo streaming: {'; '.join(errors)}",
+            "retryable": retryable}
+
+
+def call_llm_stream(
+    system_prompt: str,
+    user_input_json: str,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    cache_key: Optional[str] = None,
+    model: Optional[str] = None,
+    deadline: Optional[Deadline] = None,
+    **kwargs: Any,
+) -> Dict[str, Any]:
+    """Come call_llm, ma in streaming: on_chunk riceve ogni pezzo di testo appena arriva.
+
+    Il valore di ritorno è identico a call_llm (testo completo a fine stream),
+    così il parsing a valle non cambia. Si passa a un altro backend, o si riprova,
+    solo se il precedente fallisce PRIMA del primo pezzo (dopo, la GUI ha già
+    mostrato il testo). Niente hedging: due stream duplicherebbero il testo a video.
+    """
+    record_key = _record_key(system_prompt, user_input_json, model, kwargs)
+    if record_key and LLM_CACHE.replaying:
+        return LLM_CACHE.replay(record_key, on_chunk,
+                                sleep=deadline.sleep if deadline is not None else time.sleep)
+    recorder = StreamRecorder(on_chunk) if record_key else None
+    if recorder is not None:
+        on_chunk = recorder
+
+    until = _call_budget(deadline)
+    attempt = 0
+    while True:
+        attempt += 1
+        result = _stream_once(system_prompt, user_input_json, on_chunk, cache_key, model, deadline,
+                              timeout_sec=max(0.1, until - time.monotonic()), **kwargs)
+        if result.get("content") or not result.get("retryable") or attempt >= LLM_MAX_ATTEMPTS:
+            break
+        delay = _retry_pause(attempt, until, deadline)
+        if delay is None:
+            break
+        _count("retries")
+        print(f"[LLM] Stream fallito prima del primo pezzo, nuovo tentativo {attempt + 1}/{LLM_MAX_ATTEMPTS} "
+              f"tra {delay:.1f}s.")
+        if deadline is not None and deadline.sleep(delay):
+            break
+        if deadline is None:
+            time.sleep(delay)
+
+    final = {"content": result.get("content"), "error": result.get("error")}
+    if recorder is not None:
+        LLM_CACHE.record(record_key, final, model=model or MODEL_NAME, chunks=recorder.chunks)
+    return final
+
+
+async def _astream_once(system_prompt: str, user_input_json: str, on_chunk: Optional[Callable[[str], None]],
+                        cache_key: Optional[str], model: Optional[str], deadline: Optional[Deadline] = None,
+                        **kwargs: Any) -> Dict[str, Any]:
+    backends = _backend_router.candidates("stream")
+    if not backends:
+        return {"content": None, "error": "Client API non disponibile.", "retryable": False}
+
+    errors = []
+    retryable = False
+    for backend in backends:
+        parts = []
+        start = time.monotonic()
+        first_chunk: Optional[float] = None
+        try:
+            async for piece in backend.astream(system_prompt, user_input_json, model=model,
+                                               cache_key=cache_key, **kwargs):
+                if deadline is not None:
+                    deadline.check("stream LLM")
+                if first_chunk is None:
+                    first_chunk = time.monotonic() - start
+                parts.append(piece)
+                if on_chunk:
+                    try:
+                        on_chunk(piece)
+                    except Exception as cb_err:
+                        print(f"[LLM] Errore callback stream: {cb_err}")
+            if not parts:
+                raise ValueError("Risposta vuota dal modello.")
+        except TurnCancelled as e:
+            print(f"[LLM] Stream interrotto: {e}")
+            return {"content": "".join(parts) or None, "error": f"Chiamata annullata: {e}", "retryable": False}
+        except Exception as e:
+            _backend_router.record(backend.name, None, ok=False, kind="stream")
+            error_msg = f"Errore durante lo streaming ({backend.name}): {e}"
+            print(f"[LLM] {error_msg}")
+            if parts:
+                return {"content": "".join(parts), "error": error_msg, "retryable": False}
+            errors.append(f"{backend.name}: {e}")
+            retryable = retryable or _is_transient(e)
+            continue
+
+        _backend_router.record(backend.name, first_chunk, ok=True, kind="stream")
+        return {"content": "".join(parts), "error": None, "retryable": False}
+
+    return {"content": None, "error": f"Errore durante lo streaming: {'; '.join(errors)}",
+            "retryable": retryable}
+
+
+async def call_llm_stream_async(
+    system_prompt: str,
+    user_input_json: str,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    cache_key: Optional[str] = None,
+    model: Optional[str] = None,
+    deadline: Optional[Deadline] = None,
+    **kwargs: Any,
+) -> Dict[str, Any]:
+    """Versione asincrona di call_llm_stream (stesso router, stessi retry, stesso risultato).
+
+    Se il task viene cancellato (es. turno annullato) lo stream si chiude subito.
+    """
+    record_key = _record_key(system_prompt, user_input_json, model, kwargs)
+    if record_key and LLM_CACHE.replaying:
+        # Lettura da disco (e pause registrate): fuori dal loop
+        return await asyncio.to_thread(LLM_CACHE.replay, record_key, on_chunk,
+                                       deadline.sleep if deadline is not None else time.sleep)
+    recorder = StreamRecorder(on_chunk) if record_key else None
+    if recorder is not None:
+        on_chunk = recorder
+
+    until = _call_budget(deadline)
+    attempt = 0
+    while True:
+        attempt += 1
+        result = await _astream_once(system_prompt, user_input_json, on_chunk, cache_key, model, deadline,
+                                     timeout_sec=max(0.1, until - time.monotonic()), **kwargs)
+        if result.get("content") or not result.get("retryable") or attempt >= LLM_MAX_ATTEMPTS:
+            break
+        delay = _retry_pause(attempt, until, deadline)
+        if delay is None:
+            break
+        _count("retries")
+        print(f"[LLM] Stream fallito prima del primo pezzo, nuovo tentativo {attempt + 1}/{LLM_MAX_ATTEMPTS} "
+              f"tra {delay:.1f}s.")
+        await asyncio.sleep(delay)
+
+    final = {"content": result.get("content"), "error": result.get("error")}
+    if recorder is not None:
+        LLM_CACHE.record(record_key, final, model=model or MODEL_NAME, chunks=recorder.chunks)
+    return final
@@ -0,0 +1,141 @@
+# file: mechanics.py
+"""
+Meccaniche deterministiche di gioco (turno, oro, inventario, affinità).
+
+Questi campi sono di proprietà del motore: il DM non li riscrive in new_state
+ma chiede dei cambiamenti con "intenti" compatti, applicati qui:
+    {"gain_item": "torch"}          {"lose_item": "rope"}
+    {"gold": 5}                     {"affinity": {"Luna": 1, "Maria": -2}}
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Tuple
+
+# Campi gestiti SOLO dal motore
+MECHANICS_FIELDS = ("turn", "gold", "inventory", "affinity_scores")
+
+# Scala affinità (vedi campagna: 0-100, con margine per partenze negative)
+AFFINITY_MIN = -100
+AFFINITY_MAX = 100
+# Variazione massima di affinità per personaggio in un singolo turno
+MAX_AFFINITY_STEP = 10
+# Variazione massima di oro in un singolo turno
+MAX_GOLD_STEP = 500
+
+
+def _clamp(value: int, low: int, high: int) -> int:
+    return max(low, min(high, value))
+
+
+def _as_int(value: Any) -> int:
+    # Il modello a volte scrive "+2" come stringa
+    if isinstance(value, bool):
+        raise ValueError(f"numero non valido: {value!r}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(str(value).strip().replace("+", "", 1))
+
+
+def _items(value: Any) -> List[str]:
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise ValueError(f"oggetto non valido: {value!r}")
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def normalize_intents(raw: Any) -> List[Dict[str, Any]]:
+    """Accetta un dict singolo o una lista di dict; ogni chiave diventa un intento separato."""
+    if isinstance(raw, dict):
+        raw = [raw]
+    if not isinstance(raw, list):
+        return []
+    out: List[Dict[str, Any]] = []
+    for item in raw:
+        if isinstance(item, dict):
+            out.extend({k: v} for k, v in item.items())
+    return out
+
+
+def apply_intents(state: Dict[str, Any], raw_intents: Any) -> Tuple[List[str], List[str]]:
+    """Applica gli intenti IN PLACE. Restituisce (descrizioni applicate, errori)."""
+    applied: List[str] = []
+    errors: List[str] = []
+
+    inventory = state.get("inventory")
+    if not isinstance(inventory, list):
+        inventory = state["inventory"] = []
+    scores = state.get("affinity_scores")
+    if not isinstance(scores, dict):
+        scores = state["affinity_scores"] = {}
+
+    for intent in normalize_intents(raw_intents):
+        (kind, value), = intent.items()
+        try:
+            if kind == "gain_item":
+                for item in _items(value):
+                    inventory.append(item)
+                    applied.append(f"+{item}")
+
+            elif kind == "lose_item":
+                for item in _items(value):
+                    match = next((x for x in inventory if str(x).lower() == item.lower()), None)
+                    if match is None:
+                        errors.append(f"lose_item: '{item}' non è nell'inventario")
+                        continue
+                    inventory.remove(match)
+                    applied.append(f"-{item}")
+
+            elif kind == "gold":
+                delta = _clamp(_as_int(value), -MAX_GOLD_STEP, MAX_GOLD_STEP)
+                before = int(state.get("gold") or 0)
+                state["gold"] = max(0, before + delta)
+                applied.append(f"oro {before}->{state['gold']}")
+
+            elif kind == "affinity":
+                if not isinstance(value, dict):
+                    raise ValueError(f"affinity deve essere un oggetto: {value!r}")
+                for name, raw_delta in value.items():
+                    delta = _clamp(_as_int(raw_delta), -MAX_AFFINITY_STEP, MAX_AFFINITY_STEP)
+                    before = int(scores.get(name, 0) or 0)
+                    scores[name] = _clamp(before + delta, AFFINITY_MIN, AFFINITY_MAX)
+                    applied.append(f"affinità {name} {before}->{scores[name]}")
+
+            else:
+                errors.append(f"intento sconosciuto: {kind!r}")
+
+        except (ValueError, TypeError) as e:
+            errors.append(f"{kind}: {e}")
+
+    return applied, errors
+
+
+def advance_turn(state: Dict[str, Any]) -> None:
+    """Un turno completato = +1 (prima era lasciato al modello)."""
+    try:
+        state["turn"] = int(state.get("turn") or 0) + 1
+    except (TypeError, ValueError):
+        state["turn"] = 1
+
+
+def strip_owned_fields(new_state: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """Toglie da new_state i campi delle meccaniche. Restituisce (new_state pulito, campi ignorati)."""
+    if not isinstance(new_state, dict):
+        return {}, []
+    dropped = [k for k in new_state if k in MECHANICS_FIELDS]
+    return {k: v for k, v in new_state.items() if k not in MECHANICS_FIELDS}, dropped
+
+
+def strip_owned_ops(ops: Any) -> Tuple[Any, List[str]]:
+    """Toglie da state_patch le operazioni sui campi delle meccaniche."""
+    if not isinstance(ops, list):
+        return ops, []
+    kept, dropped = [], []
+    for op in ops:
+        path = op.get("path") if isinstance(op, dict) else None
+        root = path[1:].split("/", 1)[0] if isinstance(path, str) and path.startswith("/") else None
+        if root in MECHANICS_FIELDS:
+            dropped.append(str(path))
+        else:
+            kept.append(op)
+    return kept, dropped
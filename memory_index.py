@@ -0,0 +1,163 @@
+# file: memory_index.py
+"""
+Memoria vettoriale locale dei turni passati (risposte del DM e azioni del giocatore).
+
+Al DM arrivano solo le ultime battute e un riassunto: tutto il resto verrebbe
+dimenticato. Qui ogni battuta diventa un vettore (n-grammi di caratteri e
+parole, hashing in MEMORY_DIM componenti, niente modelli né rete) e a ogni turno
+dm_client.build_dm_input recupera le MEMORY_TOP_K più simili a player_input
+("relevant_memories"). Il prompt resta di dimensione costante, il richiamo copre
+tutta la sessione.
+
+L'indice è salvato accanto al salvataggio: <save>.memory.npz.
+NumPy è opzionale: senza, la memoria è disattivata (nessun errore).
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterable, List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MEMORY_ENABLED = os.getenv("MEMORY_INDEX", "1").strip().lower() in ("1", "true", "yes", "on")
+MEMORY_DIM = int(os.getenv("MEMORY_DIM", "1024") or "1024")
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3") or "3")
+# Similarità minima (coseno) perché un ricordo sia "rilevante"
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.25") or "0.25")
+MEMORY_MAX_ENTRIES = int(os.getenv("MEMORY_MAX_ENTRIES", "5000") or "5000")
+# Lunghezza massima di un ricordo nel prompt
+MEMORY_SNIPPET_CHARS = int(os.getenv("MEMORY_SNIPPET_CHARS", "300") or "300")
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def memory_path_for(save_path: str) -> Path:
+    path = Path(save_path)
+    return path.with_name(f"{path.stem}.memory.npz")
+
+
+def _features(text: str) -> Iterable[str]:
+    words = _WORD_RE.findall(text.lower())
+    for word in words:
+        if len(word) > 2:
+            yield "w:" + word
+        padded = f" {word} "
+        # Trigrammi di caratteri: reggono plurali, coniugazioni e refusi
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3]
+    for a, b in zip(words, words[1:]):
+        yield f"b:{a} {b}"
+
+
+def embed(text: str, dim: int = MEMORY_DIM) -> "np.ndarray":
+    """Vettore normalizzato (feature hashing con segno). crc32: stabile tra esecuzioni."""
+    vec = np.zeros(dim, dtype=np.float32)
+    for feature in _features(text):
+        h = zlib.crc32(feature.encode("utf-8"))
+        vec[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+
+class MemoryIndex:
+    def __init__(self, dim: int = MEMORY_DIM) -> None:
+        self.dim = dim
+        self.enabled = MEMORY_ENABLED and np is not None
+        self._lock = threading.Lock()
+        self._entries: List[Dict[str, Any]] = []
+        self._vectors = np.zeros((0, dim), dtype=np.float32) if np is not None else None
+        if MEMORY_ENABLED and np is None:
+            print("[MEMORY] numpy non installato: memoria dei turni passati disattivata.")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = []
+            if self.enabled:
+                self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+
+    def add(self, turn: Any, speaker: str, text: str) -> None:
+        text = str(text or "").strip()
+        if not self.enabled or not text:
+            return
+        vec = embed(text, self.dim)
+        with self._lock:
+            self._entries.append({"turn": turn, "speaker": str(speaker), "text": text})
+            self._vectors = np.vstack([self._vectors, vec[None, :]])
+            if len(self._entries) > MEMORY_MAX_ENTRIES:
+                drop = len(self._entries) - MEMORY_MAX_ENTRIES
+                self._entries = self._entries[drop:]
+                self._vectors = self._vectors[drop:]
+
+    def search(self, query: str, k: int = MEMORY_TOP_K, exclude: Iterable[str] = (),
+               min_score: float = MEMORY_MIN_SCORE) -> List[Dict[str, Any]]:
+        """I k ricordi più simili a query (escluse le battute già nel prompt)."""
+        query = str(query or "").strip()
+        if not self.enabled or not query or k <= 0:
+            return []
+        q = embed(query, self.dim)
+        skip = {str(t).strip() for t in exclude}
+        with self._lock:
+            if not self._entries:
+                return []
+            scores = self._vectors @ q
+            entries = self._entries
+        hits: List[Dict[str, Any]] = []
+        for i in np.argsort(-scores):
+            score = float(scores[i])
+            if score < min_score or len(hits) >= k:
+                break
+            entry = entries[i]
+            if entry["text"] in skip:
+                continue
+            text = entry["text"]
+            if len(text) > MEMORY_SNIPPET_CHARS:
+                text = text[:MEMORY_SNIPPET_CHARS].rsplit(" ", 1)[0] + "…"
+            hits.append({"turn": entry["turn"], "speaker": entry["speaker"], "text": text})
+        return hits
+
+    # --- persistenza ---
+
+    def save(self, path: Path) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            vectors, entries = self._vectors.copy(), list(self._entries)
+        try:
+            # np.savez aggiunge .npz se manca: il percorso lo ha già
+            np.savez_compressed(path, vectors=vectors, entries=np.array(json.dumps(entries, ensure_ascii=False)))
+            print(f"[MEMORY] Salvati {len(entries)} ricordi in {path}")
+        except OSError as e:
+            print(f"[MEMORY] Salvataggio fallito: {e}")
+
+    def load(self, path: Path) -> None:
+        """Sostituisce l'indice con quello salvato (vuoto se il file non c'è)."""
+        self.clear()
+        if not self.enabled or not Path(path).exists():
+            return
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                vectors = data["vectors"].astype(np.float32)
+                entries = json.loads(str(data["entries"]))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[MEMORY] Indice illeggibile ({e}): riparto da zero.")
+            return
+        if vectors.shape != (len(entries), self.dim):
+            # Dimensione cambiata (MEMORY_DIM): si ricalcolano i vettori dai testi
+            vectors = np.stack([embed(e["text"], self.dim) for e in entries]) if entries else self._vectors
+        with self._lock:
+            self._entries, self._vectors = entries, vectors
+        print(f"[MEMORY] Caricati {len(entries)} ricordi da {path}")
+
+
+MEMORY = MemoryIndex()
@@ -0,0 +1,181 @@
+# file: prompt_registry.py
+"""
+Registro dei prompt "compilati".
+
+Un asset di prompt = una lista di file sorgente + una funzione che li compone.
+La compilazione (composizione, minificazione degli spazi, hash) avviene UNA volta;
+il risultato resta in memoria finché l'mtime di uno dei file non cambia
+(hot reload: basta salvare il .txt, il turno successivo usa la nuova versione).
+
+Per non fare I/O a ogni turno (storage di rete lento) lo stat dei file
+viene ripetuto al massimo ogni PROMPT_RECHECK_SEC secondi.
+"""
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+PROMPT_RECHECK_SEC = float(os.getenv("PROMPT_RECHECK_SEC", "2") or "2")
+
+# Stima grezza ma stabile: ~4 caratteri per token (testo misto IT/EN)
+CHARS_PER_TOKEN = 4.0
+
+
+class CompiledPrompt(NamedTuple):
+    text: str
+    hash: str  # sha256 (primi 16 caratteri hex) del testo compilato
+    tokens_est: int
+    chars: int
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima locale dei token (nessuna chiamata di rete)."""
+    if not text:
+        return 0
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def minify_prompt(text: str) -> str:
+    """Comprime gli spazi: niente indentazione, spazi multipli o righe vuote ripetute."""
+    out: List[str] = []
+    blank = False
+    for line in (text or "").splitlines():
+        line = re.sub(r"[ \t]+", " ", line).strip()
+        if not line:
+            if not blank and out:
+                out.append("")
+            blank = True
+            continue
+        out.append(line)
+        blank = False
+    return "\n".join(out).strip()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class _Asset:
+    def __init__(self, sources: Sequence[Path], compose: Callable[..., str], minify: bool) -> None:
+        self.sources = [Path(p) for p in sources]
+        self.compose = compose
+        self.minify = minify
+        self.compiled: Optional[CompiledPrompt] = None
+        self.signature: Optional[Tuple[Any, ...]] = None
+        self.checked_at = 0.0
+        self.compiled_at = 0.0
+        self.raw_chars = 0
+        self.reloads = 0
+        self.hits = 0
+
+
+class PromptRegistry:
+    """Cache in memoria dei prompt compilati, invalidata per mtime dei file sorgente."""
+
+    def __init__(self, recheck_sec: float = PROMPT_RECHECK_SEC) -> None:
+        self._recheck_sec = recheck_sec
+        self._assets: Dict[str, _Asset] = {}
+        self._lock = threading.Lock()
+
+    def register(
+        self,
+        name: str,
+        sources: Sequence[Path],
+        compose: Callable[..., str],
+        minify: bool = True,
+    ) -> None:
+        """compose riceve il testo di ogni sorgente (None se il file manca), nello stesso ordine."""
+        with self._lock:
+            self._assets[name] = _Asset(sources, compose, minify)
+
+    def registered(self, name: str) -> bool:
+        with self._lock:
+            return name in self._assets
+
+    def get(self, name: str) -> CompiledPrompt:
+        with self._lock:
+            asset = self._assets[name]
+            now = time.monotonic()
+            if asset.compiled is not None and (now - asset.checked_at) < self._recheck_sec:
+                asset.hits += 1
+                return asset.compiled
+
+            signature = self._signature(asset.sources)
+            asset.checked_at = now
+            if asset.compiled is not None and signature == asset.signature:
+                asset.hits += 1
+                return asset.compiled
+
+            self._compile(name, asset, signature)
+            return asset.compiled  # type: ignore[return-value]
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """Forza la ricompilazione al prossimo get (di un asset o di tutti)."""
+        with self._lock:
+            for key, asset in self._assets.items():
+                if name is None or key == name:
+                    asset.compiled = None
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            out: Dict[str, Dict[str, Any]] = {}
+            for name, asset in self._assets.items():
+                c = asset.compiled
+                out[name] = {
+                    "hash": c.hash if c else None,
+                    "tokens_est": c.tokens_est if c else 0,
+                    "chars": c.chars if c else 0,
+                    "raw_chars": asset.raw_chars,
+                    "compiled_at": asset.compiled_at,
+                    "reloads": asset.reloads,
+                    "hits": asset.hits,
+                }
+            return out
+
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _signature(sources: Sequence[Path]) -> Tuple[Any, ...]:
+        sig = []
+        for path in sources:
+            try:
+                st = path.stat()
+                sig.append((str(path), st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append((str(path), None, None))
+        return tuple(sig)
+
+    def _compile(self, name: str, asset: _Asset, signature: Tuple[Any, ...]) -> None:
+        texts: List[Optional[str]] = []
+        for path in asset.sources:
+            try:
+                texts.append(path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                texts.append(None)
+
+        raw = asset.compose(*texts)
+        text = minify_prompt(raw) if asset.minify else raw
+        asset.compiled = CompiledPrompt(
+            text=text,
+            hash=content_hash(text),
+            tokens_est=estimate_tokens(text),
+            chars=len(text),
+        )
+        asset.signature = signature
+        asset.compiled_at = time.time()
+        asset.raw_chars = len(raw)
+        asset.reloads += 1
+        print(
+            f"[PROMPT] '{name}' compilato: hash={asset.compiled.hash} "
+            f"~{asset.compiled.tokens_est} token ({len(raw)} -> {asset.compiled.chars} caratteri)"
+        )
+
+
+# Registro condiviso dall'applicazione
+REGISTRY = PromptRegistry()
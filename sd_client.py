@@ -7,15 +7,30 @@ Client ottimizzato per Stable Diffusion (Automatic1111).
 
 from __future__ import annotations
 
+import asyncio
 import base64
+import json
 import os
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Tuple, List
+from typing import TYPE_CHECKING, Optional, Tuple, List
 
 import requests
 from requests.auth import HTTPBasicAuth
 
+from cost_ledger import LEDGER
+
+# Import morbido: senza aiohttp la versione asincrona usa requests in un thread
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+if TYPE_CHECKING:
+    from deadline import Deadline
+
 
 # ---------------------------------------------------------------------------
 # Config
@@ -33,10 +48,15 @@ SD_OPTIONS_ENDPOINT = f"{SD_URL}/sdapi/v1/options"
 SD_UNLOAD_ENDPOINT = f"{SD_URL}/sdapi/v1/unload-checkpoint"
 SD_RELOAD_ENDPOINT = f"{SD_URL}/sdapi/v1/reload-checkpoint"
 
+# Interrompe la generazione in corso (turno annullato o scaduto)
+SD_INTERRUPT_ENDPOINT = f"{SD_URL}/sdapi/v1/interrupt"
+
 OUTPUT_DIR = Path(_get_env("SD_OUTPUT_DIR", "storage/images"))
 
 # Timeout lungo (tu vuoi 720s)
 TIMEOUT_SECONDS = int(_get_env("SD_TIMEOUT_SECONDS", "720") or "720")
+# L'interrupt è un comando istantaneo: se A1111 non risponde subito, inutile aspettare
+INTERRUPT_TIMEOUT_SECONDS = float(_get_env("SD_INTERRUPT_TIMEOUT_SECONDS", "2") or "2")
 
 # TLS verify (di default True; se proprio ti serve disabilitarlo: SD_VERIFY_TLS=0)
 VERIFY_TLS = _get_env("SD_VERIFY_TLS", "1") not in ("0", "false", "False", "no", "NO")
@@ -77,6 +97,21 @@ def reload_checkpoint() -> bool:
         return False
 
 
+def interrupt() -> bool:
+    """Ferma la generazione in corso: la POST di txt2img ritorna subito (con l'immagine parziale)."""
+    try:
+        r = _SESSION.post(SD_INTERRUPT_ENDPOINT, timeout=INTERRUPT_TIMEOUT_SECONDS, auth=AUTH, verify=VERIFY_TLS)
+        return r.status_code == 200
+    except Exception as e:
+        print(f"[SD] Errore durante l'interrupt: {e}")
+        return False
+
+
+def interrupt_in_background() -> None:
+    """interrupt() in un thread a parte: Deadline.cancel lo chiama dal thread di chi annulla (la GUI)."""
+    threading.Thread(target=interrupt, name="sd-interrupt", daemon=True).start()
+
+
 # ---------------------------------------------------------------------------
 # Healthcheck
 # ---------------------------------------------------------------------------
@@ -139,60 +174,43 @@ def generate_image_from_prompts(
     width: int = 896,
     height: int = 1152,
     seed: int = -1,
+    deadline: Optional[Deadline] = None,
 ) -> Optional[str]:
     """
     Invia la richiesta a Automatic1111 e salva l'immagine.
-    """
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-    payload = {
-        "prompt": positive_prompt,
-        "negative_prompt": negative_prompt,
-        "width": width,
-        "height": height,
-        "seed": seed,
-        "sampler_name": "DPM++ 2M Karras",
-        "steps": 24,
-        "cfg_scale": 7,
-        "batch_size": 1,
-        "n_iter": 1,
-        "restore_faces": False,
-        "tiling": False,
-    }
+    Con un deadline il timeout non supera il tempo rimasto al turno e un annullamento
+    interrompe subito la generazione sul server (niente GPU sprecata su immagini scartate).
+    """
+    if deadline is not None and deadline.expired():
+        print("[SD] Turno scaduto/annullato: salto la generazione.")
+        return None
+    timeout = deadline.timeout(TIMEOUT_SECONDS) if deadline is not None else TIMEOUT_SECONDS
+    payload = _txt2img_payload(positive_prompt, negative_prompt, width, height, seed)
 
     print(f"[SD] URL: {SD_URL}")
     print(f"[SD] Richiesta generazione: {width}x{height}...")
 
+    forget_interrupt = deadline.on_cancel(interrupt_in_background) if deadline is not None else (lambda: None)
+    start = time.monotonic()
     try:
         response = _SESSION.post(
             SD_TXT2IMG_ENDPOINT,
             json=payload,
-            timeout=TIMEOUT_SECONDS,
+            timeout=timeout,
             auth=AUTH,
             verify=VERIFY_TLS,
         )
         response.raise_for_status()
         r = response.json()
+        _record_cost(r, payload, time.monotonic() - start)
 
-        if "images" not in r or not r["images"]:
-            print("[SD] Errore: Nessuna immagine ricevuta dall'API.")
+        if deadline is not None and deadline.cancelled:
+            # Risposta all'interrupt: immagine incompleta, non la salviamo
+            print("[SD] Generazione interrotta (turno annullato).")
             return None
 
-        image_data = r["images"][0]
-        if "," in image_data:
-            image_data = image_data.split(",", 1)[-1]
-
-        image_bytes = base64.b64decode(image_data)
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-        filename = f"scene_{timestamp}.png"
-        filepath = OUTPUT_DIR / filename
-
-        with open(filepath, "wb") as f:
-            f.write(image_bytes)
-
-        print(f"[SD] Immagine salvata correttamente: {filepath}")
-        return str(filepath)
+        return _save_image(r)
 
     except requests.exceptions.HTTPError as e:
         status = getattr(e.response, "status_code", None)
@@ -207,13 +225,132 @@ def generate_image_from_prompts(
         return None
 
     except requests.exceptions.Timeout:
-        print(f"[SD] TIMEOUT dopo {TIMEOUT_SECONDS}s su {SD_URL}.")
+        print(f"[SD] TIMEOUT dopo {timeout:.0f}s su {SD_URL}.")
+        # Il server sta ancora lavorando per un'immagine che nessuno userà
+        interrupt()
         return None
 
     except Exception as e:
         print(f"[SD] Errore generico durante la generazione: {e}")
         return None
 
+    finally:
+        forget_interrupt()
+
+
+def _txt2img_payload(positive_prompt: str, negative_prompt: str, width: int, height: int,
+                     seed: int) -> dict:
+    return {
+        "prompt": positive_prompt,
+        "negative_prompt": negative_prompt,
+        "width": width,
+        "height": height,
+        "seed": seed,
+        "sampler_name": "DPM++ 2M Karras",
+        "steps": 24,
+        "cfg_scale": 7,
+        "batch_size": 1,
+        "n_iter": 1,
+        "restore_faces": False,
+        "tiling": False,
+    }
+
+
+def _record_cost(r: dict, payload: dict, seconds: float) -> None:
+    """Steps e dimensioni reali dal blocco "info" di A1111 (stringa JSON); se manca, dal payload."""
+    try:
+        info = json.loads(r.get("info") or "{}")
+    except (TypeError, ValueError):
+        info = {}
+    if not isinstance(info, dict):
+        info = {}
+    LEDGER.record_sd(
+        steps=int(info.get("steps") or payload["steps"]),
+        width=int(info.get("width") or payload["width"]),
+        height=int(info.get("height") or payload["height"]),
+        seconds=seconds,
+    )
+
+
+def _save_image(r: dict) -> Optional[str]:
+    """Decodifica la prima immagine della risposta txt2img e la salva in OUTPUT_DIR."""
+    if "images" not in r or not r["images"]:
+        print("[SD] Errore: Nessuna immagine ricevuta dall'API.")
+        return None
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    image_data = r["images"][0]
+    if "," in image_data:
+        image_data = image_data.split(",", 1)[-1]
+
+    image_bytes = base64.b64decode(image_data)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    filename = f"scene_{timestamp}.png"
+    filepath = OUTPUT_DIR / filename
+
+    with open(filepath, "wb") as f:
+        f.write(image_bytes)
+
+    print(f"[SD] Immagine salvata correttamente: {filepath}")
+    return str(filepath)
+
+
+async def generate_image_from_prompts_async(
+    positive_prompt: str,
+    negative_prompt: str,
+    width: int = 896,
+    height: int = 1152,
+    seed: int = -1,
+    deadline: Optional[Deadline] = None,
+) -> Optional[str]:
+    """Versione asincrona (aiohttp). Se il task viene cancellato interrompe la generazione sul server."""
+    if aiohttp is None:
+        return await asyncio.to_thread(
+            generate_image_from_prompts, positive_prompt, negative_prompt, width, height, seed, deadline
+        )
+    if deadline is not None and deadline.expired():
+        print("[SD] Turno scaduto/annullato: salto la generazione.")
+        return None
+    timeout = deadline.timeout(TIMEOUT_SECONDS) if deadline is not None else TIMEOUT_SECONDS
+    payload = _txt2img_payload(positive_prompt, negative_prompt, width, height, seed)
+    auth = aiohttp.BasicAuth(AUTH.username, AUTH.password) if AUTH else None
+
+    print(f"[SD] URL: {SD_URL}")
+    print(f"[SD] Richiesta generazione (async): {width}x{height}...")
+
+    start = time.monotonic()
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout), auth=auth) as session:
+            async with session.post(SD_TXT2IMG_ENDPOINT, json=payload, ssl=None if VERIFY_TLS else False) as response:
+                if response.status >= 400:
+                    print(f"[SD] HTTP error: status={response.status}")
+                    print(f"[SD] Risposta (prime 400): {(await response.text())[:400]}")
+                    return None
+                r = await response.json()
+        _record_cost(r, payload, time.monotonic() - start)
+        if deadline is not None and deadline.cancelled:
+            print("[SD] Generazione interrotta (turno annullato).")
+            return None
+        return await asyncio.to_thread(_save_image, r)
+
+    except asyncio.CancelledError:
+        # Turno annullato: liberiamo la GPU prima di propagare la cancellazione
+        await asyncio.to_thread(interrupt)
+        raise
+
+    except asyncio.TimeoutError:
+        print(f"[SD] TIMEOUT dopo {timeout:.0f}s su {SD_URL}.")
+        await asyncio.to_thread(interrupt)
+        return None
+
+    except aiohttp.ClientConnectionError:
+        print(f"[SD] ERRORE: Impossibile connettersi a {SD_URL}.")
+        return None
+
+    except Exception as e:
+        print(f"[SD] Errore generico durante la generazione: {e}")
+        return None
 
 if __name__ == "__main__":
     print("[SD] check_connection():", check_connection())
\ No newline at end of file
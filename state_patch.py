@@ -0,0 +1,134 @@
+# file: state_patch.py
+"""
+Patch di stato in stile JSON-Patch (RFC 6902, sottoinsieme add/replace/remove).
+
+Il DM invece di ricopiare 'new_state' per intero emette solo i cambiamenti:
+    [{"op": "replace", "path": "/flags/porta_aperta", "value": true},
+     {"op": "add", "path": "/quest_log/-", "value": "Trovare la chiave"},
+     {"op": "remove", "path": "/quest_log/0"}]
+
+Le radici delle meccaniche (mechanics.MECHANICS_FIELDS: turno, oro, inventario,
+affinità) non passano da qui: il motore scarta quelle operazioni (strip_owned_ops)
+e il DM le chiede con gli "intents".
+
+Ogni operazione è validata singolarmente: quelle non valide vengono scartate
+(e loggate) senza buttare via il resto del turno.
+"""
+from __future__ import annotations
+
+import copy
+from typing import Any, Dict, List, Tuple
+
+ALLOWED_OPS = ("add", "replace", "remove")
+
+# Radici che il modello non può toccare (gestite da GUI/motore)
+PROTECTED_ROOTS = ("recent_dialogue", "recent_changes")
+
+# Oltre questo numero di operazioni la patch è sospetta: teniamo le prime
+MAX_OPS = 40
+
+
+class PatchError(ValueError):
+    pass
+
+
+def parse_pointer(path: Any) -> List[str]:
+    """'/a/b~1c' -> ['a', 'b/c'] (JSON Pointer, RFC 6901)."""
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise PatchError(f"path non valido: {path!r}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+
+def _list_index(container: List[Any], token: str, allow_end: bool) -> int:
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit():
+        raise PatchError(f"indice di lista non valido: {token!r}")
+    idx = int(token)
+    limit = len(container) if allow_end else len(container) - 1
+    if idx > limit:
+        raise PatchError(f"indice fuori range: {idx}")
+    return idx
+
+
+def _apply_op(state: Dict[str, Any], op: Dict[str, Any]) -> str:
+    """Applica UNA operazione in place. Restituisce la radice toccata."""
+    if not isinstance(op, dict):
+        raise PatchError("operazione non è un oggetto")
+    kind = op.get("op")
+    if kind not in ALLOWED_OPS:
+        raise PatchError(f"op non supportata: {kind!r}")
+    tokens = parse_pointer(op.get("path"))
+    root = tokens[0]
+    if not root:
+        raise PatchError("path vuoto")
+    if root in PROTECTED_ROOTS:
+        raise PatchError(f"'{root}' non è modificabile dal DM")
+    if kind != "remove" and "value" not in op:
+        raise PatchError(f"'{kind}' senza value")
+    if kind == "remove" and len(tokens) == 1:
+        raise PatchError(f"non si può rimuovere la radice '{root}'")
+
+    parent: Any = state
+    for token in tokens[:-1]:
+        if isinstance(parent, dict):
+            if token not in parent:
+                raise PatchError(f"percorso inesistente: {op.get('path')}")
+            parent = parent[token]
+        elif isinstance(parent, list):
+            parent = parent[_list_index(parent, token, allow_end=False)]
+        else:
+            raise PatchError(f"percorso attraversa un valore scalare: {op.get('path')}")
+
+    last = tokens[-1]
+    value = copy.deepcopy(op.get("value"))
+
+    if isinstance(parent, dict):
+        if kind == "remove":
+            if last not in parent:
+                raise PatchError(f"chiave inesistente: {op.get('path')}")
+            del parent[last]
+        else:
+            # 'replace' su chiave mancante: il modello la usa spesso come 'add', la accettiamo
+            parent[last] = value
+    elif isinstance(parent, list):
+        if kind == "add":
+            parent.insert(_list_index(parent, last, allow_end=True), value)
+        elif kind == "replace":
+            parent[_list_index(parent, last, allow_end=False)] = value
+        else:
+            del parent[_list_index(parent, last, allow_end=False)]
+    else:
+        raise PatchError(f"il genitore di {op.get('path')} non è un contenitore")
+
+    return root
+
+
+def apply_state_patch(state: Dict[str, Any], ops: Any) -> Tuple[Dict[str, Any], List[str], List[str]]:
+    """Applica la patch a una COPIA dello stato.
+
+    Restituisce (stato_patchato, radici_toccate, errori).
+    """
+    patched = copy.deepcopy(state)
+    touched: List[str] = []
+    errors: List[str] = []
+
+    if not isinstance(ops, list):
+        return patched, touched, ["state_patch non è una lista"]
+    if len(ops) > MAX_OPS:
+        errors.append(f"troppe operazioni ({len(ops)}), tengo le prime {MAX_OPS}")
+        ops = ops[:MAX_OPS]
+
+    for op in ops:
+        # Ogni op lavora su una copia: se fallisce a metà lo stato resta coerente
+        trial = copy.deepcopy(patched)
+        try:
+            root = _apply_op(trial, op)
+        except (PatchError, TypeError) as e:
+            errors.append(f"{op}: {e}")
+            continue
+        patched = trial
+        if root not in touched:
+            touched.append(root)
+
+    return patched, touched, errors
@@ -0,0 +1,231 @@
+# file: story_summarizer.py
+"""
+Riassunto della storia in background, fuori dal percorso critico del turno.
+
+Ogni STORY_SUMMARY_EVERY turni la GUI chiede a SUMMARIZER di compattare la
+memoria: la coda del dialogo + il riassunto precedente vanno a un modello
+economico (STORY_SUMMARY_MODEL) in un thread a parte. Il risultato
+(story_summary + memoria per NPC) resta "in attesa" finché la GUI non lo
+applica allo stato con apply_pending(), prima del turno successivo.
+
+Così il DM non deve più riscrivere story_summary a ogni turno (uno dei campi
+di output più lunghi): vedi dm_client.MEMORY_INSTRUCTION.
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from llm_client import call_llm
+
+# Attivo = il DM non scrive più story_summary (lo fa questo modulo)
+STORY_SUMMARY_BACKGROUND = os.getenv("STORY_SUMMARY_BACKGROUND", "1").strip().lower() in ("1", "true", "yes", "on")
+STORY_SUMMARY_EVERY = max(1, int(os.getenv("STORY_SUMMARY_EVERY", "4") or "4"))
+STORY_SUMMARY_MODEL = os.getenv("STORY_SUMMARY_MODEL", "gemini-2.5-flash-lite").strip() or None
+STORY_SUMMARY_MAX_WORDS = int(os.getenv("STORY_SUMMARY_MAX_WORDS", "200") or "200")
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain the long-term memory of an interactive story (Italian RPG)."
+    "\nYou receive the previous summary, the NPC memories and the latest dialogue."
+    "\nReturn ONLY a JSON object:"
+    '\n  {"story_summary": "...", "npc_memories": [{"name": "...", "memory": "..."}]}'
+    f"\n- story_summary: Italian, max {STORY_SUMMARY_MAX_WORDS} words. Merge the new events into the previous"
+    " summary; keep plot facts, promises, secrets discovered and relationship changes; drop small talk."
+    "\n- npc_memories: ONLY for NPCs whose relationship with the player changed in the dialogue;"
+    " one or two Italian sentences each, replacing their previous memory."
+    "\nNever invent events that are not in the input."
+)
+
+# Contatore di affinità in testa a npc_memory_text (vedi prompt di sistema, "AFFINITY ACCOUNTING")
+_STATS_PREFIX_RE = re.compile(r"^\s*\[STATS:[^\]]*\]\s*\|?\s*", re.IGNORECASE)
+
+SUMMARY_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "story_summary": {"type": "string"},
+        "npc_memories": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": {"type": "string"}, "memory": {"type": "string"}},
+                "required": ["name", "memory"],
+            },
+        },
+    },
+    "required": ["story_summary"],
+}
+
+
+def _npc_memories(game_state: Dict[str, Any]) -> Dict[str, str]:
+    memories: Dict[str, str] = {}
+    storage = game_state.get("npc_storage")
+    if isinstance(storage, dict):
+        for name, data in storage.items():
+            if isinstance(data, dict) and data.get("memory"):
+                memories[str(name)] = str(data["memory"])
+    active = str(game_state.get("companion_name") or "")
+    if active:
+        # La memoria della compagna attiva vive in npc_memory_text, non nel DB
+        memories[active] = str(game_state.get("npc_memory_text") or memories.get(active, ""))
+    return memories
+
+
+def _parse_summary(content: Optional[str]) -> Optional[Dict[str, Any]]:
+    try:
+        data = json.loads(content or "")
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not str(data.get("story_summary") or "").strip():
+        return None
+    words = str(data["story_summary"]).split()
+    memories = {}
+    for item in data.get("npc_memories") or []:
+        if isinstance(item, dict) and str(item.get("name") or "").strip() and str(item.get("memory") or "").strip():
+            memories[str(item["name"]).strip()] = str(item["memory"]).strip()
+    return {
+        # Cap di sicurezza: il modello a volte sfora il limite di parole
+        "story_summary": " ".join(words[:STORY_SUMMARY_MAX_WORDS * 2]),
+        "npc_memories": memories,
+    }
+
+
+def _with_stats_prefix(current: str, memory: str) -> str:
+    """Nuova memoria della compagna, tenendo il [STATS: ...] attuale in testa."""
+    match = _STATS_PREFIX_RE.match(current or "")
+    if not match:
+        return memory
+    memory = _STATS_PREFIX_RE.sub("", memory, count=1).strip()
+    return f"{match.group(0).strip().rstrip('|').strip()} | {memory}"
+
+
+def apply_summary(game_state: Dict[str, Any], update: Dict[str, Any]) -> List[str]:
+    """Fonde il risultato nello stato IN PLACE. Restituisce i campi aggiornati.
+
+    update["base"] sono i valori dell'istantanea da cui è nato il riassunto: un campo
+    che il DM ha cambiato nel frattempo non viene toccato (vince l'aggiornamento più recente).
+    """
+    base = update.get("base")
+    changed, skipped = [], []
+
+    def unchanged(field: str, current: Any, snapshot: Optional[str]) -> bool:
+        if base is None or str(current or "") == str(snapshot or ""):
+            return True
+        skipped.append(field)
+        return False
+
+    if update.get("story_summary") and unchanged(
+            "story_summary", game_state.get("story_summary"), (base or {}).get("story_summary")):
+        game_state["story_summary"] = update["story_summary"]
+        changed.append("story_summary")
+
+    active = str(game_state.get("companion_name") or "")
+    storage = game_state.get("npc_storage") if isinstance(game_state.get("npc_storage"), dict) else {}
+    snapshot = (base or {}).get("npc_memories") or {}
+    for name, memory in (update.get("npc_memories") or {}).items():
+        if name == active:
+            current = str(game_state.get("npc_memory_text") or "")
+            if unchanged("npc_memory_text", current, snapshot.get(name)):
+                game_state["npc_memory_text"] = _with_stats_prefix(current, memory)
+                changed.append("npc_memory_text")
+        elif isinstance(storage.get(name), dict):
+            if unchanged(f"npc_storage.{name}", storage[name].get("memory"), snapshot.get(name)):
+                storage[name]["memory"] = memory
+                changed.append(f"npc_storage.{name}")
+        # NPC sconosciuti: ignorati (non creiamo personaggi dal riassunto)
+    if skipped:
+        print(f"[SUMMARY] Campi cambiati dal DM durante il riassunto, lasciati com'erano: {', '.join(skipped)}")
+    return changed
+
+
+class StorySummarizer:
+    """Un solo riassunto alla volta; il risultato attende apply_pending()."""
+
+    def __init__(self, every: int = STORY_SUMMARY_EVERY, enabled: bool = STORY_SUMMARY_BACKGROUND) -> None:
+        self.every = every
+        self.enabled = enabled
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="story-summary")
+        self._lock = threading.Lock()
+        self._running = False
+        self._pending: Optional[Dict[str, Any]] = None
+        self._last_turn: Optional[int] = None
+        # Cambia a ogni reset(): i risultati di una sessione precedente vengono scartati
+        self._generation = 0
+
+    def reset(self, turn: Optional[int] = None) -> None:
+        """Nuova sessione (o sessione caricata): dimentica risultati e conteggio."""
+        with self._lock:
+            self._generation += 1
+            self._pending = None
+            self._last_turn = turn
+
+    def maybe_schedule(self, game_state: Dict[str, Any], recent_dialogue: List[Dict[str, str]]) -> bool:
+        """Avvia il riassunto se sono passati abbastanza turni. Non blocca mai."""
+        if not self.enabled:
+            return False
+        try:
+            turn = int(game_state.get("turn") or 0)
+        except (TypeError, ValueError):
+            return False
+        with self._lock:
+            if self._last_turn is None:
+                self._last_turn = turn - 1
+            if self._running or turn - self._last_turn < self.every:
+                return False
+            self._running = True
+            self._last_turn = turn
+            generation = self._generation
+
+        # Istantanea presa nel thread della GUI: il thread di lavoro non tocca game_state
+        summary_input = {
+            "previous_summary": str(game_state.get("story_summary") or ""),
+            "main_quest": str(game_state.get("main_quest") or ""),
+            "current_act": str(game_state.get("current_act") or ""),
+            "npc_memories": _npc_memories(game_state),
+            "dialogue": [dict(d) for d in recent_dialogue if isinstance(d, dict)],
+        }
+        print(f"[SUMMARY] Turno {turn}: riassunto in background ({len(summary_input['dialogue'])} battute).")
+        self._pool.submit(self._run, summary_input, generation, turn)
+        return True
+
+    def _run(self, summary_input: Dict[str, Any], generation: int, turn: int) -> None:
+        try:
+            response = call_llm(SUMMARY_SYSTEM_PROMPT, json.dumps(summary_input, ensure_ascii=False),
+                                model=STORY_SUMMARY_MODEL, response_schema=SUMMARY_RESPONSE_SCHEMA,
+                                temperature=0.3, priority="background")
+            update = None if response.get("error") else _parse_summary(response.get("content"))
+            if update is None:
+                print(f"[SUMMARY] Riassunto fallito ({response.get('error') or 'risposta non valida'}): resta il precedente.")
+                return
+            with self._lock:
+                if generation == self._generation:
+                    update["turn"] = turn
+                    update["base"] = {"story_summary": summary_input["previous_summary"],
+                                      "npc_memories": summary_input["npc_memories"]}
+                    self._pending = update
+            print(f"[SUMMARY] Pronto: {len(update['story_summary'].split())} parole, "
+                  f"memorie NPC: {sorted(update['npc_memories']) or '—'}")
+        except Exception as e:
+            print(f"[SUMMARY] Errore: {e}")
+        finally:
+            with self._lock:
+                self._running = False
+
+    def apply_pending(self, game_state: Dict[str, Any]) -> List[str]:
+        """Applica (nel thread del chiamante) l'ultimo riassunto pronto, se c'è."""
+        with self._lock:
+            update, self._pending = self._pending, None
+        if not update:
+            return []
+        changed = apply_summary(game_state, update)
+        print(f"[SUMMARY] Applicato il riassunto del turno {update.get('turn')}: {', '.join(changed)}")
+        return changed
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+SUMMARIZER = StorySummarizer()
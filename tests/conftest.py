@@ -0,0 +1,30 @@
+# file: tests/conftest.py
+"""
+Configurazione comune dei test: motore offline.
+
+- LLM_BACKENDS=stub: nessuna rete, risposta del DM da tests/data/stub_turn.json;
+- COST_LEDGER=0: niente righe nel registro dei costi;
+- LLM_CACHE_MODE=passthrough: nessuna registrazione in storage/.
+Le variabili vanno impostate PRIMA di importare i moduli (leggono l'ambiente all'import).
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+DATA = Path(__file__).resolve().parent / "data"
+
+sys.path.insert(0, str(ROOT))
+os.environ["LLM_BACKENDS"] = "stub"
+os.environ["LLM_STUB_RESPONSE_PATH"] = str(DATA / "stub_turn.json")
+os.environ["LLM_STUB_DELAY_SEC"] = "0"
+os.environ["COST_LEDGER"] = "0"
+os.environ["LLM_CACHE_MODE"] = "passthrough"
+
+
+@pytest.fixture(autouse=True)
+def _repo_cwd(monkeypatch):
+    # Prompt e campagna sono percorsi relativi alla radice del progetto
+    monkeypatch.chdir(ROOT)
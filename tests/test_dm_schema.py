@@ -0,0 +1,37 @@
+# file: tests/test_dm_schema.py
+from dm_schema import validate_dm_response
+
+
+def test_valid_response_passes_unchanged():
+    data = {"reply_it": "Ciao", "tags_en": ["a"], "image_subject": "Luna", "state_patch": []}
+    resp, errors = validate_dm_response(data)
+    assert errors == []
+    assert resp["reply_it"] == "Ciao" and resp["tags_en"] == ["a"] and resp["image_subject"] == "Luna"
+
+
+def test_fields_are_coerced():
+    resp, errors = validate_dm_response({"reply_it": "  Ciao  ", "tags_en": "smile", "image_subject": ""})
+    assert errors == []
+    assert resp["reply_it"] == "Ciao"
+    assert resp["tags_en"] == ["smile"]  # elemento singolo -> lista
+    assert resp["image_subject"] is None  # stringa vuota = nessuna immagine
+
+
+def test_invalid_field_is_dropped_not_fatal():
+    resp, errors = validate_dm_response({"reply_it": "Ciao", "tags_en": [1, {"x": 1}, "ok"], "visual_en": {"no": 1}})
+    assert "visual_en" not in resp
+    assert len(errors) == 1 and errors[0].startswith("visual_en")
+    assert resp["tags_en"] == ["1", "ok"]
+
+
+def test_missing_reply():
+    resp, errors = validate_dm_response({"tags_en": ["a"]})
+    assert dict(resp) == {} and "reply_it mancante" in errors
+
+    resp, errors = validate_dm_response({"tags_en": ["a"]}, require_reply=False)
+    assert resp["tags_en"] == ["a"] and errors == []
+
+
+def test_not_an_object():
+    resp, errors = validate_dm_response(["reply_it"])
+    assert dict(resp) == {} and "list" in errors[0]
@@ -0,0 +1,50 @@
+# file: tests/test_json_stream.py
+import json
+
+from json_stream import JsonFieldStream
+
+RESPONSE = {
+    "reply_it": "Luna sorride: \"vieni\" è l'unica parola.",
+    "state_patch": [{"op": "replace", "path": "/location", "value": "Aula"}],
+    "gold": 5,
+    "ok": True,
+    "image_subject": None,
+    "tags_en": ["a", "b"],
+}
+
+
+def _feed(text, size, **kwargs):
+    partial, fields = [], []
+    reader = JsonFieldStream(on_partial=lambda _k, t: partial.append(t),
+                             on_field=lambda k, v: fields.append((k, v)), **kwargs)
+    for i in range(0, len(text), size):
+        reader.feed(text[i : i + size])
+    return reader, "".join(partial), fields
+
+
+def test_fields_and_partial_text_at_any_chunk_size():
+    text = json.dumps(RESPONSE, ensure_ascii=False)
+    for size in (1, 3, 7, len(text)):
+        reader, partial, fields = _feed(text, size)
+        assert reader.fields == RESPONSE
+        assert partial == RESPONSE["reply_it"]
+        assert [k for k, _v in fields] == list(RESPONSE)
+
+
+def test_escapes_split_across_chunks():
+    text = json.dumps({"reply_it": "caffè \U0001F600 fine"})  # ensure_ascii: è e coppia surrogata
+    _reader, partial, _fields = _feed(text, 1)
+    assert partial == "caffè \U0001F600 fine"
+
+
+def test_code_fence_and_trailing_text_are_ignored():
+    text = "```json\n" + json.dumps({"a": 1, "b": {"c": [1, 2]}}) + "\n```\naltro {\"x\": 2}"
+    reader, _partial, _fields = _feed(text, 5, partial_keys=())
+    assert reader.fields == {"a": 1, "b": {"c": [1, 2]}}
+
+
+def test_truncated_stream_keeps_complete_fields():
+    text = json.dumps(RESPONSE)
+    reader, _partial, _fields = _feed(text[: text.index('"tags_en"') + 14], 4)
+    assert "tags_en" not in reader.fields
+    assert reader.fields["gold"] == 5 and reader.fields["image_subject"] is None
@@ -0,0 +1,70 @@
+# file: tests/test_llm_backends.py
+import json
+
+import pytest
+
+import llm_backends
+from llm_backends import BackendRouter, LLMBackend, StubBackend
+
+
+class _Fake(LLMBackend):
+    def __init__(self, name, available=True):
+        self.name = name
+        self._available = available
+
+    def available(self):
+        return self._available
+
+
+@pytest.fixture(autouse=True)
+def _no_probe(monkeypatch):
+    # Nessuno scambio periodico: l'ordine dipende solo da latenza e salute
+    monkeypatch.setattr(llm_backends, "ROUTER_PROBE_EVERY", 0)
+
+
+def _names(router, kind="call"):
+    return [b.name for b in router.candidates(kind)]
+
+
+def test_untried_first_then_fastest():
+    router = BackendRouter([_Fake("a"), _Fake("b"), _Fake("off", available=False)])
+    assert _names(router) == ["a", "b"]
+    router.record("a", 2.0, ok=True)
+    assert _names(router) == ["b", "a"]  # latenza ignota = da campionare subito
+    router.record("b", 0.5, ok=True)
+    assert _names(router) == ["b", "a"]
+    # Latenze separate per chiamata intera e primo pezzo dello stream
+    router.record("a", 0.1, ok=True, kind="stream")
+    router.record("b", 0.3, ok=True, kind="stream")
+    assert _names(router, "stream") == ["a", "b"]
+
+
+def test_failing_backend_goes_last_until_cooldown(monkeypatch):
+    router = BackendRouter([_Fake("a"), _Fake("b")])
+    router.record("a", 0.1, ok=True)
+    router.record("b", 1.0, ok=True)
+    for _ in range(3):
+        router.record("a", None, ok=False)
+    assert _names(router) == ["b", "a"]
+    assert router.stats()["a"]["healthy"] is False
+
+    monkeypatch.setattr(llm_backends, "ROUTER_COOLDOWN_SEC", 0.0)
+    assert _names(router) == ["a", "b"]
+
+
+def test_few_errors_do_not_mark_sick():
+    router = BackendRouter([_Fake("a"), _Fake("b")])
+    router.record("a", 0.1, ok=True)
+    router.record("b", 1.0, ok=True)
+    router.record("a", None, ok=False)
+    assert _names(router) == ["a", "b"]
+
+
+def test_stub_backend_contracts(tmp_path):
+    path = tmp_path / "r.json"
+    path.write_text(json.dumps({"reply_it": "Ciao", "tags_en": []}), encoding="utf-8")
+    stub = StubBackend(response_path=str(path), delay_sec=0, chunk_chars=2)
+    assert json.loads(stub.generate("s", "u")) == {"reply_it": "Ciao", "tags_en": []}
+    assert stub.generate("s", "u", response_mime_type="text/plain") == "Ciao"
+    assert "".join(stub.stream("s", "u", response_mime_type="text/plain")) == "Ciao"
+    assert json.loads(StubBackend(response_path="", delay_sec=0).generate("s", "u"))["reply_it"]
@@ -0,0 +1,89 @@
+# file: tests/test_llm_cache.py
+"""Registrazione / riproduzione delle chiamate LLM (llm_cache) in una cartella temporanea."""
+import os
+
+import llm_client
+from llm_cache import LLMCache, StreamRecorder, fingerprint
+
+
+def test_fingerprint_is_stable_and_ignores_volatile_params():
+    base = fingerprint("sys", '{"a": 1}', "m", {"temperature": 0.7, "response_mime_type": "text/plain"})
+    assert base == fingerprint("sys", '{"a": 1}', "m", {"response_mime_type": "text/plain", "temperature": 0.7})
+    assert base == fingerprint("sys", '{"a": 1}', "m", {"temperature": 0.7, "response_mime_type": "text/plain",
+                                                        "timeout_sec": 5, "deadline": object(),
+                                                        "priority": "background", "cost_source": "hedge"})
+    assert base != fingerprint("sys", '{"a": 2}', "m", {"temperature": 0.7, "response_mime_type": "text/plain"})
+    assert base != fingerprint("sys", '{"a": 1}', "altro", {"temperature": 0.7, "response_mime_type": "text/plain"})
+    assert base != fingerprint("sys", '{"a": 1}', "m", {"temperature": 0.2, "response_mime_type": "text/plain"})
+
+
+def test_record_then_replay_stream(tmp_path):
+    recorder = StreamRecorder(None)
+    for piece in ("Luna ", "apre ", "la porta."):
+        recorder(piece)
+    LLMCache("record", tmp_path).record("ab" * 32, {"content": "Luna apre la porta.", "error": None},
+                                        model="m", chunks=recorder.chunks)
+
+    cache = LLMCache("replay", tmp_path)
+    pieces = []
+    result = cache.replay("ab" * 32, on_chunk=pieces.append, sleep=lambda _s: None)
+    assert result == {"content": "Luna apre la porta.", "error": None}
+    assert pieces == ["Luna ", "apre ", "la porta."]
+    assert cache.stats()["hits"] == 1
+
+
+def test_errors_and_empty_results_are_not_recorded(tmp_path):
+    cache = LLMCache("record", tmp_path)
+    cache.record("cd" * 32, {"content": None, "error": "boom"})
+    cache.record("ef" * 32, {"content": "", "error": None})
+    assert cache.stats()["recorded"] == 0
+    assert not list(tmp_path.glob("*/*.json"))
+
+
+def test_replay_miss_is_an_error(tmp_path):
+    cache = LLMCache("replay", tmp_path)
+    result = cache.replay("00" * 32, on_chunk=lambda _p: None)
+    assert result["content"] is None and "nessuna registrazione" in result["error"]
+    assert cache.stats()["misses"] == 1
+
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    content = {"content": "x" * 400, "error": None}
+    keys = [f"{i:02d}" * 32 for i in range(3)]
+    cache = LLMCache("record", tmp_path)
+    for age, key in zip((300, 200, 100), keys):
+        cache.record(key, content)
+        path = cache._path(key)
+        os.utime(path, (path.stat().st_atime - age, path.stat().st_mtime - age))
+    # Spazio per tre voci: la quarta ne fa uscire una
+    cache.max_bytes = cache.stats()["bytes"] + 10
+    # Una lettura rende la voce più vecchia la più recente
+    assert cache.get(keys[0]) is not None
+
+    cache.record("99" * 32, content)
+    assert cache.stats()["evicted"] == 1
+    assert cache.get(keys[1]) is None  # la meno usata
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache.get("99" * 32) is not None
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_call_llm_stream_records_and_replays(tmp_path, monkeypatch):
+    # Prima passata col backend stub in registrazione, seconda in replay: stessi pezzi, nessuna chiamata
+    monkeypatch.setattr(llm_client, "LLM_CACHE", LLMCache("record", tmp_path))
+    recorded = []
+    first = llm_client.call_llm_stream("sys", '{"turno": 1}', on_chunk=recorded.append,
+                                       response_mime_type="text/plain")
+    assert first["error"] is None and first["content"] and recorded
+
+    monkeypatch.setattr(llm_client, "LLM_CACHE", LLMCache("replay", tmp_path))
+    monkeypatch.setattr(llm_client._backend_router, "candidates", lambda *_a, **_k: [])
+    replayed = []
+    second = llm_client.call_llm_stream("sys", '{"turno": 1}', on_chunk=replayed.append,
+                                        response_mime_type="text/plain", timeout_sec=3)
+    assert second == {"content": first["content"], "error": None}
+    assert replayed == recorded
+
+    miss = llm_client.call_llm_stream("sys", '{"turno": 2}', on_chunk=lambda _p: None,
+                                      response_mime_type="text/plain")
+    assert miss["content"] is None and miss["error"]
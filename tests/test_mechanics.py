@@ -0,0 +1,76 @@
+# file: tests/test_mechanics.py
+from mechanics import (
+    AFFINITY_MAX,
+    MAX_AFFINITY_STEP,
+    MAX_GOLD_STEP,
+    advance_turn,
+    apply_intents,
+    strip_owned_fields,
+    strip_owned_ops,
+)
+
+
+def test_items_gold_and_affinity():
+    state = {"gold": 10, "inventory": ["Corda"], "affinity_scores": {"Luna": 5}}
+    applied, errors = apply_intents(state, [
+        {"gain_item": ["torcia", "chiave"]},
+        {"lose_item": "corda"},  # confronto senza maiuscole
+        {"gold": "+7"},
+        {"affinity": {"Luna": 2, "Maria": -1}},
+    ])
+    assert errors == []
+    assert state["inventory"] == ["torcia", "chiave"]
+    assert state["gold"] == 17
+    assert state["affinity_scores"] == {"Luna": 7, "Maria": -1}
+    assert applied[0] == "+torcia"
+
+
+def test_single_dict_with_several_keys():
+    state = {}
+    applied, errors = apply_intents(state, {"gold": 3, "gain_item": "pane"})
+    assert errors == [] and len(applied) == 2
+    assert state == {"gold": 3, "inventory": ["pane"], "affinity_scores": {}}
+
+
+def test_steps_are_clamped():
+    state = {"gold": 0, "affinity_scores": {"Luna": AFFINITY_MAX - 1}}
+    apply_intents(state, [{"gold": MAX_GOLD_STEP * 10}, {"affinity": {"Luna": MAX_AFFINITY_STEP * 5}}])
+    assert state["gold"] == MAX_GOLD_STEP
+    assert state["affinity_scores"]["Luna"] == AFFINITY_MAX
+
+    apply_intents(state, [{"gold": -MAX_GOLD_STEP * 10}])
+    assert state["gold"] == 0
+
+
+def test_invalid_intents_are_reported_not_applied():
+    state = {"gold": 1, "inventory": []}
+    applied, errors = apply_intents(state, [
+        {"lose_item": "spada"},
+        {"gold": "molto"},
+        {"gold": True},
+        {"affinity": 3},
+        {"teleport": "altrove"},
+    ])
+    assert applied == []
+    assert len(errors) == 5
+    assert state["gold"] == 1 and state["inventory"] == []
+    assert apply_intents(state, "non una lista") == ([], [])
+
+
+def test_advance_turn():
+    state = {"turn": "4"}
+    advance_turn(state)
+    assert state["turn"] == 5
+    state = {"turn": "boh"}
+    advance_turn(state)
+    assert state["turn"] == 1
+
+
+def test_owned_fields_are_stripped():
+    clean, dropped = strip_owned_fields({"gold": 99, "location": "Aula", "turn": 7})
+    assert clean == {"location": "Aula"} and sorted(dropped) == ["gold", "turn"]
+
+    ops = [{"op": "replace", "path": "/affinity_scores/Luna", "value": 12},
+           {"op": "replace", "path": "/flags/porta_aperta", "value": True}]
+    kept, dropped = strip_owned_ops(ops)
+    assert kept == ops[1:] and dropped == ["/affinity_scores/Luna"]
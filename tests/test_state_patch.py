@@ -0,0 +1,60 @@
+# file: tests/test_state_patch.py
+from state_patch import MAX_OPS, apply_state_patch, parse_pointer
+
+
+def _state():
+    return {"location": "Celle", "flags": {"porta_aperta": False}, "quest_log": ["a", "b"],
+            "recent_changes": [[]]}
+
+
+def test_parse_pointer_unescapes():
+    assert parse_pointer("/a/b~1c/d~0e") == ["a", "b/c", "d~e"]
+
+
+def test_add_replace_remove():
+    state = _state()
+    ops = [
+        {"op": "replace", "path": "/flags/porta_aperta", "value": True},
+        {"op": "add", "path": "/quest_log/-", "value": "c"},
+        {"op": "remove", "path": "/quest_log/0"},
+        {"op": "replace", "path": "/location", "value": "Corridoio"},
+    ]
+    patched, touched, errors = apply_state_patch(state, ops)
+    assert errors == []
+    assert patched["flags"]["porta_aperta"] is True
+    assert patched["quest_log"] == ["b", "c"]
+    assert patched["location"] == "Corridoio"
+    assert touched == ["flags", "quest_log", "location"]
+    assert state == _state()  # lavora su una copia
+
+
+def test_replace_on_missing_key_acts_as_add():
+    patched, touched, errors = apply_state_patch(_state(), [{"op": "replace", "path": "/flags/nuovo", "value": 1}])
+    assert patched["flags"]["nuovo"] == 1 and touched == ["flags"] and errors == []
+
+
+def test_invalid_ops_are_dropped_individually():
+    ops = [
+        {"op": "move", "path": "/location", "from": "/x"},
+        {"op": "replace", "path": "/recent_changes", "value": []},
+        {"op": "remove", "path": "/flags/assente"},
+        {"op": "replace", "path": "/quest_log/9", "value": "z"},
+        {"op": "add", "path": "/flags/x"},
+        {"op": "remove", "path": "/quest_log"},
+        "non un oggetto",
+        {"op": "replace", "path": "/location", "value": "Corridoio"},
+    ]
+    patched, touched, errors = apply_state_patch(_state(), ops)
+    assert len(errors) == len(ops) - 1
+    assert patched["location"] == "Corridoio" and touched == ["location"]
+    assert patched["recent_changes"] == [[]]
+
+
+def test_non_list_and_too_many_ops():
+    _patched, touched, errors = apply_state_patch(_state(), {"op": "replace"})
+    assert touched == [] and errors == ["state_patch non è una lista"]
+
+    ops = [{"op": "add", "path": "/quest_log/-", "value": i} for i in range(MAX_OPS + 5)]
+    patched, _touched, errors = apply_state_patch(_state(), ops)
+    assert len(patched["quest_log"]) == 2 + MAX_OPS
+    assert "troppe operazioni" in errors[0]
@@ -0,0 +1,37 @@
+# file: tests/test_turn_stub.py
+"""Turno completo con il backend stub: nessuna rete, niente SD né TTS."""
+import pytest
+
+import dm_engine
+from game_state import create_initial_game_state
+
+
+@pytest.mark.parametrize("split_call", [False, True])
+def test_full_turn_offline(split_call):
+    state = create_initial_game_state("Luna")
+    gold, luna = state.get("gold") or 0, state["affinity_scores"].get("Luna", 0)
+    chunks = []
+    stages = []
+
+    out = dm_engine.process_turn(
+        state.get("main_quest", ""), state.get("story_summary", ""), state, [], "Apro la porta della cella.",
+        generate_image=False, synthesize_voice=False, split_call=split_call,
+        on_reply_chunk=chunks.append, on_stage=lambda name, _value: stages.append(name),
+    )
+
+    assert out["is_error"] is False
+    assert out["reply_it"].startswith("Luna apre la porta")
+    assert "".join(chunks) == out["reply_it"]
+    assert out["image_info"] is None and out["audio_path"] is None
+    assert out["animation_instructions_en"] == "she pushes the door open"
+
+    new_state = out["game_state"]
+    assert new_state["turn"] == state["turn"] + 1
+    assert new_state["location"] == "Bastione dei Sospiri - Corridoio"
+    # Oro, inventario e affinità passano dagli intenti; la patch su affinity_scores è ignorata
+    assert new_state["gold"] == gold + 5
+    assert "torcia" in new_state["inventory"]
+    assert new_state["affinity_scores"]["Luna"] == luna + 2
+    assert {"llm", "state"} <= set(stages)
+    # Lo stato di partenza resta intatto
+    assert state["location"] != new_state["location"]
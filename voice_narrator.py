@@ -3,13 +3,19 @@ voice_narrator.py
 Versione Anti-Blocco: Usa nomi di file univoci per evitare errori [Errno 13].
 """
 
+import asyncio
 import threading
 import time
 import os
 import re
 import tempfile
 import uuid  # Importante per nomi file univoci
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
+
+from cost_ledger import LEDGER
+
+if TYPE_CHECKING:
+    from deadline import Deadline
 
 # Import Google Cloud TTS
 try:
@@ -29,6 +35,9 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "google_credentials.json"
 # Puoi cambiare qui la voce (es. "it-IT-Neural2-C" per maschile)
 GOOGLE_VOICE_NAME = "it-IT-Neural2-C"
 
+# Timeout della sintesi (ridotto al tempo rimasto al turno, se c'è un deadline)
+TTS_TIMEOUT_SECONDS = float(os.getenv("TTS_TIMEOUT_SECONDS", "30") or "30")
+
 # Stato interno
 _audio_thread: Optional[threading.Thread] = None
 _stop_event = threading.Event()
@@ -44,26 +53,27 @@ def _sanitize_text_for_tts(text: str) -> str:
     s = re.sub(r"\s+", " ", s).strip()
     return s
 
-def _generate_file_google(text: str, out_path: str):
-    """Genera audio e lo salva in un percorso specifico."""
-    try:
-        client = texttospeech.TextToSpeechClient()
-        synthesis_input = texttospeech.SynthesisInput(text=text)
-
-        voice = texttospeech.VoiceSelectionParams(
+def _tts_request(text: str) -> dict:
+    """Parametri della richiesta di sintesi (uguali per client sincrono e asincrono)."""
+    return {
+        "input": texttospeech.SynthesisInput(text=text),
+        "voice": texttospeech.VoiceSelectionParams(
             language_code="it-IT",
             name=GOOGLE_VOICE_NAME
-        )
-
-        audio_config = texttospeech.AudioConfig(
+        ),
+        "audio_config": texttospeech.AudioConfig(
             audio_encoding=texttospeech.AudioEncoding.MP3,
             speaking_rate=1.0,
             pitch=0.0
-        )
+        ),
+    }
 
-        response = client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
+def _generate_file_google(text: str, out_path: str, timeout: float = TTS_TIMEOUT_SECONDS):
+    """Genera audio e lo salva in un percorso specifico."""
+    try:
+        client = texttospeech.TextToSpeechClient()
+        response = client.synthesize_speech(**_tts_request(text), timeout=timeout)
+        LEDGER.record_tts(len(text))
 
         with open(out_path, "wb") as out:
             out.write(response.audio_content)
@@ -72,60 +82,109 @@ def _generate_file_google(text: str, out_path: str):
         print(f"[GOOGLE TTS] ❌ Errore API: {e}")
         raise e
 
-def _playback_worker(text: str):
-    """Genera un file UNIVOCO, lo suona e poi lo cancella."""
-    temp_path = None
+def synthesize(text: str, deadline: Optional["Deadline"] = None) -> Optional[str]:
+    """Genera l'audio in un file UNIVOCO e ne restituisce il percorso (None se fallisce).
+
+    Non riproduce nulla: serve a preparare l'audio in parallelo ad altri lavori.
+    Con un deadline scaduto/annullato non sintetizza (o scarta l'audio appena fatto).
+    """
+    clean_text = _sanitize_text_for_tts(text)
+    if not clean_text or (deadline is not None and deadline.expired()):
+        return None
+    timeout = deadline.timeout(TTS_TIMEOUT_SECONDS) if deadline is not None else TTS_TIMEOUT_SECONDS
+
+    # Percorso file UNIVOCO (mai usato prima)
+    temp_path = _temp_voice_path()
+
+    try:
+        _generate_file_google(clean_text, temp_path, timeout=timeout)
+    except Exception:
+        _remove_quietly(temp_path)
+        return None
+
+    if deadline is not None and deadline.expired():
+        _remove_quietly(temp_path)
+        return None
+    if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
+        return temp_path
+    _remove_quietly(temp_path)
+    return None
+
+def _temp_voice_path() -> str:
+    return os.path.join(tempfile.gettempdir(), f"voice_{uuid.uuid4().hex}.mp3")
+
+async def synthesize_async(text: str, deadline: Optional["Deadline"] = None) -> Optional[str]:
+    """Come synthesize, con il client asincrono di Google TTS (nessun thread in attesa)."""
+    async_client_cls = getattr(texttospeech, "TextToSpeechAsyncClient", None)
+    if async_client_cls is None:
+        return await asyncio.to_thread(synthesize, text, deadline)
+
+    clean_text = _sanitize_text_for_tts(text)
+    if not clean_text or (deadline is not None and deadline.expired()):
+        return None
+    timeout = deadline.timeout(TTS_TIMEOUT_SECONDS) if deadline is not None else TTS_TIMEOUT_SECONDS
+
     try:
-        clean_text = _sanitize_text_for_tts(text)
-        if not clean_text:
-            return
+        response = await async_client_cls().synthesize_speech(**_tts_request(clean_text), timeout=timeout)
+        LEDGER.record_tts(len(clean_text))
+    except Exception as e:
+        print(f"[GOOGLE TTS] ❌ Errore API: {e}")
+        return None
+    if not response.audio_content or (deadline is not None and deadline.expired()):
+        return None
 
-        # 1. Crea un percorso file UNIVOCO (mai usato prima)
-        unique_name = f"voice_{uuid.uuid4().hex}.mp3"
-        temp_path = os.path.join(tempfile.gettempdir(), unique_name)
+    temp_path = _temp_voice_path()
+    with open(temp_path, "wb") as out:
+        out.write(response.audio_content)
+    return temp_path
 
-        # 2. Generazione
+def _remove_quietly(path: Optional[str]):
+    if path and os.path.exists(path):
         try:
-            _generate_file_google(clean_text, temp_path)
+            # Attendiamo un attimo che Windows rilasci il file
+            time.sleep(0.1)
+            os.remove(path)
         except Exception:
-            return
+            # Se non riesce a cancellarlo ora, pazienza, è nella cartella temp
+            pass
 
-        # 3. Riproduzione
-        if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
-            try:
-                pygame.mixer.music.load(temp_path)
-                pygame.mixer.music.play()
-
-                # Attesa
-                while pygame.mixer.music.get_busy() and not _stop_event.is_set():
-                    pygame.time.Clock().tick(20)
+def _play_file_worker(path: str):
+    """Suona un file già generato e poi lo cancella."""
+    try:
+        pygame.mixer.music.load(path)
+        pygame.mixer.music.play()
 
-                if _stop_event.is_set():
-                    pygame.mixer.music.stop()
+        # Attesa
+        while pygame.mixer.music.get_busy() and not _stop_event.is_set():
+            pygame.time.Clock().tick(20)
 
-                # Importante: scarica il file da pygame per poterlo cancellare
-                try:
-                    pygame.mixer.music.unload()
-                except AttributeError:
-                    # Versioni vecchie di pygame non hanno unload, fa nulla
-                    pass
+        if _stop_event.is_set():
+            pygame.mixer.music.stop()
 
-            except Exception as e:
-                print(f"[AUDIO] Errore riproduzione: {e}")
+        # Importante: scarica il file da pygame per poterlo cancellare
+        try:
+            pygame.mixer.music.unload()
+        except AttributeError:
+            # Versioni vecchie di pygame non hanno unload, fa nulla
+            pass
 
     except Exception as e:
-        print(f"[AUDIO] Errore worker: {e}")
+        print(f"[AUDIO] Errore riproduzione: {e}")
 
     finally:
-        # 4. PULIZIA: Cancella il file temporaneo alla fine
-        if temp_path and os.path.exists(temp_path):
-            try:
-                # Attendiamo un attimo che Windows rilasci il file
-                time.sleep(0.1)
-                os.remove(temp_path)
-            except Exception:
-                # Se non riesce a cancellarlo ora, pazienza, è nella cartella temp
-                pass
+        # PULIZIA: Cancella il file temporaneo alla fine
+        _remove_quietly(path)
+
+def _playback_worker(text: str):
+    """Genera un file UNIVOCO, lo suona e poi lo cancella."""
+    try:
+        path = synthesize(text)
+        if path and not _stop_event.is_set():
+            _play_file_worker(path)
+        else:
+            _remove_quietly(path)
+    except Exception as e:
+        print(f"[AUDIO] Errore worker: {e}")
 
 def init_narrator():
     global _is_initialized
@@ -151,9 +210,29 @@ def speak(text: str):
     _audio_thread = threading.Thread(target=_playback_worker, args=(text,), daemon=True)
     _audio_thread.start()
 
+def play_file(path: str):
+    """Riproduce un audio già sintetizzato (vedi synthesize)."""
+    global _audio_thread
+    if not path or not os.path.exists(path): return
+
+    if not _is_initialized:
+        init_narrator()
+
+    stop()
+    _stop_event.clear()
+
+    _audio_thread = threading.Thread(target=_play_file_worker, args=(path,), daemon=True)
+    _audio_thread.start()
+
+def discard_file(path: Optional[str]):
+    """Cancella un audio sintetizzato che non verrà riprodotto."""
+    _remove_quietly(path)
+
+def script_to_text(script_list) -> str:
+    return " ".join([item.get("text", "") for item in script_list if isinstance(item, dict)])
+
 def speak_script(script_list):
-    full_text = " ".join([item.get("text", "") for item in script_list])
-    speak(full_text)
+    speak(script_to_text(script_list))
 
 def stop():
     _stop_event.set()